@@ -13,6 +13,9 @@ from app.agent_types.tools_agent import get_tools_agent_executor
 from app.agent_types.xml_agent import get_xml_agent_executor
 from app.chatbot import get_chatbot_executor
 from app.checkpoint import AsyncPostgresCheckpoint
+from app.context_window import CONTEXT_MAX_TOKENS
+from app.hedging import LLM_HEDGE_AFTER, with_hedge
+from app.llm_cache import with_llm_cache
 from app.llms import (
     get_anthropic_llm,
     get_google_llm,
@@ -20,7 +23,11 @@ from app.llms import (
     get_ollama_llm,
     get_openai_llm,
 )
-from app.retrieval import get_retrieval_executor
+from app.retrieval import (
+    QUERY_REWRITE_TIMEOUT,
+    QueryRewrite,
+    get_retrieval_executor,
+)
 from app.tools import (
     RETRIEVAL_DESCRIPTION,
     TOOLS,
@@ -41,6 +48,7 @@ from app.tools import (
     get_retrieval_tool,
     get_retriever,
 )
+from app.vectorstore import SearchMode
 
 Tool = Union[
     ActionServer,
@@ -75,54 +83,80 @@ DEFAULT_SYSTEM_MESSAGE = "You are a helpful assistant."
 CHECKPOINTER = AsyncPostgresCheckpoint()
 
 
+class LLMType(str, Enum):
+    GPT_35_TURBO = "GPT 3.5 Turbo"
+    GPT_4 = "GPT 4 Turbo"
+    GPT_4O = "GPT 4o"
+    AZURE_OPENAI = "GPT 4 (Azure OpenAI)"
+    CLAUDE2 = "Claude 2"
+    BEDROCK_CLAUDE2 = "Claude 2 (Amazon Bedrock)"
+    GEMINI = "GEMINI"
+    MIXTRAL = "Mixtral"
+    OLLAMA = "Ollama"
+
+
+def get_llm(llm_type: LLMType):
+    if llm_type == LLMType.GPT_35_TURBO:
+        return get_openai_llm()
+    elif llm_type == LLMType.GPT_4:
+        return get_openai_llm(model="gpt-4-turbo")
+    elif llm_type == LLMType.GPT_4O:
+        return get_openai_llm(model="gpt-4o")
+    elif llm_type == LLMType.AZURE_OPENAI:
+        return get_openai_llm(azure=True)
+    elif llm_type == LLMType.CLAUDE2:
+        return get_anthropic_llm()
+    elif llm_type == LLMType.BEDROCK_CLAUDE2:
+        return get_anthropic_llm(bedrock=True)
+    elif llm_type == LLMType.GEMINI:
+        return get_google_llm()
+    elif llm_type == LLMType.MIXTRAL:
+        return get_mixtral_fireworks()
+    elif llm_type == LLMType.OLLAMA:
+        return get_ollama_llm()
+    else:
+        raise ValueError("Unexpected llm type")
+
+
+def get_agent_llm(agent: AgentType):
+    # Each agent type is named after the LLM type it runs on.
+    return get_llm(LLMType(agent.value))
+
+
 def get_agent_executor(
     tools: list,
     agent: AgentType,
     system_message: str,
     interrupt_before_action: bool,
+    context_max_tokens: int = CONTEXT_MAX_TOKENS,
+    llm_cache: bool = False,
+    hedge_agent: Optional[AgentType] = None,
+    hedge_after: float = LLM_HEDGE_AFTER,
 ):
-    if agent == AgentType.GPT_35_TURBO:
-        llm = get_openai_llm()
-        return get_tools_agent_executor(
-            tools, llm, system_message, interrupt_before_action, CHECKPOINTER
-        )
-    elif agent == AgentType.GPT_4:
-        llm = get_openai_llm(model="gpt-4-turbo")
-        return get_tools_agent_executor(
-            tools, llm, system_message, interrupt_before_action, CHECKPOINTER
-        )
-    elif agent == AgentType.GPT_4O:
-        llm = get_openai_llm(model="gpt-4o")
-        return get_tools_agent_executor(
-            tools, llm, system_message, interrupt_before_action, CHECKPOINTER
-        )
-    elif agent == AgentType.AZURE_OPENAI:
-        llm = get_openai_llm(azure=True)
-        return get_tools_agent_executor(
-            tools, llm, system_message, interrupt_before_action, CHECKPOINTER
-        )
-    elif agent == AgentType.CLAUDE2:
-        llm = get_anthropic_llm()
-        return get_tools_agent_executor(
-            tools, llm, system_message, interrupt_before_action, CHECKPOINTER
-        )
-    elif agent == AgentType.BEDROCK_CLAUDE2:
-        llm = get_anthropic_llm(bedrock=True)
+    llm = get_agent_llm(agent)
+    if hedge_agent is not None:
+        if AgentType.BEDROCK_CLAUDE2 in (agent, hedge_agent):
+            # Its prompt and output are in the format of the XML agent.
+            raise ValueError(f"{AgentType.BEDROCK_CLAUDE2.value} cannot be hedged")
+        llm = with_hedge(llm, get_agent_llm(hedge_agent), hedge_after)
+    llm = with_llm_cache(llm, llm_cache)
+    if agent == AgentType.BEDROCK_CLAUDE2:
         return get_xml_agent_executor(
-            tools, llm, system_message, interrupt_before_action, CHECKPOINTER
-        )
-    elif agent == AgentType.GEMINI:
-        llm = get_google_llm()
-        return get_tools_agent_executor(
-            tools, llm, system_message, interrupt_before_action, CHECKPOINTER
-        )
-    elif agent == AgentType.OLLAMA:
-        llm = get_ollama_llm()
-        return get_tools_agent_executor(
-            tools, llm, system_message, interrupt_before_action, CHECKPOINTER
+            tools,
+            llm,
+            system_message,
+            interrupt_before_action,
+            CHECKPOINTER,
+            context_max_tokens=context_max_tokens,
         )
-    else:
-        raise ValueError("Unexpected agent type")
+    return get_tools_agent_executor(
+        tools,
+        llm,
+        system_message,
+        interrupt_before_action,
+        CHECKPOINTER,
+        context_max_tokens=context_max_tokens,
+    )
 
 
 class ConfigurableAgent(RunnableBinding):
@@ -130,7 +164,12 @@ class ConfigurableAgent(RunnableBinding):
     agent: AgentType
     system_message: str = DEFAULT_SYSTEM_MESSAGE
     retrieval_description: str = RETRIEVAL_DESCRIPTION
+    search_mode: SearchMode = SearchMode.VECTOR
     interrupt_before_action: bool = False
+    context_max_tokens: int = CONTEXT_MAX_TOKENS
+    llm_cache: bool = False
+    hedge_agent_type: Optional[AgentType] = None
+    hedge_after: float = LLM_HEDGE_AFTER
     assistant_id: Optional[str] = None
     thread_id: Optional[str] = ""
     user_id: Optional[str] = None
@@ -144,7 +183,12 @@ class ConfigurableAgent(RunnableBinding):
         assistant_id: Optional[str] = None,
         thread_id: Optional[str] = "",
         retrieval_description: str = RETRIEVAL_DESCRIPTION,
+        search_mode: SearchMode = SearchMode.VECTOR,
         interrupt_before_action: bool = False,
+        context_max_tokens: int = CONTEXT_MAX_TOKENS,
+        llm_cache: bool = False,
+        hedge_agent_type: Optional[AgentType] = None,
+        hedge_after: float = LLM_HEDGE_AFTER,
         kwargs: Optional[Mapping[str, Any]] = None,
         config: Optional[Mapping[str, Any]] = None,
         **others: Any,
@@ -158,7 +202,9 @@ class ConfigurableAgent(RunnableBinding):
                         "Both assistant_id and thread_id must be provided if Retrieval tool is used"
                     )
                 _tools.append(
-                    get_retrieval_tool(assistant_id, thread_id, retrieval_description)
+                    get_retrieval_tool(
+                        assistant_id, thread_id, retrieval_description, search_mode
+                    )
                 )
             else:
                 tool_config = _tool.get("config", {})
@@ -168,7 +214,14 @@ class ConfigurableAgent(RunnableBinding):
                 else:
                     _tools.append(_returned_tools)
         _agent = get_agent_executor(
-            _tools, agent, system_message, interrupt_before_action
+            _tools,
+            agent,
+            system_message,
+            interrupt_before_action,
+            context_max_tokens,
+            llm_cache,
+            hedge_agent_type,
+            hedge_after,
         )
         agent_executor = _agent.with_config({"recursion_limit": 50})
         super().__init__(
@@ -176,54 +229,50 @@ class ConfigurableAgent(RunnableBinding):
             agent=agent,
             system_message=system_message,
             retrieval_description=retrieval_description,
+            search_mode=search_mode,
+            context_max_tokens=context_max_tokens,
+            llm_cache=llm_cache,
+            hedge_agent_type=hedge_agent_type,
+            hedge_after=hedge_after,
             bound=agent_executor,
             kwargs=kwargs or {},
             config=config or {},
         )
 
 
-class LLMType(str, Enum):
-    GPT_35_TURBO = "GPT 3.5 Turbo"
-    GPT_4 = "GPT 4 Turbo"
-    GPT_4O = "GPT 4o"
-    AZURE_OPENAI = "GPT 4 (Azure OpenAI)"
-    CLAUDE2 = "Claude 2"
-    BEDROCK_CLAUDE2 = "Claude 2 (Amazon Bedrock)"
-    GEMINI = "GEMINI"
-    MIXTRAL = "Mixtral"
-    OLLAMA = "Ollama"
+def get_chatbot_llm(llm_type: LLMType):
+    # Chatbots on GPT 4 Turbo have always run gpt-4, unlike the other bots.
+    if llm_type == LLMType.GPT_4:
+        return get_openai_llm(model="gpt-4")
+    return get_llm(llm_type)
 
 
 def get_chatbot(
     llm_type: LLMType,
     system_message: str,
+    context_max_tokens: int = CONTEXT_MAX_TOKENS,
+    llm_cache: bool = False,
+    hedge_llm_type: Optional[LLMType] = None,
+    hedge_after: float = LLM_HEDGE_AFTER,
 ):
-    if llm_type == LLMType.GPT_35_TURBO:
-        llm = get_openai_llm()
-    elif llm_type == LLMType.GPT_4:
-        llm = get_openai_llm(model="gpt-4")
-    elif llm_type == LLMType.GPT_4O:
-        llm = get_openai_llm(model="gpt-4o")
-    elif llm_type == LLMType.AZURE_OPENAI:
-        llm = get_openai_llm(azure=True)
-    elif llm_type == LLMType.CLAUDE2:
-        llm = get_anthropic_llm()
-    elif llm_type == LLMType.BEDROCK_CLAUDE2:
-        llm = get_anthropic_llm(bedrock=True)
-    elif llm_type == LLMType.GEMINI:
-        llm = get_google_llm()
-    elif llm_type == LLMType.MIXTRAL:
-        llm = get_mixtral_fireworks()
-    elif llm_type == LLMType.OLLAMA:
-        llm = get_ollama_llm()
-    else:
-        raise ValueError("Unexpected llm type")
-    return get_chatbot_executor(llm, system_message, CHECKPOINTER)
+    llm = get_chatbot_llm(llm_type)
+    if hedge_llm_type is not None:
+        llm = with_hedge(llm, get_chatbot_llm(hedge_llm_type), hedge_after)
+    return get_chatbot_executor(
+        with_llm_cache(llm, llm_cache),
+        system_message,
+        CHECKPOINTER,
+        context_max_tokens=context_max_tokens,
+    )
 
 
 class ConfigurableChatBot(RunnableBinding):
     llm: LLMType
     system_message: str = DEFAULT_SYSTEM_MESSAGE
+    context_max_tokens: int = CONTEXT_MAX_TOKENS
+    llm_cache: bool = False
+    hedge_llm_type: Optional[LLMType] = None
+    hedge_after: float = LLM_HEDGE_AFTER
     user_id: Optional[str] = None
 
     def __init__(
@@ -231,16 +280,31 @@ class ConfigurableChatBot(RunnableBinding):
         *,
         llm: LLMType = LLMType.GPT_35_TURBO,
         system_message: str = DEFAULT_SYSTEM_MESSAGE,
+        context_max_tokens: int = CONTEXT_MAX_TOKENS,
+        llm_cache: bool = False,
+        hedge_llm_type: Optional[LLMType] = None,
+        hedge_after: float = LLM_HEDGE_AFTER,
         kwargs: Optional[Mapping[str, Any]] = None,
         config: Optional[Mapping[str, Any]] = None,
         **others: Any,
     ) -> None:
         others.pop("bound", None)
 
-        chatbot = get_chatbot(llm, system_message)
+        chatbot = get_chatbot(
+            llm,
+            system_message,
+            context_max_tokens,
+            llm_cache,
+            hedge_llm_type,
+            hedge_after,
+        )
         super().__init__(
             llm=llm,
             system_message=system_message,
+            context_max_tokens=context_max_tokens,
+            llm_cache=llm_cache,
+            hedge_llm_type=hedge_llm_type,
+            hedge_after=hedge_after,
             bound=chatbot,
             kwargs=kwargs or {},
             config=config or {},
@@ -252,6 +316,26 @@ chatbot = (
     .configurable_fields(
         llm=ConfigurableField(id="llm_type", name="LLM Type"),
         system_message=ConfigurableField(id="system_message", name="Instructions"),
+        context_max_tokens=ConfigurableField(
+            id="context_max_tokens",
+            name="Context Token Limit",
+            description="Token budget of the thread history sent to the LLM. Older messages are summarized. 0 sends the whole history.",
+        ),
+        llm_cache=ConfigurableField(
+            id="llm_cache",
+            name="Cache LLM Responses",
+            description="If Yes, prompts identical to earlier ones are answered from a cache instead of calling the LLM again.",
+        ),
+        hedge_llm_type=ConfigurableField(
+            id="hedge_llm_type",
+            name="Hedge LLM Type",
+            description="If set, this LLM is also asked when the LLM Type has not started answering after the Hedge Delay, and the first to answer is used.",
+        ),
+        hedge_after=ConfigurableField(
+            id="hedge_after",
+            name="Hedge Delay",
+            description="Seconds without an answer after which the Hedge LLM Type is asked.",
+        ),
     )
     .with_types(
         input_type=Messages,
@@ -263,6 +347,13 @@ chatbot = (
 class ConfigurableRetrieval(RunnableBinding):
     llm_type: LLMType
     system_message: str = DEFAULT_SYSTEM_MESSAGE
+    query_rewrite: QueryRewrite = QueryRewrite.ALWAYS
+    rewrite_llm_type: Optional[LLMType] = None
+    rewrite_timeout: float = QUERY_REWRITE_TIMEOUT
+    search_mode: SearchMode = SearchMode.VECTOR
+    llm_cache: bool = False
+    hedge_llm_type: Optional[LLMType] = None
+    hedge_after: float = LLM_HEDGE_AFTER
     assistant_id: Optional[str] = None
     thread_id: Optional[str] = ""
     user_id: Optional[str] = None
@@ -272,6 +363,13 @@ class ConfigurableRetrieval(RunnableBinding):
         *,
         llm_type: LLMType = LLMType.GPT_35_TURBO,
         system_message: str = DEFAULT_SYSTEM_MESSAGE,
+        query_rewrite: QueryRewrite = QueryRewrite.ALWAYS,
+        rewrite_llm_type: Optional[LLMType] = None,
+        rewrite_timeout: float = QUERY_REWRITE_TIMEOUT,
+        search_mode: SearchMode = SearchMode.VECTOR,
+        llm_cache: bool = False,
+        hedge_llm_type: Optional[LLMType] = None,
+        hedge_after: float = LLM_HEDGE_AFTER,
         assistant_id: Optional[str] = None,
         thread_id: Optional[str] = "",
         kwargs: Optional[Mapping[str, Any]] = None,
@@ -279,31 +377,35 @@ class ConfigurableRetrieval(RunnableBinding):
         **others: Any,
     ) -> None:
         others.pop("bound", None)
-        retriever = get_retriever(assistant_id, thread_id)
-        if llm_type == LLMType.GPT_35_TURBO:
-            llm = get_openai_llm()
-        elif llm_type == LLMType.GPT_4:
-            llm = get_openai_llm(model="gpt-4-turbo")
-        elif llm_type == LLMType.GPT_4O:
-            llm = get_openai_llm(model="gpt-4o")
-        elif llm_type == LLMType.AZURE_OPENAI:
-            llm = get_openai_llm(azure=True)
-        elif llm_type == LLMType.CLAUDE2:
-            llm = get_anthropic_llm()
-        elif llm_type == LLMType.BEDROCK_CLAUDE2:
-            llm = get_anthropic_llm(bedrock=True)
-        elif llm_type == LLMType.GEMINI:
-            llm = get_google_llm()
-        elif llm_type == LLMType.MIXTRAL:
-            llm = get_mixtral_fireworks()
-        elif llm_type == LLMType.OLLAMA:
-            llm = get_ollama_llm()
-        else:
-            raise ValueError("Unexpected llm type")
-        chatbot = get_retrieval_executor(llm, retriever, system_message, CHECKPOINTER)
+        retriever = get_retriever(assistant_id, thread_id, search_mode)
+        llm = get_llm(llm_type)
+        if hedge_llm_type is not None:
+            llm = with_hedge(llm, get_llm(hedge_llm_type), hedge_after)
+        llm = with_llm_cache(llm, llm_cache)
+        rewrite_llm = (
+            with_llm_cache(get_llm(rewrite_llm_type), llm_cache)
+            if rewrite_llm_type
+            else None
+        )
+        chatbot = get_retrieval_executor(
+            llm,
+            retriever,
+            system_message,
+            CHECKPOINTER,
+            query_rewrite=query_rewrite,
+            rewrite_llm=rewrite_llm,
+            rewrite_timeout=rewrite_timeout,
+        )
         super().__init__(
             llm_type=llm_type,
             system_message=system_message,
+            query_rewrite=query_rewrite,
+            rewrite_llm_type=rewrite_llm_type,
+            rewrite_timeout=rewrite_timeout,
+            search_mode=search_mode,
+            llm_cache=llm_cache,
+            hedge_llm_type=hedge_llm_type,
+            hedge_after=hedge_after,
             bound=chatbot,
             kwargs=kwargs or {},
             config=config or {},
@@ -315,6 +417,41 @@ chat_retrieval = (
     .configurable_fields(
         llm_type=ConfigurableField(id="llm_type", name="LLM Type"),
         system_message=ConfigurableField(id="system_message", name="Instructions"),
+        query_rewrite=ConfigurableField(
+            id="query_rewrite",
+            name="Query Rewrite",
+            description="How follow-up messages are turned into search queries.\nalways: rewrite every follow-up with the LLM.\nheuristic: skip the rewrite for self-contained questions.\nspeculative: search for the message while the rewrite runs, saves time when the rewrite does not change the query.",
+        ),
+        rewrite_llm_type=ConfigurableField(
+            id="rewrite_llm_type",
+            name="Query Rewrite LLM Type",
+            description="The LLM used to rewrite search queries. Defaults to the LLM Type.",
+        ),
+        rewrite_timeout=ConfigurableField(
+            id="rewrite_timeout",
+            name="Query Rewrite Timeout",
+            description="With speculative query rewrite, seconds to wait for the rewrite before answering from the search for the message as is.",
+        ),
+        search_mode=ConfigurableField(
+            id="search_mode",
+            name="Search Mode",
+            description="How uploaded files are searched.\nvector: semantic similarity of embeddings.\nhybrid: semantic similarity combined with keyword search, better for exact terms like codes and names.",
+        ),
+        llm_cache=ConfigurableField(
+            id="llm_cache",
+            name="Cache LLM Responses",
+            description="If Yes, prompts identical to earlier ones are answered from a cache instead of calling the LLM again.",
+        ),
+        hedge_llm_type=ConfigurableField(
+            id="hedge_llm_type",
+            name="Hedge LLM Type",
+            description="If set, this LLM is also asked when the LLM Type has not started answering after the Hedge Delay, and the first to answer is used.",
+        ),
+        hedge_after=ConfigurableField(
+            id="hedge_after",
+            name="Hedge Delay",
+            description="Seconds without an answer after which the Hedge LLM Type is asked.",
+        ),
         assistant_id=ConfigurableField(
             id="assistant_id", name="Assistant ID", is_shared=True
         ),
@@ -356,6 +493,31 @@ agent: Pregel = (
         retrieval_description=ConfigurableField(
             id="retrieval_description", name="Retrieval Description"
         ),
+        search_mode=ConfigurableField(
+            id="search_mode",
+            name="Search Mode",
+            description="How uploaded files are searched.\nvector: semantic similarity of embeddings.\nhybrid: semantic similarity combined with keyword search, better for exact terms like codes and names.",
+        ),
+        context_max_tokens=ConfigurableField(
+            id="context_max_tokens",
+            name="Context Token Limit",
+            description="Token budget of the thread history sent to the LLM. Older messages are summarized. 0 sends the whole history.",
+        ),
+        llm_cache=ConfigurableField(
+            id="llm_cache",
+            name="Cache LLM Responses",
+            description="If Yes, prompts identical to earlier ones are answered from a cache instead of calling the LLM again.",
+        ),
+        hedge_agent_type=ConfigurableField(
+            id="hedge_agent_type",
+            name="Hedge Agent Type",
+            description="If set, the LLM of this agent type is also asked when the LLM of the Agent Type has not started answering after the Hedge Delay, and the first to answer is used.",
+        ),
+        hedge_after=ConfigurableField(
+            id="hedge_after",
+            name="Hedge Delay",
+            description="Seconds without an answer after which the Hedge Agent Type is asked.",
+        ),
     )
     .configurable_alternatives(
         ConfigurableField(id="type", name="Bot Type"),
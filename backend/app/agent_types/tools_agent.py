@@ -1,4 +1,7 @@
+import asyncio
+import time
 from typing import cast
+from uuid import uuid4
 
 from langchain.tools import BaseTool
 from langchain_core.language_models.base import LanguageModelLike
@@ -6,15 +9,39 @@ from langchain_core.messages import (
     AIMessage,
     FunctionMessage,
     HumanMessage,
-    SystemMessage,
     ToolMessage,
 )
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langchain_core.runnables.config import merge_configs
 from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import END
 from langgraph.graph.message import MessageGraph
 from langgraph.prebuilt import ToolExecutor, ToolInvocation
 
+from app.context_window import CONTEXT_MAX_TOKENS, with_context_window
 from app.message_types import LiberalToolMessage
+from app.prompt_caching import cached_system_message
+from app.singleflight import invoke_tool
+from app.tool_cache import RunResults
+from app.tool_executors import TOOL_CALL_RUN_NAME
+
+
+def _run_results(messages) -> RunResults:
+    """Return the results of the tool calls since the last human message."""
+    results = RunResults()
+    calls = {}
+    for message in reversed(messages):
+        if isinstance(message, HumanMessage):
+            break
+        if isinstance(message, ToolMessage):
+            calls[message.tool_call_id] = message.content
+        elif isinstance(message, AIMessage):
+            for tool_call in message.tool_calls:
+                if tool_call["id"] in calls:
+                    results.add(
+                        tool_call["name"], tool_call["args"], calls[tool_call["id"]]
+                    )
+    return results
 
 
 def get_tools_agent_executor(
@@ -23,6 +50,8 @@ def get_tools_agent_executor(
     system_message: str,
     interrupt_before_action: bool,
     checkpoint: BaseCheckpointSaver,
+    *,
+    context_max_tokens: int = CONTEXT_MAX_TOKENS,
 ):
     async def _get_messages(messages):
         msgs = []
@@ -38,13 +67,20 @@ def get_tools_agent_executor(
             else:
                 msgs.append(m)
 
-        return [SystemMessage(content=system_message)] + msgs
+        return [cached_system_message(system_message)] + msgs
 
+    # The same tools in the same order keep the prompt prefix cacheable.
+    tools = sorted(tools, key=lambda tool: tool.name)
     if tools:
         llm_with_tools = llm.bind_tools(tools)
     else:
         llm_with_tools = llm
-    agent = _get_messages | llm_with_tools
+    agent = with_context_window(
+        _get_messages,
+        llm_with_tools,
+        summary_llm=llm,
+        max_tokens=context_max_tokens,
+    )
     tool_executor = ToolExecutor(tools)
 
     # Define the function that determines whether to continue or not
@@ -58,31 +94,50 @@ def get_tools_agent_executor(
             return "continue"
 
     # Define the function to execute tools
-    async def call_tool(messages):
-        actions: list[ToolInvocation] = []
+    async def call_tool(messages, config: RunnableConfig):
         # Based on the continue condition
         # we know the last message involves a function call
         last_message = cast(AIMessage, messages[-1])
-        for tool_call in last_message.tool_calls:
-            # We construct a ToolInvocation from the function_call
-            actions.append(
-                ToolInvocation(
-                    tool=tool_call["name"],
-                    tool_input=tool_call["args"],
-                )
+        run_results = _run_results(messages)
+
+        async def call_one(tool_call) -> LiberalToolMessage:
+            started = time.monotonic()
+            # We construct a ToolInvocation from the tool call
+            action = ToolInvocation(
+                tool=tool_call["name"], tool_input=tool_call["args"]
             )
-        # We call the tool_executor and get back a response
-        responses = await tool_executor.abatch(actions)
-        # We use the response to create a ToolMessage
-        tool_messages = [
-            LiberalToolMessage(
+            # We call the tool_executor and get back a response
+            response = await invoke_tool(tool_executor, action, run_results)
+            # We use the response to create a ToolMessage, with the id it will
+            # have in the state, since it is streamed as soon as it is ready
+            return LiberalToolMessage(
+                id=str(uuid4()),
                 tool_call_id=tool_call["id"],
                 name=tool_call["name"],
                 content=response,
+                response_metadata={"duration": round(time.monotonic() - started, 3)},
+            )
+
+        # Each call is a run of its own, whose start and end are streamed
+        # while the other calls are still running
+        tool_run = RunnableLambda(call_one, name=TOOL_CALL_RUN_NAME)
+        return await asyncio.gather(
+            *(
+                tool_run.ainvoke(
+                    tool_call,
+                    merge_configs(
+                        config,
+                        {
+                            "metadata": {
+                                "tool": tool_call["name"],
+                                "tool_call_id": tool_call["id"],
+                            }
+                        },
+                    ),
+                )
+                for tool_call in last_message.tool_calls
             )
-            for tool_call, response in zip(last_message.tool_calls, responses)
-        ]
-        return tool_messages
+        )
 
     workflow = MessageGraph()
 
@@ -1,3 +1,6 @@
+import time
+from uuid import uuid4
+
 from langchain.tools import BaseTool
 from langchain.tools.render import render_text_description
 from langchain_core.language_models.base import LanguageModelLike
@@ -5,15 +8,21 @@ from langchain_core.messages import (
     AIMessage,
     FunctionMessage,
     HumanMessage,
-    SystemMessage,
 )
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langchain_core.runnables.config import merge_configs
 from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import END
 from langgraph.graph.message import MessageGraph
 from langgraph.prebuilt import ToolExecutor, ToolInvocation
 
 from app.agent_types.prompts import xml_template
+from app.context_window import CONTEXT_MAX_TOKENS, with_context_window
 from app.message_types import LiberalFunctionMessage
+from app.prompt_caching import cached_system_message
+from app.singleflight import invoke_tool
+from app.tool_cache import RunResults
+from app.tool_executors import TOOL_CALL_RUN_NAME
 
 
 def _collapse_messages(messages):
@@ -59,13 +68,48 @@ def construct_chat_history(messages):
     return collapsed_messages
 
 
+def _parse_tool_invocation(content: str) -> ToolInvocation:
+    tool, tool_input = content.split("</tool>")
+    _tool = tool.split("<tool>")[1]
+    if "<tool_input>" not in tool_input:
+        _tool_input = ""
+    else:
+        _tool_input = tool_input.split("<tool_input>")[1]
+        if "</tool_input>" in _tool_input:
+            _tool_input = _tool_input.split("</tool_input>")[0]
+    return ToolInvocation(
+        tool=_tool,
+        tool_input=_tool_input,
+    )
+
+
+def _run_results(messages) -> RunResults:
+    """Return the results of the tool calls since the last human message."""
+    results = RunResults()
+    for action, observation in zip(messages, messages[1:] + [None]):
+        if isinstance(action, HumanMessage):
+            results = RunResults()
+        elif (
+            isinstance(action, AIMessage)
+            and "</tool>" in action.content
+            and isinstance(observation, LiberalFunctionMessage)
+        ):
+            invocation = _parse_tool_invocation(action.content)
+            results.add(invocation.tool, invocation.tool_input, observation.content)
+    return results
+
+
 def get_xml_agent_executor(
     tools: list[BaseTool],
     llm: LanguageModelLike,
     system_message: str,
     interrupt_before_action: bool,
     checkpoint: BaseCheckpointSaver,
+    *,
+    context_max_tokens: int = CONTEXT_MAX_TOKENS,
 ):
+    # The same tools in the same order keep the prompt prefix cacheable.
+    tools = sorted(tools, key=lambda tool: tool.name)
     formatted_system_message = xml_template.format(
         system_message=system_message,
         tools=render_text_description(tools),
@@ -75,11 +119,16 @@ def get_xml_agent_executor(
     llm_with_stop = llm.bind(stop=["</tool_input>", "<observation>"])
 
     def _get_messages(messages):
-        return [
-            SystemMessage(content=formatted_system_message)
-        ] + construct_chat_history(messages)
+        return [cached_system_message(formatted_system_message)] + (
+            construct_chat_history(messages)
+        )
 
-    agent = _get_messages | llm_with_stop
+    agent = with_context_window(
+        _get_messages,
+        llm_with_stop,
+        summary_llm=llm,
+        max_tokens=context_max_tokens,
+    )
     tool_executor = ToolExecutor(tools)
 
     # Define the function that determines whether to continue or not
@@ -91,29 +140,30 @@ def get_xml_agent_executor(
             return "end"
 
     # Define the function to execute tools
-    async def call_tool(messages):
+    async def call_tool(messages, config: RunnableConfig):
         # Based on the continue condition
         # we know the last message involves a function call
         last_message = messages[-1]
         # We construct an ToolInvocation from the function_call
-        tool, tool_input = last_message.content.split("</tool>")
-        _tool = tool.split("<tool>")[1]
-        if "<tool_input>" not in tool_input:
-            _tool_input = ""
-        else:
-            _tool_input = tool_input.split("<tool_input>")[1]
-            if "</tool_input>" in _tool_input:
-                _tool_input = _tool_input.split("</tool_input>")[0]
-        action = ToolInvocation(
-            tool=_tool,
-            tool_input=_tool_input,
+        action = _parse_tool_invocation(last_message.content)
+        run_results = _run_results(messages)
+
+        async def call_one(action: ToolInvocation) -> LiberalFunctionMessage:
+            started = time.monotonic()
+            # We call the tool_executor and get back a response
+            response = await invoke_tool(tool_executor, action, run_results)
+            # We use the response to create a FunctionMessage
+            return LiberalFunctionMessage(
+                id=str(uuid4()),
+                content=response,
+                name=action.tool,
+                response_metadata={"duration": round(time.monotonic() - started, 3)},
+            )
+
+        # The call is a run of its own, whose start and end are streamed
+        return await RunnableLambda(call_one, name=TOOL_CALL_RUN_NAME).ainvoke(
+            action, merge_configs(config, {"metadata": {"tool": action.tool}})
         )
-        # We call the tool_executor and get back a response
-        response = await tool_executor.ainvoke(action)
-        # We use the response to create a FunctionMessage
-        function_message = LiberalFunctionMessage(content=response, name=action.tool)
-        # We return a list, because this will get added to the existing list
-        return function_message
 
     workflow = MessageGraph()
 
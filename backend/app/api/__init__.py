@@ -1,6 +1,7 @@
 from fastapi import APIRouter
 
 from app.api.assistants import router as assistants_router
+from app.api.documents import router as documents_router
 from app.api.runs import router as runs_router
 from app.api.threads import router as threads_router
 
@@ -27,3 +28,8 @@ router.include_router(
     prefix="/threads",
     tags=["threads"],
 )
+router.include_router(
+    documents_router,
+    prefix="/documents",
+    tags=["documents"],
+)
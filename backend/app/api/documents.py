@@ -0,0 +1,96 @@
+from typing import Annotated, List, Optional
+
+from fastapi import APIRouter, HTTPException, Path, Query, UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+import app.storage as storage
+from app.auth.handlers import AuthedUser
+from app.jobs import ingest_jobs
+from app.schema import Document, IngestJob
+from app.upload import (
+    FileTooLargeError,
+    convert_ingestion_input_to_blob,
+    ingest_runnable,
+    release_blob,
+)
+
+router = APIRouter()
+
+
+DocumentID = Annotated[str, Path(description="The ID of the document.")]
+
+
+async def _get_owned_document(user_id: str, document_id: str) -> Document:
+    document = await storage.get_document(document_id)
+    if document is None or not await storage.owns_namespace(
+        user_id, document.namespace
+    ):
+        raise HTTPException(status_code=404, detail="Document not found")
+    return document
+
+
+@router.get("/")
+async def list_documents(
+    user: AuthedUser,
+    assistant_id: Annotated[
+        Optional[str], Query(description="List the files of this assistant.")
+    ] = None,
+    thread_id: Annotated[
+        Optional[str], Query(description="List the files of this thread.")
+    ] = None,
+) -> List[Document]:
+    """List the files uploaded to an assistant or a thread."""
+    if (assistant_id is None) == (thread_id is None):
+        raise HTTPException(
+            status_code=422,
+            detail="Exactly one of assistant_id or thread_id must be provided",
+        )
+    namespace = assistant_id if assistant_id is not None else thread_id
+    if not await storage.owns_namespace(user.user_id, namespace):
+        raise HTTPException(status_code=404, detail="Namespace not found")
+    return await storage.list_documents(namespace)
+
+
+@router.get("/{did}")
+async def get_document(user: AuthedUser, did: DocumentID) -> Document:
+    """Get an uploaded file by ID."""
+    return await _get_owned_document(user.user_id, did)
+
+
+@router.put("/{did}")
+async def replace_document(
+    user: AuthedUser, did: DocumentID, file: UploadFile
+) -> IngestJob:
+    """Replace the content of an uploaded file.
+
+    The new content keeps the name of the file. Its old chunks are deleted in
+    the same transaction the new ones are recorded in, once the returned
+    ingestion job has indexed them.
+    """
+    document = await _get_owned_document(user.user_id, did)
+    if await storage.get_thread(user.user_id, document.namespace) is not None:
+        configurable = {"thread_id": document.namespace}
+    else:
+        configurable = {"assistant_id": document.namespace}
+
+    file.filename = document.source
+    try:
+        # Spooling to disk is blocking I/O, keep it off the event loop.
+        blob = await run_in_threadpool(convert_ingestion_input_to_blob, file)
+    except FileTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return ingest_jobs.submit(
+        user.user_id,
+        ingest_runnable,
+        [blob],
+        {"configurable": configurable},
+        cleanup=release_blob,
+    )
+
+
+@router.delete("/{did}")
+async def delete_document(user: AuthedUser, did: DocumentID):
+    """Delete an uploaded file and its chunks."""
+    await _get_owned_document(user.user_id, did)
+    await storage.delete_document(did)
+    return {"status": "ok"}
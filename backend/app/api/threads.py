@@ -127,12 +127,15 @@ async def upsert_thread(
     thread_put_request: ThreadPutRequest,
 ) -> Thread:
     """Update a thread."""
-    return await storage.put_thread(
+    thread = await storage.put_thread(
         user.user_id,
         tid,
         assistant_id=thread_put_request.assistant_id,
         name=thread_put_request.name,
     )
+    if not thread:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    return thread
 
 
 @router.delete("/{tid}")
@@ -0,0 +1,148 @@
+"""Chat models that wrap another chat model.
+
+The inner model is called with the "nostream" tag, and its output is streamed
+as the output of the wrapper, so that clients see a single model run whose
+messages have the id of the wrapper run. Subclasses change how the inner model
+is called by overriding `_acall`.
+"""
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence
+
+import orjson
+from langchain_core.callbacks import (
+    AsyncCallbackManager,
+    AsyncCallbackManagerForLLMRun,
+    CallbackManager,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models.chat_models import (
+    BaseChatModel,
+    agenerate_from_stream,
+    generate_from_stream,
+)
+from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
+    BaseMessage,
+    BaseMessageChunk,
+)
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableBinding, RunnableConfig
+
+
+def message_to_chunk(message: BaseMessage) -> BaseMessageChunk:
+    """Return a chunk holding the whole message, so it can be streamed."""
+    if isinstance(message, BaseMessageChunk):
+        return message
+    if not isinstance(message, AIMessage):
+        raise TypeError(f"Cannot stream a {message.type} message")
+    return AIMessageChunk(
+        content=message.content,
+        additional_kwargs=message.additional_kwargs,
+        response_metadata=message.response_metadata,
+        usage_metadata=message.usage_metadata,
+        id=message.id,
+        tool_call_chunks=[
+            {
+                "name": call["name"],
+                "args": orjson.dumps(call["args"]).decode(),
+                "id": call["id"],
+                "index": index,
+            }
+            for index, call in enumerate(message.tool_calls)
+        ],
+    )
+
+
+class DelegatingChatModel(BaseChatModel):
+    """Chat model that forwards its calls to `inner`."""
+
+    inner: BaseChatModel
+
+    @property
+    def _llm_type(self) -> str:
+        return self.inner._llm_type
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return self.inner._identifying_params
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> RunnableBinding:
+        # Let the inner model convert the tools to the format of its provider,
+        # and pass them back to it on each call.
+        bound = self.inner.bind_tools(tools, **kwargs)
+        return self.bind(**bound.kwargs)
+
+    def _inner_config(self, run_manager: Any) -> RunnableConfig:
+        if run_manager is None:
+            return {"tags": ["nostream"]}
+        # Run managers of LLMs have no get_child(), this is its equivalent.
+        if isinstance(run_manager, AsyncCallbackManagerForLLMRun):
+            manager = AsyncCallbackManager(
+                handlers=[], parent_run_id=run_manager.run_id
+            )
+        else:
+            manager = CallbackManager(handlers=[], parent_run_id=run_manager.run_id)
+        manager.set_handlers(run_manager.inheritable_handlers)
+        manager.add_tags(run_manager.inheritable_tags)
+        manager.add_metadata(run_manager.inheritable_metadata)
+        manager.add_tags(["nostream"], False)
+        return {"callbacks": manager}
+
+    async def _acall(
+        self,
+        messages: List[BaseMessage],
+        config: RunnableConfig,
+        *,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[BaseMessageChunk]:
+        """Stream the response to the messages."""
+        async for chunk in self.inner.astream(messages, config, stop=stop, **kwargs):
+            yield chunk
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        config = self._inner_config(run_manager)
+        async for chunk in self._acall(messages, config, stop=stop, **kwargs):
+            # The chunks take the id of the run of this model.
+            chunk = message_to_chunk(chunk).model_copy(update={"id": None})
+            yield ChatGenerationChunk(message=chunk)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await agenerate_from_stream(
+            self._astream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        )
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        config = self._inner_config(run_manager)
+        for chunk in self.inner.stream(messages, config, stop=stop, **kwargs):
+            chunk = message_to_chunk(chunk).model_copy(update={"id": None})
+            yield ChatGenerationChunk(message=chunk)
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return generate_from_stream(
+            self._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        )
@@ -1,22 +1,28 @@
 from typing import Annotated, List
 
 from langchain_core.language_models.base import LanguageModelLike
-from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.messages import BaseMessage
 from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph.state import StateGraph
 
+from app.context_window import CONTEXT_MAX_TOKENS, with_context_window
 from app.message_types import add_messages_liberal
+from app.prompt_caching import cached_system_message
 
 
 def get_chatbot_executor(
     llm: LanguageModelLike,
     system_message: str,
     checkpoint: BaseCheckpointSaver,
+    *,
+    context_max_tokens: int = CONTEXT_MAX_TOKENS,
 ):
     def _get_messages(messages):
-        return [SystemMessage(content=system_message)] + messages
+        return [cached_system_message(system_message)] + messages
 
-    chatbot = _get_messages | llm
+    chatbot = with_context_window(
+        _get_messages, llm, summary_llm=llm, max_tokens=context_max_tokens
+    )
 
     workflow = StateGraph(Annotated[List[BaseMessage], add_messages_liberal])
     workflow.add_node("chatbot", chatbot)
@@ -0,0 +1,126 @@
+"""Select retrieved chunks to put in the prompt.
+
+Retrieval returns more candidates than are needed. They are picked with
+maximal marginal relevance (MMR), so that chunks that repeat each other are
+not all picked. Chunks split from the same file overlap by a few hundred
+characters, so the overlap with already picked chunks is removed. Picking
+stops when `k` chunks are picked or the token budget is spent.
+"""
+import os
+from typing import List, Optional, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+
+from app.tokens import count_tokens
+
+RETRIEVAL_MAX_TOKENS = int(os.environ.get("RETRIEVAL_MAX_TOKENS", "2000"))
+"""Maximum number of tokens of retrieved context in a prompt."""
+
+# Overlaps shorter than this are more likely a coincidence than a split.
+_MIN_OVERLAP = 20
+# Only this many characters at the edges of chunks are compared. It should be
+# more than the chunk_overlap of the text splitter used at ingestion.
+_MAX_OVERLAP = 500
+
+
+def _overlap(a: str, b: str) -> int:
+    """Length of the longest suffix of `a` that is a prefix of `b`."""
+    if len(b) < _MIN_OVERLAP:
+        return 0
+    tail = a[-_MAX_OVERLAP:]
+    head = b[:_MIN_OVERLAP]
+    start = tail.find(head)
+    while start != -1:
+        if b.startswith(tail[start:]):
+            return len(tail) - start
+        start = tail.find(head, start + 1)
+    return 0
+
+
+def _remove_overlap(doc: Document, picked: Sequence[Document]) -> Optional[Document]:
+    """Strip the text `doc` shares with the picked chunks of the same file.
+
+    Returns None if nothing new is left.
+    """
+    text = doc.page_content
+    source = doc.metadata.get("source")
+    for other in picked:
+        if other.metadata.get("source") != source:
+            continue
+        if text in other.page_content:
+            return None
+        if overlap := _overlap(other.page_content, text):
+            text = text[overlap:]
+        if overlap := _overlap(text, other.page_content):
+            text = text[:-overlap]
+    if not text.strip():
+        return None
+    if text == doc.page_content:
+        return doc
+    return Document(page_content=text, metadata=doc.metadata)
+
+
+def _normalize_rows(embeddings: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+# PUBLIC API
+
+
+def pack_context(
+    docs: Sequence[Document],
+    embeddings: np.ndarray,
+    relevance: Sequence[float],
+    *,
+    k: int,
+    lambda_mult: float = 0.5,
+    max_tokens: Optional[int] = None,
+    duplicate_threshold: float = 0.95,
+) -> List[Document]:
+    """Pick up to `k` of the candidate chunks, in the order they are picked.
+
+    Args:
+        docs: The candidate chunks.
+        embeddings: The embeddings of the candidates, one row per chunk.
+        relevance: The relevance of each candidate to the query, on any scale.
+        k: Maximum number of chunks to pick.
+        lambda_mult: Between 0 and 1. Higher values favor relevance over
+            diversity.
+        max_tokens: Maximum number of tokens of the picked chunks.
+        duplicate_threshold: Candidates with a cosine similarity to a picked
+            chunk above this are skipped as near duplicates.
+    """
+    if not docs:
+        return []
+    embeddings = _normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    relevance = np.asarray(relevance, dtype=np.float32)
+    spread = relevance.max() - relevance.min()
+    relevance = (
+        (relevance - relevance.min()) / spread if spread else np.ones_like(relevance)
+    )
+    similarity = embeddings @ embeddings.T
+
+    # Highest similarity of each candidate to the picked chunks.
+    redundancy = np.zeros(len(docs), dtype=np.float32)
+    available = np.ones(len(docs), dtype=bool)
+    picked: List[Document] = []
+    tokens = 0
+    while len(picked) < k and available.any():
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        i = int(np.argmax(scores))
+        available[i] = False
+        if redundancy[i] >= duplicate_threshold:
+            continue
+        doc = _remove_overlap(docs[i], picked)
+        if doc is None:
+            continue
+        doc_tokens = count_tokens(doc.page_content)
+        if max_tokens is not None and tokens + doc_tokens > max_tokens:
+            continue
+        tokens += doc_tokens
+        picked.append(doc)
+        redundancy = np.maximum(redundancy, similarity[i])
+    return picked
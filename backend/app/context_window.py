@@ -0,0 +1,216 @@
+"""Fit the history of a thread into a token budget.
+
+Recent turns are sent to the LLM verbatim. Once the history outgrows the
+budget, the oldest turns are folded into a summary, which is kept in the
+thread state as a message with the id SUMMARY_MESSAGE_ID and updated
+incrementally: only the turns that are newly folded are summarized, together
+with the previous summary. The summary is sent as part of the system message.
+
+A turn starts at a human message and includes every message up to the next
+one, so a tool call is never separated from its result.
+"""
+import inspect
+import os
+from typing import Any, Awaitable, Callable, List, Optional, Sequence, Tuple, Union
+
+import orjson
+from langchain_core.language_models.base import LanguageModelLike
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+)
+from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+
+from app.tokens import count_tokens
+
+CONTEXT_MAX_TOKENS = int(os.environ.get("CONTEXT_MAX_TOKENS", "8000"))
+"""Token budget of the thread history sent to the LLM. 0 sends all of it."""
+
+SUMMARY_MESSAGE_ID = "conversation-summary"
+
+# Tokens of the role and separators of each message, as counted by OpenAI.
+_TOKENS_PER_MESSAGE = 4
+# Long tool results are truncated before being summarized.
+_MAX_SUMMARIZED_CHARS = 2000
+
+summary_prompt = PromptTemplate.from_template(
+    """Progressively summarize the lines of conversation below, adding onto the previous summary.
+
+Keep the facts, names, numbers, decisions and open questions that may matter later in the conversation. Return ONLY the new summary.
+
+>>> Previous summary:
+{summary}
+
+>>> New lines of conversation:
+{conversation}
+>>> END OF CONVERSATION"""
+)
+
+_SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+GetMessages = Callable[
+    [List[BaseMessage]], Union[List[BaseMessage], Awaitable[List[BaseMessage]]]
+]
+
+
+def _content_text(content: Any) -> str:
+    return content if isinstance(content, str) else str(content)
+
+
+def _message_tokens(message: BaseMessage, model: Optional[str]) -> int:
+    tokens = _TOKENS_PER_MESSAGE + count_tokens(_content_text(message.content), model)
+    if isinstance(message, AIMessage) and message.tool_calls:
+        tokens += count_tokens(orjson.dumps(message.tool_calls).decode(), model)
+    return tokens
+
+
+def _split_turns(messages: Sequence[BaseMessage]) -> List[List[BaseMessage]]:
+    turns: List[List[BaseMessage]] = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _format_conversation(messages: Sequence[BaseMessage]) -> str:
+    lines = []
+    for message in messages:
+        text = _content_text(message.content)
+        if len(text) > _MAX_SUMMARIZED_CHARS:
+            text = text[:_MAX_SUMMARIZED_CHARS] + "..."
+        if isinstance(message, AIMessage) and message.tool_calls:
+            calls = ", ".join(
+                f"{call['name']}({orjson.dumps(call['args']).decode()})"
+                for call in message.tool_calls
+            )
+            text = f"{text}\n[called {calls}]".strip()
+        role = {"human": "Human", "ai": "AI"}.get(message.type, message.type.title())
+        lines.append(f"{role}: {text}")
+    return "\n".join(lines)
+
+
+def _model_name(llm: LanguageModelLike) -> Optional[str]:
+    # Wrappers such as app.llm_cache.CachedChatModel hold the model in `inner`.
+    while getattr(llm, "inner", None) is not None:
+        llm = llm.inner
+    return getattr(llm, "model_name", None) or getattr(llm, "model", None)
+
+
+def window_messages(
+    messages: Sequence[BaseMessage], *, max_tokens: int, model: Optional[str] = None
+) -> Tuple[Optional[BaseMessage], List[BaseMessage], List[BaseMessage]]:
+    """Split the history into the turns to fold into the summary and the
+    turns to keep verbatim.
+
+    Returns the current summary message, if any, the messages to fold and
+    the messages to keep. Nothing is folded while the unsummarized turns fit
+    in `max_tokens`. Otherwise the most recent turns that fit in half of it
+    are kept, so that the summary is not updated on every turn. The last turn
+    is always kept.
+    """
+    summary = next((m for m in messages if m.id == SUMMARY_MESSAGE_ID), None)
+    history = [m for m in messages if m.id != SUMMARY_MESSAGE_ID]
+    if summary is not None:
+        summarized_until = summary.additional_kwargs.get("summarized_until")
+        ids = [m.id for m in history]
+        if summarized_until in ids:
+            history = history[ids.index(summarized_until) + 1 :]
+
+    turns = _split_turns(history)
+    tokens = [sum(_message_tokens(m, model) for m in turn) for turn in turns]
+    if len(turns) < 2 or sum(tokens) <= max_tokens:
+        return summary, [], history
+
+    kept = 1
+    used = tokens[-1]
+    while kept < len(turns) and used + tokens[-kept - 1] <= max_tokens // 2:
+        used += tokens[-kept - 1]
+        kept += 1
+    folded = [m for turn in turns[:-kept] for m in turn]
+    return summary, folded, [m for turn in turns[-kept:] for m in turn]
+
+
+async def summarize(
+    llm: LanguageModelLike,
+    summary: Optional[BaseMessage],
+    messages: Sequence[BaseMessage],
+    config: Optional[RunnableConfig] = None,
+) -> SystemMessage:
+    """Fold the messages into the summary, returning the new summary message."""
+    response = await llm.ainvoke(
+        summary_prompt.format(
+            summary=summary.content if summary is not None else "(none)",
+            conversation=_format_conversation(messages),
+        ),
+        config,
+    )
+    return SystemMessage(
+        id=SUMMARY_MESSAGE_ID,
+        content=_content_text(response.content).strip(),
+        additional_kwargs={"summarized_until": messages[-1].id},
+    )
+
+
+def _with_summary(
+    prompt: List[BaseMessage], summary: Optional[BaseMessage]
+) -> List[BaseMessage]:
+    if summary is None:
+        return prompt
+    text = _SUMMARY_PREFIX + _content_text(summary.content)
+    if prompt and isinstance(prompt[0], SystemMessage):
+        # Some providers only accept a system message at the start.
+        # The summary comes last, so that the prefix of the prompt is stable.
+        system = SystemMessage(
+            content=f"{prompt[0].content}\n\n{text}",
+            additional_kwargs=prompt[0].additional_kwargs,
+        )
+        return [system] + prompt[1:]
+    return [SystemMessage(content=text)] + prompt
+
+
+# PUBLIC API
+
+
+def with_context_window(
+    get_messages: GetMessages,
+    llm: LanguageModelLike,
+    *,
+    summary_llm: LanguageModelLike,
+    max_tokens: int = CONTEXT_MAX_TOKENS,
+) -> Runnable:
+    """Return the node that calls `llm` with the prompt built by
+    `get_messages` from the thread history that fits in `max_tokens`.
+
+    The node returns the response of the LLM, preceded by the updated summary
+    when turns were folded into it. `summary_llm` writes the summary, its
+    output is not streamed to the client.
+    """
+    if not max_tokens:
+        return RunnableLambda(get_messages) | llm
+
+    model = _model_name(summary_llm)
+    summary_llm = summary_llm.with_config(
+        {"run_name": "summarize_history", "tags": ["nostream"]}
+    )
+
+    async def call_model(
+        messages: List[BaseMessage], config: RunnableConfig
+    ) -> List[BaseMessage]:
+        summary, folded, kept = window_messages(
+            messages, max_tokens=max_tokens, model=model
+        )
+        updates = []
+        if folded:
+            summary = await summarize(summary_llm, summary, folded, config)
+            updates.append(summary)
+        prompt = get_messages(kept)
+        if inspect.isawaitable(prompt):
+            prompt = await prompt
+        response = await llm.ainvoke(_with_summary(prompt, summary), config)
+        return updates + [response]
+
+    return RunnableLambda(call_model)
@@ -0,0 +1,98 @@
+"""Record of the files ingested into each namespace.
+
+The `document` table (migration 9) keeps the hash of each ingested file and
+the ids of its chunks. Uploading a file whose name is already recorded in
+the namespace replaces its chunks, and uploading identical content again is
+a no-op.
+"""
+import hashlib
+from typing import List, NamedTuple, Optional
+
+import sqlalchemy
+from langchain_core.document_loaders.blob_loaders import Blob
+from sqlalchemy.engine import Engine
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+_GET_SQL = """
+SELECT CAST(document_id AS text), content_hash, chunk_ids
+FROM document
+WHERE namespace = :namespace AND source = :source
+"""
+
+# Concurrent uploads of the same file are applied one after the other, so
+# that the chunks of neither are left behind. The file may not have a row
+# to lock yet, hence the advisory lock.
+_LOCK_SQL = """
+SELECT pg_advisory_xact_lock(hashtext(:namespace || '/' || :source))
+"""
+
+# Chunks share their id across the collections of different embedding
+# models, see app.reindex.
+_DELETE_CHUNKS_SQL = """
+DELETE FROM langchain_pg_embedding
+WHERE cmetadata->>'namespace' = :namespace
+AND custom_id = ANY(:chunk_ids)
+"""
+
+_UPSERT_SQL = """
+INSERT INTO document (namespace, source, content_hash, chunk_ids)
+VALUES (:namespace, :source, :content_hash, :chunk_ids)
+ON CONFLICT (namespace, source) DO UPDATE SET
+    content_hash = EXCLUDED.content_hash,
+    chunk_ids = EXCLUDED.chunk_ids,
+    updated_at = CURRENT_TIMESTAMP AT TIME ZONE 'UTC'
+RETURNING CAST(document_id AS text)
+"""
+
+
+class DocumentRecord(NamedTuple):
+    document_id: str
+    content_hash: str
+    chunk_ids: List[str]
+
+
+def hash_blob(blob: Blob) -> str:
+    """Return the SHA-256 of the content of a blob, without loading it at once."""
+    digest = hashlib.sha256()
+    with blob.as_bytes_io() as f:
+        while chunk := f.read(_HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DocumentRegistry:
+    """Read and replace the ingested files of a namespace."""
+
+    def __init__(self, bind: Engine) -> None:
+        self.bind = bind
+
+    def get(self, namespace: str, source: str) -> Optional[DocumentRecord]:
+        with self.bind.connect() as conn:
+            row = conn.execute(
+                sqlalchemy.text(_GET_SQL), {"namespace": namespace, "source": source}
+            ).first()
+        return DocumentRecord(*row) if row is not None else None
+
+    def replace(
+        self, namespace: str, source: str, content_hash: str, chunk_ids: List[str]
+    ) -> str:
+        """Record the chunks of a file, and delete the chunks it had before.
+
+        Runs in one transaction. Returns the id of the document.
+        """
+        params = {"namespace": namespace, "source": source}
+        with self.bind.begin() as conn:
+            conn.execute(sqlalchemy.text(_LOCK_SQL), params)
+            row = conn.execute(sqlalchemy.text(_GET_SQL), params).first()
+            if row is not None:
+                stale = sorted(set(row[2]) - set(chunk_ids))
+                if stale:
+                    conn.execute(
+                        sqlalchemy.text(_DELETE_CHUNKS_SQL),
+                        {"namespace": namespace, "chunk_ids": stale},
+                    )
+            return conn.execute(
+                sqlalchemy.text(_UPSERT_SQL),
+                {**params, "content_hash": content_hash, "chunk_ids": chunk_ids},
+            ).scalar()
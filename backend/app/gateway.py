@@ -0,0 +1,405 @@
+"""Admission control and retries for the calls to each LLM provider.
+
+Each provider and model has a gateway, shared by every request of the server
+process, which bounds the calls in flight and queues the others, spaces calls
+out to a rate limit, and retries failed calls with jittered backoff, honoring
+the Retry-After header of the provider. Retries are drawn from a budget that
+is refilled by successful calls, so that a failing provider is not sent a
+multiple of the regular traffic. After repeated failures, the circuit breaker
+fails calls right away until the provider is tried again.
+
+Limits are read from the environment, e.g. LLM_MAX_IN_FLIGHT, and can be set
+per provider by suffixing the name of the provider, e.g.
+LLM_MAX_IN_FLIGHT_OPENAI.
+"""
+import asyncio
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+from enum import Enum
+from functools import lru_cache
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    TypeVar,
+)
+
+import httpx
+import structlog
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.chat_models import generate_from_stream
+from langchain_core.messages import BaseMessage, BaseMessageChunk
+from langchain_core.messages.ai import UsageMetadata, add_usage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableConfig
+
+from app.chat_models import DelegatingChatModel
+from app.metrics import METRICS
+from app.prompt_caching import record_usage
+
+logger = structlog.get_logger(__name__)
+
+T = TypeVar("T")
+
+# Too many requests, timeouts, and server errors, including the "overloaded"
+# status of Anthropic.
+_RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504, 529}
+
+_BASE_RETRY_DELAY = 0.5
+_MAX_RETRY_DELAY = 30.0
+
+QUEUE_DEPTH = METRICS.gauge(
+    "llm_gateway_queue_depth", "LLM calls waiting for a slot, per provider and model."
+)
+IN_FLIGHT = METRICS.gauge(
+    "llm_gateway_in_flight", "LLM calls in flight, per provider and model."
+)
+REJECTIONS = METRICS.counter(
+    "llm_gateway_rejections_total",
+    "LLM calls failed without calling the provider, per provider, model and reason.",
+)
+RETRIES = METRICS.counter(
+    "llm_gateway_retries_total", "Retried LLM calls, per provider and model."
+)
+CIRCUIT_OPEN = METRICS.gauge(
+    "llm_gateway_circuit_open", "1 while calls to the provider fail fast, else 0."
+)
+
+
+class ProviderUnavailableError(RuntimeError):
+    """Raised when a call is rejected without calling the provider."""
+
+
+def _setting(name: str, provider: str, default: str) -> str:
+    return os.environ.get(f"{name}_{provider.upper()}", os.environ.get(name, default))
+
+
+class GatewayLimits(NamedTuple):
+    max_in_flight: int = 16
+    """Calls in flight at once. Further calls wait for a slot."""
+    max_queue: int = 256
+    """Calls waiting for a slot. Further calls are rejected."""
+    requests_per_minute: float = 0.0
+    """Rate of calls, with bursts of up to a tenth of it. 0 is unlimited."""
+    max_retries: int = 3
+    """Retries of a failed call."""
+    retry_budget: float = 0.2
+    """Retries allowed per successful call, beyond a reserve of 10 retries."""
+    circuit_failures: int = 5
+    """Consecutive failures after which calls fail fast."""
+    circuit_reset: float = 30.0
+    """Seconds after which the provider is tried again."""
+
+    @classmethod
+    def from_env(cls, provider: str) -> "GatewayLimits":
+        defaults = cls()
+        return cls(
+            **{
+                field: type(getattr(defaults, field))(
+                    _setting(
+                        f"LLM_{field.upper()}", provider, str(getattr(defaults, field))
+                    )
+                )
+                for field in cls._fields
+            }
+        )
+
+
+class TokenBucket:
+    """Spaces calls out to `rate` per second, with bursts of `capacity`."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RetryBudget:
+    """Allows `ratio` retries per successful call, and `reserve` at most."""
+
+    def __init__(self, ratio: float, reserve: float = 10.0) -> None:
+        self.ratio = ratio
+        self.reserve = reserve
+        self._balance = reserve
+
+    def deposit(self) -> None:
+        self._balance = min(self.reserve, self._balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self._balance < 1:
+            return False
+        self._balance -= 1
+        return True
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Fails calls fast after `failures` consecutive failures, for `reset`
+    seconds, after which one call is let through to try the provider."""
+
+    def __init__(self, failures: int, reset: float) -> None:
+        self.failures = failures
+        self.reset = reset
+        self.state = CircuitState.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == CircuitState.CLOSED:
+            return True
+        # Let a trial call through every `reset` seconds until one succeeds.
+        if time.monotonic() - self._opened_at < self.reset:
+            return False
+        self.state = CircuitState.HALF_OPEN
+        self._opened_at = time.monotonic()
+        return True
+
+    def record_success(self) -> None:
+        self.state = CircuitState.CLOSED
+        self._consecutive_failures = 0
+
+    def record_failure(self) -> None:
+        self._consecutive_failures += 1
+        if (
+            self.state == CircuitState.HALF_OPEN
+            or self._consecutive_failures >= self.failures
+        ):
+            self.state = CircuitState.OPEN
+            self._opened_at = time.monotonic()
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether the call may succeed if made again."""
+    status = _status_code(error)
+    if status is not None:
+        return status in _RETRYABLE_STATUS_CODES
+    # Clients of providers wrap connection errors and timeouts.
+    cause = error.__cause__ or error
+    return isinstance(
+        cause, (httpx.TransportError, asyncio.TimeoutError, ConnectionError)
+    )
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Return the delay requested by the provider before a retry, if any."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    if value := headers.get("retry-after-ms"):
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    if value := headers.get("retry-after"):
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+class ProviderGateway:
+    """Calls to one model of a provider."""
+
+    def __init__(self, provider: str, model: str, limits: GatewayLimits) -> None:
+        self.provider = provider
+        self.model = model
+        self.limits = limits
+        self._labels = {"provider": provider, "model": model}
+        self._slots = asyncio.Semaphore(limits.max_in_flight)
+        self._waiting = 0
+        self._in_flight = 0
+        self._rate = (
+            TokenBucket(
+                limits.requests_per_minute / 60, limits.requests_per_minute / 10
+            )
+            if limits.requests_per_minute
+            else None
+        )
+        self._budget = RetryBudget(limits.retry_budget)
+        self._circuit = CircuitBreaker(limits.circuit_failures, limits.circuit_reset)
+
+    def _reject(self, reason: str) -> ProviderUnavailableError:
+        REJECTIONS.inc(reason=reason, **self._labels)
+        return ProviderUnavailableError(
+            f"{self.provider} {self.model} is unavailable: {reason.replace('_', ' ')}"
+        )
+
+    def _set_gauges(self) -> None:
+        QUEUE_DEPTH.set(self._waiting, **self._labels)
+        IN_FLIGHT.set(self._in_flight, **self._labels)
+        CIRCUIT_OPEN.set(
+            float(self._circuit.state == CircuitState.OPEN), **self._labels
+        )
+
+    def _delay(self, error: BaseException, attempt: int) -> Optional[float]:
+        requested = retry_after(error)
+        if requested is not None:
+            if requested > _MAX_RETRY_DELAY:
+                return None
+            # Spread the retries of the calls rejected together.
+            return requested + random.uniform(0, _BASE_RETRY_DELAY)
+        return random.uniform(0, min(_MAX_RETRY_DELAY, _BASE_RETRY_DELAY * 2**attempt))
+
+    async def _acquire(self) -> None:
+        if not self._circuit.allow():
+            raise self._reject("circuit_open")
+        if self._slots.locked() and self._waiting >= self.limits.max_queue:
+            raise self._reject("queue_full")
+        self._waiting += 1
+        self._set_gauges()
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        self._in_flight += 1
+        self._set_gauges()
+
+    def _release(self) -> None:
+        self._in_flight -= 1
+        self._slots.release()
+        self._set_gauges()
+
+    async def stream(self, call: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """Yield the chunks of `call()`, retrying it while nothing was yielded."""
+        await self._acquire()
+        try:
+            attempt = 0
+            while True:
+                if self._rate is not None:
+                    await self._rate.acquire()
+                started = False
+                try:
+                    async for chunk in call():
+                        started = True
+                        yield chunk
+                except Exception as e:
+                    if not is_retryable(e):
+                        # The provider answered, the call itself is wrong.
+                        self._circuit.record_success()
+                        raise
+                    self._circuit.record_failure()
+                    delay = self._delay(e, attempt)
+                    if (
+                        started
+                        or delay is None
+                        or attempt >= self.limits.max_retries
+                        or not self._circuit.allow()
+                        or not self._budget.withdraw()
+                    ):
+                        raise
+                    logger.warning(
+                        "Retrying LLM call",
+                        provider=self.provider,
+                        model=self.model,
+                        attempt=attempt + 1,
+                        delay=round(delay, 2),
+                        error=str(e),
+                    )
+                    RETRIES.inc(**self._labels)
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                else:
+                    self._circuit.record_success()
+                    self._budget.deposit()
+                    return
+        finally:
+            self._release()
+
+
+class GatewayChatModel(DelegatingChatModel):
+    """Chat model whose calls go through `gateway`."""
+
+    gateway: ProviderGateway
+
+    async def _acall(
+        self,
+        messages: List[BaseMessage],
+        config: RunnableConfig,
+        *,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[BaseMessageChunk]:
+        parent = super()._acall
+        usage: Optional[UsageMetadata] = None
+        async for chunk in self.gateway.stream(
+            lambda: parent(messages, config, stop=stop, **kwargs)
+        ):
+            if getattr(chunk, "usage_metadata", None):
+                usage = add_usage(usage, chunk.usage_metadata)
+            yield chunk
+        record_usage(self.gateway.provider, self.gateway.model, usage)
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        # The limits of the gateway are shared by the calls of the event loop,
+        # and the clients of the providers do not retry, so a sync call would
+        # bypass both.
+        raise NotImplementedError(
+            "Calls through the gateway are asynchronous, use ainvoke or astream"
+        )
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return generate_from_stream(
+            self._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        )
+
+
+# PUBLIC API
+
+
+@lru_cache(maxsize=None)
+def get_gateway(provider: str, model: str) -> ProviderGateway:
+    """Return the gateway of a model, shared by the whole process."""
+    return ProviderGateway(provider, model, GatewayLimits.from_env(provider))
+
+
+def with_gateway(llm: BaseChatModel, provider: str, model: str) -> BaseChatModel:
+    """Return the model, calling it through the gateway of `provider`."""
+    return GatewayChatModel(inner=llm, gateway=get_gateway(provider, model))
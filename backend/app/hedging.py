@@ -0,0 +1,156 @@
+"""Hedge slow LLM calls with a call to another model.
+
+If the primary model has not streamed its first chunk after `hedge_after`
+seconds, or failed before that, the same prompt is sent to the hedge model.
+The first of the two to stream a chunk answers, and the other call is
+cancelled. Only the slowest calls are hedged, so the traffic to the hedge
+model stays a small fraction of the traffic to the primary one.
+"""
+import asyncio
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage, BaseMessageChunk
+from langchain_core.runnables import Runnable, RunnableBinding, RunnableConfig
+
+from app.chat_models import DelegatingChatModel
+from app.metrics import METRICS
+
+LLM_HEDGE_AFTER = float(os.environ.get("LLM_HEDGE_AFTER", "2.0"))
+"""Seconds without a first chunk after which a hedged LLM call is hedged."""
+
+_DONE = object()
+
+HEDGED_CALLS = METRICS.counter(
+    "llm_hedged_calls_total", "Calls of LLMs with a hedge model, per primary model."
+)
+HEDGES = METRICS.counter(
+    "llm_hedges_total", "Hedged calls sent to the hedge model, per primary model."
+)
+HEDGE_WINS = METRICS.counter(
+    "llm_hedge_wins_total",
+    "Hedged calls answered by each model, per primary model and winner.",
+)
+
+
+class _Call:
+    """A call streamed into a queue by a task of its own."""
+
+    def __init__(self, chunks: AsyncIterator[BaseMessageChunk]) -> None:
+        self._queue: "asyncio.Queue[Tuple[Any, Optional[BaseException]]]" = (
+            asyncio.Queue()
+        )
+        self.task = asyncio.create_task(self._run(chunks))
+
+    async def _run(self, chunks: AsyncIterator[BaseMessageChunk]) -> None:
+        try:
+            async for chunk in chunks:
+                self._queue.put_nowait((chunk, None))
+        except Exception as e:
+            self._queue.put_nowait((_DONE, e))
+        else:
+            self._queue.put_nowait((_DONE, None))
+
+    async def next(self) -> Tuple[Any, Optional[BaseException]]:
+        return await self._queue.get()
+
+    async def rest(self) -> AsyncIterator[BaseMessageChunk]:
+        while True:
+            chunk, error = await self.next()
+            if error is not None:
+                raise error
+            if chunk is _DONE:
+                return
+            yield chunk
+
+
+class HedgedChatModel(DelegatingChatModel):
+    """Chat model that hedges slow calls of `inner` with calls of `hedge`."""
+
+    hedge: Runnable
+    hedge_after: float = LLM_HEDGE_AFTER
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> RunnableBinding:
+        # Each model gets the tools in the format of its provider.
+        bound = self.inner.bind_tools(tools, **kwargs)
+        hedged = self.model_copy(
+            update={"hedge": self.hedge.bind_tools(tools, **kwargs)}
+        )
+        return hedged.bind(**bound.kwargs)
+
+    async def _acall(
+        self,
+        messages: List[BaseMessage],
+        config: RunnableConfig,
+        *,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[BaseMessageChunk]:
+        labels = {"model": self.inner._llm_type}
+        HEDGED_CALLS.inc(**labels)
+        calls: Dict[str, _Call] = {
+            "primary": _Call(super()._acall(messages, config, stop=stop, **kwargs))
+        }
+        pending: Dict[asyncio.Future, str] = {
+            asyncio.ensure_future(calls["primary"].next()): "primary"
+        }
+        errors: Dict[str, BaseException] = {}
+        winner: Optional[str] = None
+        first: Any = None
+
+        def start_hedge() -> None:
+            HEDGES.inc(**labels)
+            calls["hedge"] = _Call(self.hedge.astream(messages, config, stop=stop))
+            pending[asyncio.ensure_future(calls["hedge"].next())] = "hedge"
+
+        try:
+            while winner is None:
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=None if "hedge" in calls else self.hedge_after,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    start_hedge()
+                    continue
+                for future in done:
+                    name = pending.pop(future)
+                    chunk, error = future.result()
+                    if error is None:
+                        winner, first = name, chunk
+                        break
+                    # Failed before streaming anything, the other call answers.
+                    errors[name] = error
+                    if "hedge" not in calls:
+                        start_hedge()
+                if winner is None and not pending:
+                    raise errors["primary"]
+
+            HEDGE_WINS.inc(winner=winner, **labels)
+            for future in pending:
+                future.cancel()
+            for name, call in calls.items():
+                if name != winner:
+                    call.task.cancel()
+
+            if first is _DONE:
+                return
+            yield first
+            async for chunk in calls[winner].rest():
+                yield chunk
+        finally:
+            for future in pending:
+                future.cancel()
+            for call in calls.values():
+                call.task.cancel()
+
+
+# PUBLIC API
+
+
+def with_hedge(
+    llm: BaseChatModel, hedge: BaseChatModel, hedge_after: float = LLM_HEDGE_AFTER
+) -> BaseChatModel:
+    """Return the model, hedging its slow calls with calls of `hedge`."""
+    return HedgedChatModel(inner=llm, hedge=hedge, hedge_after=hedge_after)
@@ -0,0 +1,182 @@
+"""HTTP clients shared by the clients of the LLM and embedding providers.
+
+Every OpenAI, Azure OpenAI and Anthropic client of the process sends its
+requests through the same connection pools, so connections stay warm when a
+model is created again, and their size, keepalive and timeouts are set in one
+place. Connections to the configured providers are opened at startup.
+"""
+import asyncio
+import os
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
+
+import httpx
+import structlog
+
+from app.metrics import METRICS
+
+logger = structlog.get_logger(__name__)
+
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "100"))
+"""Connections of each pool, in use or idle."""
+
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+"""Idle connections kept open by each pool."""
+
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "60"))
+"""Seconds after which an idle connection is closed."""
+
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+"""Seconds to wait for a connection, or for a connection of the pool."""
+
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "600"))
+"""Seconds to wait for each chunk of a response, or to send a request."""
+
+HTTP2 = int(os.environ.get("HTTP2", "0"))
+"""Whether to use HTTP/2 when the server supports it. Requires h2, which is
+not installed by default (`pip install httpx[http2]`)."""
+
+HTTP_PREWARM_CONNECTIONS = int(os.environ.get("HTTP_PREWARM_CONNECTIONS", "2"))
+"""Connections opened at startup to each provider. 0 disables prewarming."""
+
+HTTP_PREWARM_URLS = os.environ.get("HTTP_PREWARM_URLS")
+"""Comma separated URLs to connect to at startup. Defaults to the URLs of the
+providers whose credentials are set."""
+
+_PREWARM_TIMEOUT = 10.0
+
+POOL_CONNECTIONS = METRICS.gauge(
+    "http_pool_connections", "Connections of the shared HTTP pools, per state."
+)
+PREWARMED = METRICS.counter(
+    "http_prewarmed_connections_total", "Connections opened at startup, per host."
+)
+
+_async_clients: Dict[Optional[str], httpx.AsyncClient] = {}
+_sync_clients: Dict[Optional[str], httpx.Client] = {}
+
+
+@lru_cache(maxsize=1)
+def _http2() -> bool:
+    if not HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("h2 is not installed, HTTP/2 is disabled")
+        return False
+    return True
+
+
+def _settings() -> Tuple[httpx.Limits, httpx.Timeout]:
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT, pool=HTTP_CONNECT_TIMEOUT
+    )
+    return limits, timeout
+
+
+def _default_prewarm_urls() -> List[str]:
+    urls = []
+    if os.environ.get("OPENAI_API_KEY"):
+        urls.append(os.environ.get("OPENAI_BASE_URL") or "https://api.openai.com")
+    if os.environ.get("AZURE_OPENAI_API_BASE"):
+        urls.append(os.environ["AZURE_OPENAI_API_BASE"])
+    if os.environ.get("ANTHROPIC_API_KEY"):
+        urls.append("https://api.anthropic.com")
+    return urls
+
+
+def _pool_connections(client: Union[httpx.Client, httpx.AsyncClient]) -> List:
+    # httpx does not expose the state of its pool.
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    return list(getattr(pool, "connections", []))
+
+
+@METRICS.collector
+def _collect_pool_metrics() -> None:
+    for kind, clients in (("async", _async_clients), ("sync", _sync_clients)):
+        for proxy, client in list(clients.items()):
+            connections = _pool_connections(client)
+            idle = sum(1 for connection in connections if connection.is_idle())
+            labels = {"client": kind, "proxy": proxy or ""}
+            POOL_CONNECTIONS.set(idle, state="idle", **labels)
+            POOL_CONNECTIONS.set(len(connections) - idle, state="active", **labels)
+
+
+# PUBLIC API
+
+
+def get_async_http_client(proxy: Optional[str] = None) -> httpx.AsyncClient:
+    """Return the shared async HTTP client, sending requests through `proxy`."""
+    client = _async_clients.get(proxy)
+    if client is None or client.is_closed:
+        limits, timeout = _settings()
+        transport = httpx.AsyncHTTPTransport(proxy=proxy, limits=limits, http2=_http2())
+        client = _async_clients[proxy] = httpx.AsyncClient(
+            transport=transport, timeout=timeout
+        )
+    return client
+
+
+def get_http_client(proxy: Optional[str] = None) -> httpx.Client:
+    """Return the shared sync HTTP client, sending requests through `proxy`."""
+    client = _sync_clients.get(proxy)
+    if client is None or client.is_closed:
+        limits, timeout = _settings()
+        transport = httpx.HTTPTransport(proxy=proxy, limits=limits, http2=_http2())
+        client = _sync_clients[proxy] = httpx.Client(
+            transport=transport, timeout=timeout
+        )
+    return client
+
+
+async def prewarm_http_clients(
+    urls: Optional[List[str]] = None,
+    *,
+    connections: int = HTTP_PREWARM_CONNECTIONS,
+    proxy: Optional[str] = None,
+) -> None:
+    """Open `connections` connections to each URL, to keep in the pool.
+
+    Failures are logged, the connections are opened again when needed.
+    """
+    if urls is None:
+        urls = (
+            [url.strip() for url in HTTP_PREWARM_URLS.split(",") if url.strip()]
+            if HTTP_PREWARM_URLS
+            else _default_prewarm_urls()
+        )
+    if not urls or connections <= 0:
+        return
+    client = get_async_http_client(proxy)
+
+    async def connect(url: str) -> None:
+        try:
+            # Any response will do, it is the connection that is kept.
+            await client.head(url, timeout=_PREWARM_TIMEOUT)
+            PREWARMED.inc(host=httpx.URL(url).host)
+        except httpx.HTTPError as e:
+            logger.warning("Failed to prewarm connection", url=url, error=str(e))
+
+    # Concurrent requests to the same host each take a connection.
+    await asyncio.gather(*(connect(url) for url in urls for _ in range(connections)))
+
+
+async def close_http_clients() -> None:
+    """Close the connections of the shared HTTP clients.
+
+    The clients themselves stay open: the cached models and vectorstores keep
+    them, and open new connections when they are used again.
+    """
+    # Closing the pool of a transport drops its connections, it can be reused.
+    for client in _async_clients.values():
+        await client._transport.aclose()
+    for client in _sync_clients.values():
+        client._transport.close()
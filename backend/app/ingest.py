@@ -6,14 +6,39 @@ into a vector store.
 This code should be agnostic to how the blob got generated; i.e., it does not
 know about server/uploading etc.
 """
-from typing import List
+import random
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Iterator, List, Optional, Sequence, Tuple
+from uuid import uuid4
 
+import structlog
 from langchain.text_splitter import TextSplitter
 from langchain_community.document_loaders import Blob
 from langchain_community.document_loaders.base import BaseBlobParser
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_core.vectorstores import VectorStore
 
+logger = structlog.get_logger(__name__)
+
+# Substrings of provider errors raised when a single embedding request
+# carries too many tokens or inputs. Such batches are split, not retried.
+_BATCH_TOO_LARGE_MARKERS = (
+    "maximum context length",
+    "tokens per request",
+    "too many tokens",
+    "too many inputs",
+)
+_TRANSIENT_ERROR_NAMES = {
+    "APIConnectionError",
+    "APITimeoutError",
+    "InternalServerError",
+    "RateLimitError",
+}
+_TRANSIENT_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
 
 def _update_document_metadata(document: Document, namespace: str) -> None:
     """Mutation in place that adds a namespace to the document metadata."""
@@ -27,21 +52,77 @@ def _sanitize_document_content(document: Document) -> Document:
     document.page_content = document.page_content.replace("\x00", "x")
 
 
-# PUBLIC API
+def _is_batch_too_large(error: Exception) -> bool:
+    message = str(error).lower()
+    return any(marker in message for marker in _BATCH_TOO_LARGE_MARKERS)
 
 
-def ingest_blob(
+def _is_transient(error: Exception) -> bool:
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if type(error).__name__ in _TRANSIENT_ERROR_NAMES:
+        return True
+    return getattr(error, "status_code", None) in _TRANSIENT_STATUS_CODES
+
+
+def _embed_texts(
+    embeddings: Embeddings, texts: List[str], *, max_retries: int
+) -> List[List[float]]:
+    """Embed texts, halving the batch when it is too large for the provider."""
+    attempt = 0
+    while True:
+        try:
+            return embeddings.embed_documents(texts)
+        except Exception as e:
+            if _is_batch_too_large(e) and len(texts) > 1:
+                mid = len(texts) // 2
+                logger.info("Splitting embedding batch", size=len(texts))
+                return _embed_texts(
+                    embeddings, texts[:mid], max_retries=max_retries
+                ) + _embed_texts(embeddings, texts[mid:], max_retries=max_retries)
+            if not _is_transient(e) or attempt >= max_retries:
+                raise
+            attempt += 1
+            # Exponential backoff with full jitter.
+            time.sleep(random.uniform(0, min(30.0, 0.5 * 2**attempt)))
+
+
+def _write_embedded_batch(
+    vectorstore: VectorStore,
+    batch: List[Document],
+    embedded: "Future[List[List[float]]]",
+    ids: List[str],
+) -> List[str]:
+    return vectorstore.add_embeddings(
+        texts=[doc.page_content for doc in batch],
+        embeddings=embedded.result(),
+        metadatas=[doc.metadata for doc in batch],
+        ids=ids,
+    )
+
+
+def _write_mirrored_batch(
+    vectorstore: VectorStore,
+    batch: List[Document],
+    embedded: "Future[List[List[float]]]",
+    ids: List[str],
+) -> None:
+    # A chunk missing from a mirror is copied by the reindex job that set up
+    # the mirror, so failing here must not fail the ingestion.
+    try:
+        _write_embedded_batch(vectorstore, batch, embedded, ids)
+    except Exception:
+        logger.exception("Failed to write batch to mirror vectorstore")
+
+
+def _iter_batches(
     blob: Blob,
     parser: BaseBlobParser,
     text_splitter: TextSplitter,
-    vectorstore: VectorStore,
     namespace: str,
-    *,
-    batch_size: int = 100,
-) -> List[str]:
-    """Ingest a document into the vectorstore."""
-    docs_to_index = []
-    ids = []
+    batch_size: int,
+) -> Iterator[List[Document]]:
+    docs_to_index: List[Document] = []
     for document in parser.lazy_parse(blob):
         docs = text_splitter.split_documents([document])
         for doc in docs:
@@ -49,11 +130,153 @@ def ingest_blob(
             _update_document_metadata(doc, namespace)
         docs_to_index.extend(docs)
 
-        if len(docs_to_index) >= batch_size:
-            ids.extend(vectorstore.add_documents(docs_to_index))
-            docs_to_index = []
+        while len(docs_to_index) >= batch_size:
+            yield docs_to_index[:batch_size]
+            docs_to_index = docs_to_index[batch_size:]
 
     if docs_to_index:
-        ids.extend(vectorstore.add_documents(docs_to_index))
+        yield docs_to_index
+
+
+# PUBLIC API
+
+
+def delete_chunks(
+    vectorstore: VectorStore, ids: List[str], *, mirrors: Sequence[VectorStore] = ()
+) -> None:
+    """Delete chunks from the vectorstore and its mirrors, logging failures.
+
+    Used for the chunks of failed ingestions, which no document records.
+    """
+    if not ids:
+        return
+    for store in (*mirrors, vectorstore):
+        try:
+            store.delete(ids=ids)
+        except Exception:
+            logger.exception("Failed to delete the chunks of a failed ingestion")
+
+
+def ingest_blob(
+    blob: Blob,
+    parser: BaseBlobParser,
+    text_splitter: TextSplitter,
+    vectorstore: VectorStore,
+    namespace: str,
+    *,
+    batch_size: int = 100,
+    embedding_concurrency: int = 1,
+    max_pending_batches: Optional[int] = None,
+    max_retries: int = 3,
+    mirrors: Sequence[VectorStore] = (),
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> List[str]:
+    """Ingest a document into the vectorstore.
+
+    Parsing and splitting run on the calling thread, embedding runs on up to
+    `embedding_concurrency` threads and writing runs on a single writer
+    thread, so the stages overlap. At most `max_pending_batches` batches
+    (default: twice the embedding concurrency) are in flight at once.
+
+    Vectorstores that do not expose separate embeddings and `add_embeddings`
+    are written with `add_documents`, which embeds and writes in one step.
+
+    Each chunk is also written to the `mirrors`, embedded with their own
+    embeddings and with the same id, before it is written to the vectorstore.
+    This keeps the collection a namespace is being re-embedded into up to
+    date, see `app.reindex`.
+
+    If given, `on_progress` is called with the number of chunks written so
+    far each time a batch has been written.
+
+    If ingestion fails, the chunks it wrote are deleted before it raises.
+    """
+    embeddings = vectorstore.embeddings
+    split_stages = embeddings is not None and hasattr(vectorstore, "add_embeddings")
+    if mirrors and not split_stages:
+        raise ValueError("Mirrors require a vectorstore with add_embeddings")
+    max_pending_batches = max_pending_batches or 2 * embedding_concurrency
+
+    ids: List[str] = []
+    # Ids of the chunks of every batch submitted, written or not.
+    submitted: List[str] = []
+    # Futures of the batches in flight, oldest first; the last one of each
+    # entry resolves to the ids of the written batch.
+    pending: Deque[Tuple[Future, ...]] = deque()
+
+    def collect_written_batch() -> None:
+        ids.extend(pending.popleft()[-1].result())
+        if on_progress is not None:
+            on_progress(len(ids))
+
+    try:
+        with ThreadPoolExecutor(
+            max_workers=embedding_concurrency, thread_name_prefix="ingest-embed"
+        ) as embed_pool, ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="ingest-write"
+        ) as write_pool:
+            try:
+                for batch in _iter_batches(
+                    blob, parser, text_splitter, namespace, batch_size
+                ):
+                    batch_ids = [str(uuid4()) for _ in batch]
+                    submitted.extend(batch_ids)
+                    if split_stages:
+                        texts = [doc.page_content for doc in batch]
+                        futures: List[Future] = []
+                        # The writer runs in submission order, so the mirrors are
+                        # written before the vectorstore.
+                        for mirror in mirrors:
+                            mirror_embedded = embed_pool.submit(
+                                _embed_texts,
+                                mirror.embeddings,
+                                texts,
+                                max_retries=max_retries,
+                            )
+                            futures.append(mirror_embedded)
+                            futures.append(
+                                write_pool.submit(
+                                    _write_mirrored_batch,
+                                    mirror,
+                                    batch,
+                                    mirror_embedded,
+                                    batch_ids,
+                                )
+                            )
+                        embedded = embed_pool.submit(
+                            _embed_texts, embeddings, texts, max_retries=max_retries
+                        )
+                        written = write_pool.submit(
+                            _write_embedded_batch,
+                            vectorstore,
+                            batch,
+                            embedded,
+                            batch_ids,
+                        )
+                        pending.append((*futures, embedded, written))
+                    else:
+                        pending.append(
+                            (
+                                write_pool.submit(
+                                    vectorstore.add_documents, batch, ids=batch_ids
+                                ),
+                            )
+                        )
+
+                    while len(pending) >= max_pending_batches:
+                        collect_written_batch()
+
+                while pending:
+                    collect_written_batch()
+            except BaseException:
+                for futures in pending:
+                    for future in futures:
+                        future.cancel()
+                raise
+    except BaseException:
+        # Leaving the pools waited for the writes that were running, so the
+        # chunks written so far are all known.
+        delete_chunks(vectorstore, submitted, mirrors=mirrors)
+        raise
 
     return ids
@@ -0,0 +1,187 @@
+"""Background ingestion jobs.
+
+Parsing, splitting, embedding and writing documents is blocking work. Instead
+of doing it inside the request handler, `/ingest` enqueues a job that runs on a
+bounded thread pool, and clients poll the job for per-file progress.
+
+Jobs are kept in process memory, so they are only visible to the server
+process that accepted the upload.
+"""
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from typing import Any, Callable, Optional, Sequence
+from uuid import uuid4
+
+import structlog
+from langchain_core.document_loaders.blob_loaders import Blob
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from app.schema import IngestFileProgress, IngestJob, IngestJobStatus
+
+logger = structlog.get_logger(__name__)
+
+INGEST_MAX_WORKERS = int(os.environ.get("INGEST_MAX_WORKERS", "2"))
+"""Maximum number of files ingested concurrently by this process."""
+
+INGEST_MAX_RETAINED_JOBS = int(os.environ.get("INGEST_MAX_RETAINED_JOBS", "1000"))
+"""Maximum number of finished jobs kept around for status lookups."""
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _cleanup_if_cancelled(
+    blobs: Sequence[Blob], cleanup: Callable[[Blob], None], future: Future
+) -> None:
+    # Jobs cancelled by `shutdown` never run, so they do not clean up.
+    if future.cancelled():
+        for blob in blobs:
+            cleanup(blob)
+
+
+class IngestJobManager:
+    """Run ingestion jobs on a bounded worker pool and track their progress."""
+
+    def __init__(self, *, max_workers: int, max_retained_jobs: int) -> None:
+        self._max_workers = max_workers
+        self._max_retained_jobs = max_retained_jobs
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._jobs: OrderedDict[str, IngestJob] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._max_workers, thread_name_prefix="ingest"
+            )
+        return self._executor
+
+    def submit(
+        self,
+        user_id: str,
+        runnable: Runnable[Blob, Sequence[Any]],
+        blobs: Sequence[Blob],
+        config: RunnableConfig,
+        *,
+        cleanup: Optional[Callable[[Blob], None]] = None,
+    ) -> IngestJob:
+        """Enqueue the blobs for ingestion and return the new job.
+
+        The runnable is invoked with an `on_progress` callback, see
+        `IngestRunnable.invoke`, that records the chunks written so far.
+        If given, `cleanup` is called with each blob once it has been processed.
+        """
+        now = _now()
+        job = IngestJob(
+            job_id=str(uuid4()),
+            user_id=user_id,
+            files=[IngestFileProgress(name=str(blob.source)) for blob in blobs],
+            created_at=now,
+            updated_at=now,
+        )
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._prune()
+            snapshot = job.model_copy(deep=True)
+        future = self._get_executor().submit(
+            self._run, job, runnable, blobs, config, cleanup
+        )
+        if cleanup is not None:
+            future.add_done_callback(partial(_cleanup_if_cancelled, blobs, cleanup))
+        return snapshot
+
+    def get(self, user_id: str, job_id: str) -> Optional[IngestJob]:
+        """Get a snapshot of a job owned by the given user."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.user_id != user_id:
+                return None
+            return job.model_copy(deep=True)
+
+    def shutdown(self) -> None:
+        """Stop accepting work and cancel jobs that have not started yet.
+
+        The blobs of the cancelled jobs are cleaned up.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _prune(self) -> None:
+        """Forget the oldest finished jobs once over the retention limit."""
+        finished = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.status in (IngestJobStatus.SUCCEEDED, IngestJobStatus.FAILED)
+        ]
+        for job_id in finished[: max(0, len(self._jobs) - self._max_retained_jobs)]:
+            del self._jobs[job_id]
+
+    def _update(self, job: IngestJob, **kwargs: Any) -> None:
+        with self._lock:
+            for key, value in kwargs.items():
+                setattr(job, key, value)
+            job.updated_at = _now()
+
+    def _update_file(self, job: IngestJob, idx: int, **kwargs: Any) -> None:
+        with self._lock:
+            for key, value in kwargs.items():
+                setattr(job.files[idx], key, value)
+            job.updated_at = _now()
+
+    def _run(
+        self,
+        job: IngestJob,
+        runnable: Runnable[Blob, Sequence[Any]],
+        blobs: Sequence[Blob],
+        config: RunnableConfig,
+        cleanup: Optional[Callable[[Blob], None]],
+    ) -> None:
+        self._update(job, status=IngestJobStatus.RUNNING)
+        failed = False
+        for idx, blob in enumerate(blobs):
+            self._update_file(job, idx, status=IngestJobStatus.RUNNING)
+            try:
+                ids = runnable.invoke(
+                    blob,
+                    config,
+                    on_progress=lambda chunks: self._update_file(
+                        job, idx, chunks=chunks
+                    ),
+                )
+            except Exception:
+                logger.exception(
+                    "Failed to ingest file", job_id=job.job_id, file=str(blob.source)
+                )
+                failed = True
+                # Do not expose the error message to the client since
+                # the message may contain sensitive information.
+                self._update_file(
+                    job,
+                    idx,
+                    status=IngestJobStatus.FAILED,
+                    error="Failed to ingest file.",
+                )
+            else:
+                self._update_file(
+                    job, idx, status=IngestJobStatus.SUCCEEDED, chunks=len(ids)
+                )
+            finally:
+                if cleanup is not None:
+                    cleanup(blob)
+        self._update(
+            job,
+            status=IngestJobStatus.FAILED if failed else IngestJobStatus.SUCCEEDED,
+        )
+
+
+# PUBLIC API
+
+ingest_jobs = IngestJobManager(
+    max_workers=INGEST_MAX_WORKERS, max_retained_jobs=INGEST_MAX_RETAINED_JOBS
+)
@@ -1,5 +1,6 @@
+import asyncio
 import os
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
 
 import asyncpg
 import orjson
@@ -7,6 +8,14 @@ import structlog
 from fastapi import FastAPI
 
 from app.checkpoint import AsyncPostgresCheckpoint
+from app.http_clients import close_http_clients, prewarm_http_clients
+from app.jobs import ingest_jobs
+from app.llm_cache import LLM_CACHE
+from app.parsing import PROCESS_POOL_PARSER
+from app.thread_gc import run_thread_gc
+from app.tool_cache import TOOL_RESULT_CACHE
+from app.tool_executors import shutdown_tool_pools
+from app.ttl_cache import run_cache_pruning
 
 _pg_pool = None
 
@@ -59,6 +68,21 @@ async def lifespan(app: FastAPI):
         init=_init_connection,
     )
     await AsyncPostgresCheckpoint().ensure_setup()
+    background = [
+        asyncio.create_task(run_thread_gc(_pg_pool)),
+        asyncio.create_task(
+            run_cache_pruning(_pg_pool, [LLM_CACHE, TOOL_RESULT_CACHE])
+        ),
+        asyncio.create_task(prewarm_http_clients()),
+    ]
     yield
+    for task in background:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    ingest_jobs.shutdown()
+    PROCESS_POOL_PARSER.shutdown()
+    shutdown_tool_pools()
+    await close_http_clients()
     await _pg_pool.close()
     _pg_pool = None
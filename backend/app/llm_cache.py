@@ -0,0 +1,168 @@
+"""Cache of LLM responses to identical prompts.
+
+The models of OpenGPTs are called with a temperature of 0, so the same prompt
+gets the same response. Assistants that enable the cache answer a prompt they
+were already asked from it, without calling the provider again. This helps
+public assistants that are asked the same questions, and query rewriting.
+
+A prompt is identified by the model and its parameters, including the bound
+tools, and by the content of its messages. Ids and provider metadata are left
+out, so the same question in another thread is a hit. Responses are kept in
+memory and in the `llm_cache` table (migration 11), which is shared by all
+server processes. A hit is streamed to the client as a single chunk.
+"""
+import hashlib
+import os
+import uuid
+from typing import Any, AsyncIterator, Callable, List, Optional
+
+import asyncpg
+import orjson
+from langchain_core.language_models import BaseChatModel
+from langchain_core.load import dumpd, load
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    BaseMessageChunk,
+    message_chunk_to_message,
+)
+from langchain_core.runnables import RunnableConfig
+
+from app.chat_models import DelegatingChatModel
+from app.metrics import METRICS
+from app.ttl_cache import TTLCache
+
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", "86400"))
+"""Seconds a cached LLM response is used for. 0 disables the cache."""
+
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "1000"))
+"""Number of LLM responses kept in memory by each server process."""
+
+HITS = METRICS.counter(
+    "llm_cache_hits_total", "LLM responses served from the cache, per tier."
+)
+MISSES = METRICS.counter(
+    "llm_cache_misses_total", "LLM calls not found in the response cache."
+)
+
+
+def _normalize(message: BaseMessage) -> dict:
+    data = {"type": message.type, "content": message.content}
+    if message.name:
+        data["name"] = message.name
+    if isinstance(message, AIMessage) and message.tool_calls:
+        # Tool call ids are random, and tool results follow their call.
+        data["tool_calls"] = [
+            {"name": call["name"], "args": call["args"]} for call in message.tool_calls
+        ]
+    return data
+
+
+def cache_key(llm_string: str, messages: List[BaseMessage]) -> str:
+    """Return the key of the response of a model to messages."""
+    payload = orjson.dumps(
+        [llm_string, [_normalize(message) for message in messages]],
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.sha256(payload).hexdigest()
+
+
+def _with_fresh_ids(message: AIMessage) -> AIMessage:
+    # A cached response may be used twice in a thread, its tool calls must
+    # not share ids with the previous ones.
+    if not message.tool_calls:
+        return message
+    tool_calls = [
+        {**call, "id": f"call_{uuid.uuid4().hex}"} for call in message.tool_calls
+    ]
+    return message.model_copy(update={"tool_calls": tool_calls})
+
+
+class LLMCache(TTLCache):
+    """Two tier cache of LLM responses: in memory, then in Postgres."""
+
+    table = "llm_cache"
+    value_column = "response"
+
+    def __init__(
+        self,
+        *,
+        ttl: float,
+        max_entries: int,
+        get_pool: Callable[[], Optional[asyncpg.pool.Pool]],
+    ) -> None:
+        super().__init__(max_entries=max_entries, get_pool=get_pool)
+        self.ttl = ttl
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def encode(self, value: Any) -> Any:
+        return dumpd(value)
+
+    def decode(self, value: Any) -> Any:
+        return load(value)
+
+    async def alookup(self, key: str) -> Optional[AIMessage]:
+        """Return the cached response for the key, if any."""
+        tier, message = await self.get(key)
+        if tier is None:
+            MISSES.inc()
+            return None
+        HITS.inc(tier=tier)
+        return message
+
+    async def aupdate(self, key: str, message: AIMessage) -> None:
+        """Cache the response for the key."""
+        await self.set(key, message.model_copy(update={"id": None}), self.ttl)
+
+
+class CachedChatModel(DelegatingChatModel):
+    """Chat model that answers from `response_cache` when it can."""
+
+    response_cache: LLMCache
+
+    async def _acall(
+        self,
+        messages: List[BaseMessage],
+        config: RunnableConfig,
+        *,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[BaseMessageChunk]:
+        key = cache_key(self.inner._get_llm_string(stop=stop, **kwargs), messages)
+        cached = await self.response_cache.alookup(key)
+        if cached is not None:
+            yield _with_fresh_ids(cached)
+            return
+
+        response: Optional[BaseMessageChunk] = None
+        async for chunk in super()._acall(messages, config, stop=stop, **kwargs):
+            response = chunk if response is None else response + chunk
+            yield chunk
+        if response is not None:
+            message = message_chunk_to_message(response)
+            if isinstance(message, AIMessage) and not message.invalid_tool_calls:
+                await self.response_cache.aupdate(key, message)
+
+
+def _get_pg_pool() -> Optional[asyncpg.pool.Pool]:
+    # app.lifespan imports this module.
+    from app.lifespan import get_pg_pool
+
+    return get_pg_pool()
+
+
+# PUBLIC API
+
+LLM_CACHE = LLMCache(
+    ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES, get_pool=_get_pg_pool
+)
+
+
+def with_llm_cache(llm: BaseChatModel, enabled: bool) -> BaseChatModel:
+    """Return the model, answering from the LLM cache if `enabled`."""
+    if not enabled or not LLM_CACHE.enabled:
+        return llm
+    return CachedChatModel(inner=llm, response_cache=LLM_CACHE)
@@ -1,37 +1,50 @@
 import os
 from functools import lru_cache
+from importlib.metadata import version
 from urllib.parse import urlparse
 
 import boto3
-import httpx
 import structlog
+from botocore.config import Config
 from langchain_anthropic import ChatAnthropic
 from langchain_community.chat_models import BedrockChat, ChatFireworks
 from langchain_community.chat_models.ollama import ChatOllama
 from langchain_google_vertexai import ChatVertexAI
 from langchain_openai import AzureChatOpenAI, ChatOpenAI
 
+from app.gateway import with_gateway
+from app.http_clients import get_async_http_client, get_http_client
+from app.prompt_caching import with_prompt_caching
+from app.singleflight import with_single_flight
+
 logger = structlog.get_logger(__name__)
 
 
-@lru_cache(maxsize=4)
+@lru_cache(maxsize=None)
 def get_openai_llm(model: str = "gpt-3.5-turbo", azure: bool = False):
     proxy_url = os.getenv("PROXY_URL")
-    http_client = None
+    proxy = None
     if proxy_url:
         parsed_url = urlparse(proxy_url)
         if parsed_url.scheme and parsed_url.netloc:
-            http_client = httpx.AsyncClient(proxies=proxy_url)
+            proxy = proxy_url
         else:
             logger.warn("Invalid proxy URL provided. Proceeding without proxy.")
+    http_client = get_http_client(proxy)
+    http_async_client = get_async_http_client(proxy)
 
     if not azure:
         try:
             openai_model = model
             llm = ChatOpenAI(
                 http_client=http_client,
+                http_async_client=http_async_client,
                 model=openai_model,
                 temperature=0,
+                # Retries are made by the gateway.
+                max_retries=0,
+                # Report the usage, and cached tokens, when streaming.
+                stream_usage=True,
             )
         except Exception as e:
             logger.error(
@@ -39,7 +52,9 @@ def get_openai_llm(model: str = "gpt-3.5-turbo", azure: bool = False):
             )
             llm = AzureChatOpenAI(
                 http_client=http_client,
+                http_async_client=http_async_client,
                 temperature=0,
+                max_retries=0,
                 deployment_name=os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"],
                 azure_endpoint=os.environ["AZURE_OPENAI_API_BASE"],
                 openai_api_version=os.environ["AZURE_OPENAI_API_VERSION"],
@@ -48,13 +63,40 @@ def get_openai_llm(model: str = "gpt-3.5-turbo", azure: bool = False):
     else:
         llm = AzureChatOpenAI(
             http_client=http_client,
+            http_async_client=http_async_client,
             temperature=0,
+            max_retries=0,
             deployment_name=os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"],
             azure_endpoint=os.environ["AZURE_OPENAI_API_BASE"],
             openai_api_version=os.environ["AZURE_OPENAI_API_VERSION"],
             openai_api_key=os.environ["AZURE_OPENAI_API_KEY"],
         )
-    return llm
+    if isinstance(llm, AzureChatOpenAI):
+        llm = with_gateway(llm, "azure_openai", llm.deployment_name)
+    else:
+        llm = with_gateway(llm, "openai", model)
+    return with_single_flight(llm)
+
+
+# Versions of langchain-anthropic whose private clients are swapped for the
+# shared ones.
+_ANTHROPIC_CLIENT_VERSIONS = ("0.2.",)
+
+
+def _use_shared_http_clients(model: ChatAnthropic) -> None:
+    # ChatAnthropic takes no HTTP client, swap it into its private clients,
+    # which only known versions are checked to use.
+    anthropic_version = version("langchain-anthropic")
+    if not anthropic_version.startswith(_ANTHROPIC_CLIENT_VERSIONS):
+        logger.warning(
+            "Anthropic models do not use the shared HTTP clients",
+            langchain_anthropic=anthropic_version,
+        )
+        return
+    model._client = model._client.with_options(http_client=get_http_client())
+    model._async_client = model._async_client.with_options(
+        http_client=get_async_http_client()
+    )
 
 
 @lru_cache(maxsize=2)
@@ -65,27 +107,42 @@ def get_anthropic_llm(bedrock: bool = False):
             region_name="us-west-2",
             aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
             aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
+            # Retries are made by the gateway.
+            config=Config(retries={"total_max_attempts": 1}),
         )
         model = BedrockChat(model_id="anthropic.claude-v2", client=client)
+        model = with_gateway(model, "bedrock", "anthropic.claude-v2")
     else:
         model = ChatAnthropic(
             model_name="claude-3-haiku-20240307",
             max_tokens_to_sample=2000,
             temperature=0,
+            max_retries=0,
         )
-    return model
+        _use_shared_http_clients(model)
+        model = with_prompt_caching(model)
+        model = with_gateway(model, "anthropic", "claude-3-haiku-20240307")
+    return with_single_flight(model)
 
 
 @lru_cache(maxsize=1)
 def get_google_llm():
-    return ChatVertexAI(
-        model_name="gemini-pro", convert_system_message_to_human=True, streaming=True
+    llm = ChatVertexAI(
+        model_name="gemini-pro",
+        convert_system_message_to_human=True,
+        streaming=True,
+        # Retries are made by the gateway.
+        max_retries=0,
     )
+    return with_single_flight(with_gateway(llm, "google", "gemini-pro"))
 
 
 @lru_cache(maxsize=1)
 def get_mixtral_fireworks():
-    return ChatFireworks(model="accounts/fireworks/models/mixtral-8x7b-instruct")
+    model = "accounts/fireworks/models/mixtral-8x7b-instruct"
+    # Retries are made by the gateway.
+    llm = ChatFireworks(model=model, max_retries=0)
+    return with_single_flight(with_gateway(llm, "fireworks", model))
 
 
 @lru_cache(maxsize=1)
@@ -97,4 +154,6 @@ def get_ollama_llm():
     if not ollama_base_url:
         ollama_base_url = "http://localhost:11434"
 
-    return ChatOllama(model=model_name, base_url=ollama_base_url)
+    # ChatOllama does not retry, retries are made by the gateway.
+    llm = ChatOllama(model=model_name, base_url=ollama_base_url)
+    return with_single_flight(with_gateway(llm, "ollama", model_name))
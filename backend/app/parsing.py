@@ -1,11 +1,28 @@
 """Module contains logic for parsing binary blobs into text."""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Iterator, List, Optional, Sequence
+from weakref import WeakKeyDictionary
+
 from langchain_community.document_loaders.parsers import BS4HTMLParser, PDFMinerParser
 from langchain_community.document_loaders.parsers.generic import MimeTypeBasedParser
 from langchain_community.document_loaders.parsers.msword import MsWordParser
 from langchain_community.document_loaders.parsers.txt import TextParser
+from langchain_core.document_loaders import BaseBlobParser
+from langchain_core.document_loaders.blob_loaders import Blob
+from langchain_core.documents import Document
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
 
 HANDLERS = {
-    "application/pdf": PDFMinerParser(),
+    # One document per page, as when large PDFs are parsed in page ranges.
+    "application/pdf": PDFMinerParser(concatenate_pages=False),
     "text/plain": TextParser(),
     "text/html": BS4HTMLParser(),
     "application/msword": MsWordParser(),
@@ -16,9 +33,189 @@ HANDLERS = {
 
 SUPPORTED_MIMETYPES = sorted(HANDLERS.keys())
 
+# Plain text is cheap to parse, so it is not worth a round trip to a worker.
+_IN_PROCESS_MIMETYPES = {"text/plain"}
+
+PARSER_MAX_WORKERS = int(os.environ.get("PARSER_MAX_WORKERS", "2"))
+"""Number of worker processes used for parsing documents."""
+
+PARSER_CPU_TIME_LIMIT = int(os.environ.get("PARSER_CPU_TIME_LIMIT", "120"))
+"""CPU seconds a single parsing task may use before its worker is killed."""
+
+PARSER_MEMORY_LIMIT = int(os.environ.get("PARSER_MEMORY_LIMIT_MB", "4096")) * 2**20
+"""Address space limit, in bytes, of each parsing worker."""
+
+PARSER_PDF_PAGES_PER_TASK = int(os.environ.get("PARSER_PDF_PAGES_PER_TASK", "25"))
+"""PDFs with more pages than this are parsed in page ranges of this size."""
+
+
+class ParsingError(Exception):
+    """Raised when a document could not be parsed within the resource limits."""
+
+
+def _init_worker(memory_limit: int) -> None:
+    if resource is not None and memory_limit > 0:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+
+
+def _limit_cpu_time(seconds: int) -> None:
+    """Allow the current task `seconds` of CPU time on top of what was used."""
+    if resource is None or seconds <= 0:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = int(usage.ru_utime + usage.ru_stime) + 1
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = used + seconds
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _parse_blob(blob: Blob, cpu_time_limit: int) -> List[Document]:
+    _limit_cpu_time(cpu_time_limit)
+    return list(MIMETYPE_BASED_PARSER.lazy_parse(blob))
+
+
+def _count_pdf_pages(blob: Blob, cpu_time_limit: int) -> int:
+    from pdfminer.pdfpage import PDFPage
+
+    _limit_cpu_time(cpu_time_limit)
+    with blob.as_bytes_io() as pdf_file_obj:
+        return sum(1 for _ in PDFPage.get_pages(pdf_file_obj))
+
+
+def _parse_pdf_pages(
+    blob: Blob, page_numbers: Sequence[int], cpu_time_limit: int
+) -> List[Document]:
+    from pdfminer.high_level import extract_text
+
+    _limit_cpu_time(cpu_time_limit)
+    documents = []
+    with blob.as_bytes_io() as pdf_file_obj:
+        # Same documents as PDFMinerParser(concatenate_pages=False).
+        for page_number in page_numbers:
+            text = extract_text(pdf_file_obj, page_numbers=[page_number])
+            metadata = {"source": blob.source, "page": str(page_number)}
+            documents.append(Document(page_content=text, metadata=metadata))
+    return documents
+
+
+class ProcessPoolParser(BaseBlobParser):
+    """Parse blobs in worker processes with CPU time and memory limits.
+
+    Large PDFs are split into page ranges that are parsed in parallel and
+    yielded in page order as soon as each range is done, so callers can start
+    processing the beginning of a document before the rest is parsed.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_workers: int,
+        cpu_time_limit: int,
+        memory_limit: int,
+        pdf_pages_per_task: int,
+    ) -> None:
+        self.max_workers = max_workers
+        self.cpu_time_limit = cpu_time_limit
+        self.memory_limit = memory_limit
+        self.pdf_pages_per_task = max(1, pdf_pages_per_task)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # The executor each pending task was submitted to.
+        self._executors: "WeakKeyDictionary[Future, ProcessPoolExecutor]" = (
+            WeakKeyDictionary()
+        )
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    # Forking a process with running threads is unsafe.
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.memory_limit,),
+                )
+            return self._executor
+
+    def _submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+        executor = self._get_executor()
+        future = executor.submit(fn, *args, self.cpu_time_limit)
+        with self._lock:
+            self._executors[future] = executor
+        return future
+
+    def _result(self, future: Future, blob: Blob) -> Any:
+        try:
+            return future.result()
+        except BrokenProcessPool as e:
+            # A worker was killed, most likely for exceeding its CPU time
+            # limit. The pool is unusable from here on, so start a new one,
+            # unless another thread already did.
+            with self._lock:
+                broken = self._executors.get(future)
+                if self._executor is not None and self._executor is broken:
+                    self._executor.shutdown(wait=False, cancel_futures=True)
+                    self._executor = None
+            raise ParsingError(
+                f"Parsing {blob.source} was aborted, it may exceed the resource limits"
+            ) from e
+        except MemoryError as e:
+            raise ParsingError(
+                f"Parsing {blob.source} exceeded the memory limit"
+            ) from e
+
+    def lazy_parse(self, blob: Blob) -> Iterator[Document]:
+        """Lazily parse the blob in worker processes."""
+        if blob.mimetype not in HANDLERS:
+            raise ValueError(f"Unsupported mime type: {blob.mimetype}")
+
+        if blob.mimetype in _IN_PROCESS_MIMETYPES:
+            yield from MIMETYPE_BASED_PARSER.lazy_parse(blob)
+            return
+
+        if blob.mimetype == "application/pdf":
+            num_pages = self._result(self._submit(_count_pdf_pages, blob), blob)
+            if num_pages > self.pdf_pages_per_task:
+                step = self.pdf_pages_per_task
+                futures = [
+                    self._submit(
+                        _parse_pdf_pages,
+                        blob,
+                        list(range(start, min(start + step, num_pages))),
+                    )
+                    for start in range(0, num_pages, step)
+                ]
+                try:
+                    for future in futures:
+                        yield from self._result(future, blob)
+                finally:
+                    for future in futures:
+                        future.cancel()
+                return
+
+        yield from self._result(self._submit(_parse_blob, blob), blob)
+
+    def shutdown(self) -> None:
+        """Shut down the worker processes."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
 # PUBLIC API
 
 MIMETYPE_BASED_PARSER = MimeTypeBasedParser(
     handlers=HANDLERS,
     fallback_parser=None,
 )
+
+PROCESS_POOL_PARSER = ProcessPoolParser(
+    max_workers=PARSER_MAX_WORKERS,
+    cpu_time_limit=PARSER_CPU_TIME_LIMIT,
+    memory_limit=PARSER_MEMORY_LIMIT,
+    pdf_pages_per_task=PARSER_PDF_PAGES_PER_TASK,
+)
@@ -0,0 +1,111 @@
+"""Prompt caching of the stable prefix of prompts by LLM providers.
+
+Each call of an assistant starts with the same tool schemas and the same
+instructions, followed by what changes between calls: retrieved documents,
+the summary of the conversation and the conversation itself. Providers that
+cache prompts process such a prefix once and reuse it for a few minutes,
+which lowers the latency of the first token and the cost of the prompt.
+
+OpenAI caches the longest prefix it has seen on its own, so it only needs the
+prefix to be identical from one call to the next. Anthropic caches prompts up
+to the blocks marked with `cache_control`: the agents mark the stable prefix
+of their system message, and `with_prompt_caching` turns the mark into a
+breakpoint, with another one after the tools.
+
+Cached input tokens are reported by providers in the usage of each response,
+and counted by provider and model.
+"""
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage, BaseMessageChunk, SystemMessage
+from langchain_core.messages.ai import UsageMetadata
+from langchain_core.runnables import RunnableConfig
+
+from app.chat_models import DelegatingChatModel
+from app.metrics import METRICS
+
+PROMPT_CACHING = int(os.environ.get("PROMPT_CACHING", "1"))
+"""Whether to mark the stable prefix of prompts for caching. 0 disables."""
+
+CACHED_PREFIX_LENGTH = "cached_prefix_length"
+"""Key of the length of the stable prefix in the additional kwargs of the
+system message."""
+
+_CACHE_CONTROL = {"type": "ephemeral"}
+
+INPUT_TOKENS = METRICS.counter(
+    "llm_input_tokens_total", "Input tokens of LLM calls, per provider and model."
+)
+CACHED_INPUT_TOKENS = METRICS.counter(
+    "llm_cached_input_tokens_total",
+    "Input tokens read from or written to the prompt cache of the provider, "
+    "per provider, model and kind.",
+)
+
+
+def _cached_system_blocks(message: SystemMessage) -> Optional[List[Dict[str, Any]]]:
+    length = message.additional_kwargs.get(CACHED_PREFIX_LENGTH)
+    if not length or not isinstance(message.content, str):
+        return None
+    prefix, rest = message.content[:length], message.content[length:]
+    blocks = [{"type": "text", "text": prefix, "cache_control": _CACHE_CONTROL}]
+    if rest.strip():
+        blocks.append({"type": "text", "text": rest})
+    return blocks
+
+
+class AnthropicPromptCachingChatModel(DelegatingChatModel):
+    """Anthropic chat model that marks the tools and the stable prefix of
+    the system message as cache breakpoints."""
+
+    async def _acall(
+        self,
+        messages: List[BaseMessage],
+        config: RunnableConfig,
+        *,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[BaseMessageChunk]:
+        if messages and isinstance(messages[0], SystemMessage):
+            blocks = _cached_system_blocks(messages[0])
+            if blocks is not None:
+                messages = [SystemMessage(content=blocks)] + messages[1:]
+        if tools := kwargs.get("tools"):
+            # The tools come first in the prompt, they are cached on their own
+            # when the system message has no stable prefix.
+            kwargs["tools"] = tools[:-1] + [
+                {**tools[-1], "cache_control": _CACHE_CONTROL}
+            ]
+        async for chunk in super()._acall(messages, config, stop=stop, **kwargs):
+            yield chunk
+
+
+# PUBLIC API
+
+
+def cached_system_message(prefix: str, rest: str = "") -> SystemMessage:
+    """Return the system message `prefix + rest`, marking `prefix` as stable
+    across the calls of an assistant."""
+    return SystemMessage(
+        content=prefix + rest, additional_kwargs={CACHED_PREFIX_LENGTH: len(prefix)}
+    )
+
+
+def with_prompt_caching(llm: BaseChatModel) -> BaseChatModel:
+    """Return the Anthropic model, caching the stable prefix of its prompts."""
+    if not PROMPT_CACHING:
+        return llm
+    return AnthropicPromptCachingChatModel(inner=llm)
+
+
+def record_usage(provider: str, model: str, usage: Optional[UsageMetadata]) -> None:
+    """Count the input tokens of a response, and those of the prompt cache."""
+    if not usage:
+        return
+    labels = {"provider": provider, "model": model}
+    INPUT_TOKENS.inc(usage.get("input_tokens", 0), **labels)
+    for kind, tokens in (usage.get("input_token_details") or {}).items():
+        if kind in ("cache_read", "cache_creation") and tokens:
+            CACHED_INPUT_TOKENS.inc(tokens, kind=kind, **labels)
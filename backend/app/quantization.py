@@ -0,0 +1,127 @@
+"""Quantized copies of the chunk embeddings.
+
+Migration 7 stores a half precision (halfvec) and a binary (bit) copy of each
+1536-dimension embedding, and indexes them. Searching a quantized copy is
+cheaper, and the top candidates are then rescored with the full precision
+embeddings to recover most of the recall.
+
+Rows written before the migration are quantized by running:
+
+    poetry run python -m app.quantization
+"""
+import argparse
+import os
+from enum import Enum
+
+import sqlalchemy
+import structlog
+from langchain_community.vectorstores.pgvector import PGVector
+from sqlalchemy.engine import Engine
+
+logger = structlog.get_logger(__name__)
+
+QUANTIZED_DIMENSIONS = 1536
+"""Number of dimensions of the quantized columns, see migration 7."""
+
+
+class Quantization(str, Enum):
+    """Which copy of the embeddings is searched for candidates."""
+
+    NONE = "none"
+    """Search the full precision embeddings, no rescoring."""
+    HALFVEC = "halfvec"
+    """Search the half precision embeddings, by cosine distance."""
+    BINARY = "binary"
+    """Search the binary embeddings, by hamming distance."""
+
+
+EMBEDDING_QUANTIZATION = Quantization(
+    os.environ.get("EMBEDDING_QUANTIZATION", Quantization.NONE.value)
+)
+"""Copy of the embeddings searched for candidates by the retriever."""
+
+EMBEDDING_RESCORE_FACTOR = int(os.environ.get("EMBEDDING_RESCORE_FACTOR", "4"))
+"""Candidates rescored with the full embeddings, per candidate returned."""
+
+# Distance of the quantized copy of each row to the query `:embedding`.
+CANDIDATE_DISTANCE = {
+    Quantization.HALFVEC: (
+        f"embedding_half <=> CAST(:embedding AS halfvec({QUANTIZED_DIMENSIONS}))"
+    ),
+    Quantization.BINARY: (
+        "embedding_bit <~> CAST(binary_quantize(CAST(:embedding AS vector)) "
+        f"AS bit({QUANTIZED_DIMENSIONS}))"
+    ),
+}
+
+_BACKFILL_SQL = f"""
+WITH batch AS (
+    SELECT uuid
+    FROM langchain_pg_embedding
+    WHERE uuid > CAST(:after AS uuid)
+    ORDER BY uuid
+    LIMIT :batch_size
+),
+updated AS (
+    UPDATE langchain_pg_embedding e
+    SET
+        embedding_half = CAST(e.embedding AS halfvec({QUANTIZED_DIMENSIONS})),
+        embedding_bit = CAST(binary_quantize(e.embedding) AS bit({QUANTIZED_DIMENSIONS}))
+    FROM batch
+    WHERE e.uuid = batch.uuid
+    AND e.embedding_half IS NULL
+    AND e.embedding IS NOT NULL
+    AND vector_dims(e.embedding) = {QUANTIZED_DIMENSIONS}
+    RETURNING e.uuid
+)
+SELECT
+    CAST((SELECT uuid FROM batch ORDER BY uuid DESC LIMIT 1) AS text),
+    (SELECT count(*) FROM updated)
+"""
+
+
+def backfill_quantized_embeddings(bind: Engine, batch_size: int = 1000) -> int:
+    """Quantize the embeddings written before migration 7.
+
+    Rows are updated in batches of `batch_size`, each in its own transaction,
+    so the backfill can run while the server is up. Returns the number of
+    rows updated.
+    """
+    after = "00000000-0000-0000-0000-000000000000"
+    total = 0
+    while True:
+        with bind.begin() as conn:
+            last, updated = conn.execute(
+                sqlalchemy.text(_BACKFILL_SQL),
+                {"after": after, "batch_size": batch_size},
+            ).one()
+        total += updated
+        if last is None:
+            return total
+        logger.info("Quantized embeddings", rows=total)
+        after = last
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Quantize the embeddings written before migration 7."
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    engine = sqlalchemy.create_engine(
+        PGVector.connection_string_from_db_params(
+            driver="psycopg2",
+            host=os.environ["POSTGRES_HOST"],
+            port=int(os.environ["POSTGRES_PORT"]),
+            database=os.environ["POSTGRES_DB"],
+            user=os.environ["POSTGRES_USER"],
+            password=os.environ["POSTGRES_PASSWORD"],
+        )
+    )
+    total = backfill_quantized_embeddings(engine, batch_size=args.batch_size)
+    logger.info("Done quantizing embeddings", rows=total)
+
+
+if __name__ == "__main__":
+    main()
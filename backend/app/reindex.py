@@ -0,0 +1,508 @@
+"""Re-embed the chunks of a namespace with another embedding model.
+
+Embeddings of different models can not be compared, so each embedding model
+has its own collection, and the `namespace_embedding` table records the
+collection searched for each namespace (migration 8). Namespaces without a
+row use the default collection.
+
+A reindex job copies the chunks of a namespace to the collection of the new
+model in throttled batches, embedding their text again. While it runs, new
+chunks of the namespace are written to both collections. Once every chunk is
+copied, the namespace is switched to the new collection in one transaction.
+The chunks in the previous collection are kept until pruned, so that server
+processes that have not seen the switch yet can still search them: jobs run
+outside of the servers, which keep their cached routes for up to
+EMBEDDING_ROUTE_TTL seconds.
+
+    poetry run python -m app.reindex --model text-embedding-3-small
+    poetry run python -m app.reindex --status
+"""
+import argparse
+import os
+import threading
+import time
+from enum import Enum
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import sqlalchemy
+import structlog
+from langchain_community.vectorstores.pgvector import PGVector
+from sqlalchemy.engine import Engine
+
+
+logger = structlog.get_logger(__name__)
+
+EMBEDDING_ROUTE_TTL = int(os.environ.get("EMBEDDING_ROUTE_TTL", "30"))
+"""Seconds for which the collection of a namespace is cached for retrieval.
+
+After a namespace is switched to a new collection, other server processes
+keep searching the previous one for up to this long.
+"""
+
+REINDEX_MAX_CHUNKS_PER_MINUTE = int(
+    os.environ.get("REINDEX_MAX_CHUNKS_PER_MINUTE", "3000")
+)
+"""Maximum number of chunks re-embedded per minute by a reindex job."""
+
+# Routes cached beyond this are dropped once expired.
+_MAX_CACHED_ROUTES = 10000
+
+_ROUTES_SQL = """
+SELECT namespace, collection_name, model
+FROM namespace_embedding
+WHERE namespace = ANY(:namespaces)
+"""
+
+_MIRRORS_SQL = """
+SELECT target_collection, model
+FROM reindex_job
+WHERE namespace = :namespace AND status = 'running'
+"""
+
+_COLLECTION_ID = """(
+    SELECT uuid FROM langchain_pg_collection WHERE name = :{}
+)"""
+
+# Rows written before custom ids were always set are identified by uuid.
+_CHUNK_ID = "coalesce(s.custom_id, CAST(s.uuid AS text))"
+
+_COUNT_SQL = f"""
+SELECT count(*)
+FROM langchain_pg_embedding s
+WHERE s.collection_id = {_COLLECTION_ID.format("source_collection")}
+AND s.cmetadata->>'namespace' = :namespace
+"""
+
+_BATCH_SQL = f"""
+SELECT CAST(s.uuid AS text), s.document, s.cmetadata, {_CHUNK_ID}
+FROM langchain_pg_embedding s
+WHERE s.collection_id = {_COLLECTION_ID.format("source_collection")}
+AND s.cmetadata->>'namespace' = :namespace
+AND s.uuid > CAST(:after AS uuid)
+AND NOT EXISTS (
+    SELECT 1 FROM langchain_pg_embedding t
+    WHERE t.collection_id = {_COLLECTION_ID.format("target_collection")}
+    AND t.custom_id = {_CHUNK_ID}
+)
+ORDER BY s.uuid
+LIMIT :batch_size
+"""
+
+_PRUNE_SQL = f"""
+DELETE FROM langchain_pg_embedding
+WHERE collection_id = {_COLLECTION_ID.format("collection_name")}
+AND cmetadata->>'namespace' = :namespace
+"""
+
+_CREATE_JOB_SQL = """
+INSERT INTO reindex_job (
+    namespace, source_collection, target_collection, model, status, total_chunks
+)
+VALUES (
+    :namespace, :source_collection, :target_collection, :model, 'running', :total
+)
+RETURNING CAST(job_id AS text)
+"""
+
+_UPDATE_JOB_SQL = """
+UPDATE reindex_job
+SET
+    status = :status,
+    done_chunks = :done,
+    total_chunks = greatest(total_chunks, :done),
+    error = :error,
+    updated_at = CURRENT_TIMESTAMP AT TIME ZONE 'UTC'
+WHERE job_id = CAST(:job_id AS uuid)
+"""
+
+_SWITCH_SQL = """
+INSERT INTO namespace_embedding (namespace, collection_name, model, updated_at)
+VALUES (:namespace, :target_collection, :model, CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+ON CONFLICT (namespace) DO UPDATE SET
+    collection_name = EXCLUDED.collection_name,
+    model = EXCLUDED.model,
+    updated_at = EXCLUDED.updated_at
+"""
+
+_STATUS_SQL = """
+SELECT
+    CAST(job_id AS text), namespace, source_collection, target_collection,
+    status, done_chunks, total_chunks, error, updated_at
+FROM reindex_job
+ORDER BY created_at DESC
+LIMIT :limit
+"""
+
+_NAMESPACES_SQL = """
+SELECT DISTINCT cmetadata->>'namespace'
+FROM langchain_pg_embedding
+WHERE cmetadata->>'namespace' IS NOT NULL
+"""
+
+Route = Optional[Tuple[str, str]]
+"""(collection name, model) of a namespace, None for the default collection."""
+
+
+class ReindexStatus(str, Enum):
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class ReindexAlreadyRunningError(ValueError):
+    """Raised when a namespace is already being reindexed."""
+
+
+class EmbeddingRouter:
+    """Resolve the collection, and so the embedding model, of each namespace."""
+
+    def __init__(
+        self,
+        default: PGVector,
+        get_vectorstore: Callable[[str, str], PGVector],
+        *,
+        ttl: float,
+    ) -> None:
+        self.default = default
+        self.get_vectorstore = get_vectorstore
+        self.ttl = ttl
+        self._routes: Dict[str, Tuple[float, Route]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def bind(self) -> Engine:
+        return self.default._bind
+
+    def _vectorstore(self, route: Route) -> PGVector:
+        return self.default if route is None else self.get_vectorstore(*route)
+
+    def _fetch_routes(self, namespaces: Sequence[str]) -> Dict[str, Route]:
+        with self.bind.connect() as conn:
+            rows = conn.execute(
+                sqlalchemy.text(_ROUTES_SQL), {"namespaces": list(namespaces)}
+            ).fetchall()
+        routes: Dict[str, Route] = {namespace: None for namespace in namespaces}
+        for namespace, collection_name, model in rows:
+            if collection_name != self.default.collection_name:
+                routes[namespace] = (collection_name, model)
+        return routes
+
+    def search_targets(
+        self, namespaces: Sequence[str]
+    ) -> List[Tuple[PGVector, List[str]]]:
+        """Group the namespaces by the vectorstore their chunks are searched in."""
+        namespaces = list(dict.fromkeys(namespaces))
+        now = time.monotonic()
+        routes: Dict[str, Route] = {}
+        with self._lock:
+            for namespace in namespaces:
+                entry = self._routes.get(namespace)
+                if entry is not None and now - entry[0] < self.ttl:
+                    routes[namespace] = entry[1]
+        missing = [namespace for namespace in namespaces if namespace not in routes]
+        if missing:
+            fetched = self._fetch_routes(missing)
+            with self._lock:
+                if len(self._routes) > _MAX_CACHED_ROUTES:
+                    self._routes = {
+                        key: entry
+                        for key, entry in self._routes.items()
+                        if now - entry[0] < self.ttl
+                    }
+                for namespace, route in fetched.items():
+                    self._routes[namespace] = (now, route)
+            routes.update(fetched)
+
+        groups: Dict[Route, List[str]] = {}
+        for namespace in namespaces:
+            groups.setdefault(routes[namespace], []).append(namespace)
+        return [(self._vectorstore(route), group) for route, group in groups.items()]
+
+    def ingest_targets(self, namespace: str) -> Tuple[PGVector, List[PGVector]]:
+        """Return the vectorstore new chunks of a namespace are written to, and
+        the vectorstores of the reindex jobs running for it.
+
+        This is not cached, so that no chunk is missed by a job that just
+        started.
+        """
+        route = self._fetch_routes([namespace])[namespace]
+        with self.bind.connect() as conn:
+            mirrors = conn.execute(
+                sqlalchemy.text(_MIRRORS_SQL), {"namespace": namespace}
+            ).fetchall()
+        return self._vectorstore(route), [
+            self.get_vectorstore(collection_name, model)
+            for collection_name, model in mirrors
+        ]
+
+    def collection_name(self, namespace: str) -> str:
+        """Return the name of the collection a namespace is searched in."""
+        route = self._fetch_routes([namespace])[namespace]
+        return self.default.collection_name if route is None else route[0]
+
+    def invalidate(self, namespace: str) -> None:
+        with self._lock:
+            self._routes.pop(namespace, None)
+
+
+def _update_job(
+    bind: Engine,
+    job_id: str,
+    status: ReindexStatus,
+    done: int,
+    error: Optional[str] = None,
+) -> None:
+    with bind.begin() as conn:
+        conn.execute(
+            sqlalchemy.text(_UPDATE_JOB_SQL),
+            {"job_id": job_id, "status": status.value, "done": done, "error": error},
+        )
+
+
+def _copy_pass(
+    bind: Engine,
+    target: PGVector,
+    params: dict,
+    *,
+    batch_size: int,
+    max_chunks_per_minute: int,
+    on_batch: Callable[[int], None],
+) -> int:
+    """Copy the chunks missing from the target collection once over.
+
+    Returns the number of chunks copied.
+    """
+    after = "00000000-0000-0000-0000-000000000000"
+    copied = 0
+    start = time.monotonic()
+    while True:
+        with bind.connect() as conn:
+            rows = conn.execute(
+                sqlalchemy.text(_BATCH_SQL),
+                {**params, "after": after, "batch_size": batch_size},
+            ).fetchall()
+        if not rows:
+            return copied
+        after = rows[-1][0]
+        target.add_embeddings(
+            texts=[row[1] for row in rows],
+            embeddings=target.embeddings.embed_documents([row[1] for row in rows]),
+            metadatas=[row[2] or {} for row in rows],
+            ids=[row[3] for row in rows],
+        )
+        copied += len(rows)
+        on_batch(len(rows))
+        # Sleep off any time ahead of the allowed rate.
+        ahead = copied * 60 / max_chunks_per_minute - (time.monotonic() - start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+# PUBLIC API
+
+
+def reindex_namespace(
+    router: EmbeddingRouter,
+    namespace: str,
+    model: str,
+    target_collection: str,
+    *,
+    batch_size: int = 100,
+    max_chunks_per_minute: int = REINDEX_MAX_CHUNKS_PER_MINUTE,
+) -> str:
+    """Re-embed the chunks of a namespace into the target collection, and
+    switch the namespace to it.
+
+    Chunks already in the target collection are skipped, so a failed job can
+    be resumed by running it again. Returns the id of the job.
+    """
+    bind = router.bind
+    source_collection = router.collection_name(namespace)
+    if source_collection == target_collection:
+        raise ValueError(f"Namespace {namespace} already uses {target_collection}")
+    # Creates the target collection if needed.
+    target = router.get_vectorstore(target_collection, model)
+    params = {
+        "namespace": namespace,
+        "source_collection": source_collection,
+        "target_collection": target_collection,
+        "model": model,
+    }
+    try:
+        with bind.begin() as conn:
+            total = conn.execute(sqlalchemy.text(_COUNT_SQL), params).scalar()
+            job_id = conn.execute(
+                sqlalchemy.text(_CREATE_JOB_SQL), {**params, "total": total}
+            ).scalar()
+    except sqlalchemy.exc.IntegrityError as e:
+        raise ReindexAlreadyRunningError(
+            f"Namespace {namespace} is already being reindexed"
+        ) from e
+
+    done = 0
+
+    def on_batch(copied: int) -> None:
+        nonlocal done
+        done += copied
+        _update_job(bind, job_id, ReindexStatus.RUNNING, done)
+        logger.info(
+            "Reindexing namespace",
+            namespace=namespace,
+            job_id=job_id,
+            done=done,
+            total=total,
+        )
+
+    def copy_pass() -> int:
+        return _copy_pass(
+            bind,
+            target,
+            params,
+            batch_size=batch_size,
+            max_chunks_per_minute=max_chunks_per_minute,
+            on_batch=on_batch,
+        )
+
+    try:
+        # Chunks of ingestions that started before the job are not mirrored,
+        # and may be committed behind the keyset of a pass, so passes are
+        # repeated until one finds nothing left to copy.
+        while copy_pass():
+            pass
+        with bind.begin() as conn:
+            conn.execute(sqlalchemy.text(_SWITCH_SQL), params)
+            conn.execute(
+                sqlalchemy.text(_UPDATE_JOB_SQL),
+                {
+                    "job_id": job_id,
+                    "status": ReindexStatus.DONE.value,
+                    "done": done,
+                    "error": None,
+                },
+            )
+        # Only the routes of this process, the other processes switch once
+        # their routes expire (EMBEDDING_ROUTE_TTL). Their cached vectors are
+        # per collection, so none of them are stale.
+        router.invalidate(namespace)
+        # Catch ingestions that were still writing only to the source.
+        copy_pass()
+        _update_job(bind, job_id, ReindexStatus.DONE, done)
+    except BaseException as e:
+        _update_job(bind, job_id, ReindexStatus.FAILED, done, error=repr(e))
+        raise
+    logger.info("Reindexed namespace", namespace=namespace, job_id=job_id, done=done)
+    return job_id
+
+
+def prune_namespace(bind: Engine, namespace: str, collection_name: str) -> int:
+    """Delete the chunks of a namespace from a collection it was switched away
+    from. Returns the number of chunks deleted."""
+    with bind.begin() as conn:
+        return conn.execute(
+            sqlalchemy.text(_PRUNE_SQL),
+            {"namespace": namespace, "collection_name": collection_name},
+        ).rowcount
+
+
+def reindex_status(bind: Engine, limit: int = 50) -> List[dict]:
+    """Return the most recent reindex jobs, newest first."""
+    with bind.connect() as conn:
+        rows = conn.execute(sqlalchemy.text(_STATUS_SQL), {"limit": limit}).fetchall()
+    return [
+        {
+            "job_id": job_id,
+            "namespace": namespace,
+            "source_collection": source_collection,
+            "target_collection": target_collection,
+            "status": status,
+            "done_chunks": done,
+            "total_chunks": total,
+            "error": error,
+            "updated_at": updated_at,
+        }
+        for (
+            job_id,
+            namespace,
+            source_collection,
+            target_collection,
+            status,
+            done,
+            total,
+            error,
+            updated_at,
+        ) in rows
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Re-embed namespaces with another embedding model."
+    )
+    parser.add_argument("--model", help="Embedding model to re-embed with.")
+    parser.add_argument(
+        "--namespace",
+        action="append",
+        help="Assistant or thread id to reindex, all namespaces if not given.",
+    )
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument(
+        "--max-chunks-per-minute", type=int, default=REINDEX_MAX_CHUNKS_PER_MINUTE
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="Delete the chunks from the previous collection once switched.",
+    )
+    parser.add_argument(
+        "--status", action="store_true", help="Show the recent reindex jobs."
+    )
+    args = parser.parse_args()
+
+    # Imported here, app.upload imports this module.
+    from app.upload import EMBEDDING_ROUTER, collection_for_model
+
+    router = EMBEDDING_ROUTER
+    if args.status:
+        for job in reindex_status(router.bind):
+            print(
+                f"{job['job_id']} {job['namespace']} {job['status']} "
+                f"{job['done_chunks']}/{job['total_chunks']} "
+                f"{job['source_collection']} -> {job['target_collection']}"
+                + (f" {job['error']}" if job["error"] else "")
+            )
+        return
+    if not args.model:
+        parser.error("--model is required")
+
+    target_collection = collection_for_model(args.model)
+    namespaces = args.namespace
+    if not namespaces:
+        with router.bind.connect() as conn:
+            namespaces = [
+                row[0] for row in conn.execute(sqlalchemy.text(_NAMESPACES_SQL))
+            ]
+    switched = []
+    for namespace in namespaces:
+        source_collection = router.collection_name(namespace)
+        if source_collection == target_collection:
+            continue
+        reindex_namespace(
+            router,
+            namespace,
+            args.model,
+            target_collection,
+            batch_size=args.batch_size,
+            max_chunks_per_minute=args.max_chunks_per_minute,
+        )
+        switched.append((namespace, source_collection))
+
+    if args.prune and switched:
+        logger.info("Waiting for all servers to switch", seconds=router.ttl)
+        time.sleep(router.ttl)
+        for namespace, source_collection in switched:
+            deleted = prune_namespace(router.bind, namespace, source_collection)
+            logger.info("Pruned namespace", namespace=namespace, rows=deleted)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,30 @@
+import asyncio
 import operator
-from typing import Annotated, List, Sequence, TypedDict
+import os
+import re
+from enum import Enum
+from typing import Annotated, List, Optional, Sequence, TypedDict
 from uuid import uuid4
 
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
 from langchain_core.language_models.base import LanguageModelLike
-from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    ToolMessage,
+)
 from langchain_core.prompts import PromptTemplate
 from langchain_core.retrievers import BaseRetriever
-from langchain_core.runnables import chain
+from langchain_core.runnables import RunnableConfig, chain
+from langchain_core.runnables.config import merge_configs
 from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import END
 from langgraph.graph.state import StateGraph
 
 from app.message_types import LiberalToolMessage, add_messages_liberal
+from app.prompt_caching import cached_system_message
 
 search_prompt = PromptTemplate.from_template(
     """Given the conversation below, come up with a search query to look up.
@@ -35,12 +48,107 @@ Respond to the user using ONLY the context provided below. Do not make anything
 {context}"""
 
 
+QUERY_REWRITE_TIMEOUT = float(os.environ.get("QUERY_REWRITE_TIMEOUT", "1.0"))
+"""Default seconds a speculative search waits for the rewrite of the query."""
+
+
+class QueryRewrite(str, Enum):
+    """How the search query for a follow-up message is obtained."""
+
+    ALWAYS = "always"
+    """Always ask the LLM to rewrite the conversation into a search query."""
+    HEURISTIC = "heuristic"
+    """Search for the message as is if it looks self-contained."""
+    SPECULATIVE = "speculative"
+    """Search for the message while the rewrite runs, and keep those results
+    if the rewrite is slow or does not change the query.
+
+    When the rewrite changes the query, the rewritten query can only be
+    searched for once the rewrite arrives, which takes as long as ALWAYS."""
+
+
+# Words that usually refer back to earlier turns of the conversation.
+_REFERENTIAL_WORDS = frozenset(
+    {
+        "it",
+        "its",
+        "this",
+        "that",
+        "these",
+        "those",
+        "they",
+        "them",
+        "their",
+        "he",
+        "him",
+        "his",
+        "she",
+        "her",
+        "there",
+        "above",
+        "previous",
+        "earlier",
+        "former",
+        "latter",
+        "same",
+        "else",
+        "again",
+    }
+)
+_FOLLOW_UP_PREFIXES = ("and ", "also ", "what about", "how about")
+_MIN_SELF_CONTAINED_WORDS = 4
+
+
+def _is_self_contained(question: str) -> bool:
+    """Guess whether a question can be searched for without the conversation."""
+    normalized = question.strip().lower()
+    if normalized.startswith(_FOLLOW_UP_PREFIXES):
+        return False
+    words = re.findall(r"[a-z0-9']+", normalized)
+    if len(words) < _MIN_SELF_CONTAINED_WORDS:
+        return False
+    return not _REFERENTIAL_WORDS.intersection(words)
+
+
+def _normalize_query(query: str) -> str:
+    return " ".join(re.findall(r"\w+", query.lower()))
+
+
+class _RetrievedDocuments(BaseRetriever):
+    """Retriever that returns documents retrieved earlier."""
+
+    documents: List[Document]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self.documents
+
+
 def get_retrieval_executor(
     llm: LanguageModelLike,
     retriever: BaseRetriever,
     system_message: str,
     checkpoint: BaseCheckpointSaver,
+    *,
+    query_rewrite: QueryRewrite = QueryRewrite.ALWAYS,
+    rewrite_llm: Optional[LanguageModelLike] = None,
+    rewrite_timeout: float = QUERY_REWRITE_TIMEOUT,
 ):
+    """Build the chat_retrieval graph.
+
+    Args:
+        llm: The model that answers the user.
+        retriever: The retriever used to look up context.
+        system_message: The instructions of the assistant.
+        checkpoint: The checkpointer of the graph.
+        query_rewrite: How follow-up messages are turned into search queries.
+        rewrite_llm: The model used to rewrite search queries, if not `llm`.
+        rewrite_timeout: Seconds to wait for the rewrite before falling back
+            to the speculative results, with `QueryRewrite.SPECULATIVE`.
+    """
+    rewrite_llm = rewrite_llm or llm
+
     class AgentState(TypedDict):
         messages: Annotated[List[BaseMessage], add_messages_liberal]
         msg_count: Annotated[int, operator.add]
@@ -55,13 +163,11 @@ def get_retrieval_executor(
                 chat_history.append(m)
         response = messages[-1].content
         content = "\n".join([d["page_content"] for d in response])
-        return [
-            SystemMessage(
-                content=response_prompt_template.format(
-                    instructions=system_message, context=content
-                )
-            )
-        ] + chat_history
+        # The documents change on each turn, the instructions before them don't.
+        instructions = response_prompt_template.format(
+            instructions=system_message, context=""
+        )
+        return [cached_system_message(instructions, content)] + chat_history
 
     @chain
     async def get_search_query(messages: Sequence[BaseMessage]):
@@ -74,59 +180,102 @@ def get_retrieval_executor(
                 convo.append(f"Human: {m.content}")
         conversation = "\n".join(convo)
         prompt = await search_prompt.ainvoke({"conversation": conversation})
-        response = await llm.ainvoke(prompt, {"tags": ["nostream"]})
+        response = await rewrite_llm.ainvoke(prompt, {"tags": ["nostream"]})
         return response
 
-    async def invoke_retrieval(state: AgentState):
+    def _retrieval_call(query: str, id: Optional[str] = None) -> AIMessage:
+        return AIMessage(
+            id=id,
+            content="",
+            tool_calls=[
+                {
+                    "id": uuid4().hex,
+                    "name": "retrieval",
+                    "args": {"query": query},
+                }
+            ],
+        )
+
+    async def _retrieve(query: str, config: RunnableConfig) -> list:
+        response = await retriever.ainvoke(query, config)
+        return [doc.model_dump() for doc in response]
+
+    async def _speculative_retrieval(
+        messages: Sequence[BaseMessage], config: RunnableConfig
+    ):
+        human_input = messages[-1].content
+        # The client is only told about the search whose results are used.
+        speculative = asyncio.ensure_future(
+            retriever.ainvoke(
+                human_input, merge_configs(config, {"tags": ["nostream"]})
+            )
+        )
+        try:
+            try:
+                search_query = await asyncio.wait_for(
+                    get_search_query.ainvoke(messages), rewrite_timeout
+                )
+            except asyncio.TimeoutError:
+                call = _retrieval_call(human_input)
+                search_query = None
+            else:
+                call = _retrieval_call(search_query.content, search_query.id)
+            if search_query is None or _normalize_query(
+                search_query.content
+            ) == _normalize_query(human_input):
+                documents = await speculative
+                # Report the kept results as a search for the query.
+                documents = await _RetrievedDocuments(documents=documents).ainvoke(
+                    call.tool_calls[0]["args"]["query"], config
+                )
+                response = [doc.model_dump() for doc in documents]
+            else:
+                speculative.cancel()
+                response = await _retrieve(search_query.content, config)
+        finally:
+            speculative.cancel()
+        msg = LiberalToolMessage(
+            name="retrieval",
+            content=response,
+            tool_call_id=call.tool_calls[0]["id"],
+        )
+        return {"messages": [call, msg], "msg_count": 1}
+
+    async def invoke_retrieval(state: AgentState, config: RunnableConfig):
         messages = state["messages"]
         if len(messages) == 1:
-            human_input = messages[-1].content
-            return {
-                "messages": [
-                    AIMessage(
-                        content="",
-                        tool_calls=[
-                            {
-                                "id": uuid4().hex,
-                                "name": "retrieval",
-                                "args": {"query": human_input},
-                            }
-                        ],
-                    )
-                ]
-            }
+            return {"messages": [_retrieval_call(messages[-1].content)]}
+        elif query_rewrite == QueryRewrite.SPECULATIVE:
+            return await _speculative_retrieval(messages, config)
+        elif query_rewrite == QueryRewrite.HEURISTIC and _is_self_contained(
+            messages[-1].content
+        ):
+            return {"messages": [_retrieval_call(messages[-1].content)]}
         else:
             search_query = await get_search_query.ainvoke(messages)
             return {
-                "messages": [
-                    AIMessage(
-                        id=search_query.id,
-                        content="",
-                        tool_calls=[
-                            {
-                                "id": uuid4().hex,
-                                "name": "retrieval",
-                                "args": {"query": search_query.content},
-                            }
-                        ],
-                    )
-                ]
+                "messages": [_retrieval_call(search_query.content, search_query.id)]
             }
 
-    async def retrieve(state: AgentState):
+    def should_retrieve(state: AgentState):
+        # Speculative retrieval may already have returned the documents.
+        if isinstance(state["messages"][-1], ToolMessage):
+            return "response"
+        return "retrieve"
+
+    async def retrieve(state: AgentState, config: RunnableConfig):
         messages = state["messages"]
         params = messages[-1].tool_calls[0]
-        query = params["args"]["query"]
-        response = await retriever.ainvoke(query)
-        response = [doc.model_dump() for doc in response]
+        response = await _retrieve(params["args"]["query"], config)
         msg = LiberalToolMessage(
             name="retrieval", content=response, tool_call_id=params["id"]
         )
         return {"messages": [msg], "msg_count": 1}
 
-    def call_model(state: AgentState):
+    async def call_model(state: AgentState, config: RunnableConfig):
         messages = state["messages"]
-        response = llm.invoke(_get_messages(messages))
+        # Pass the node config through so tokens are streamed to astream_events.
+        response = await llm.ainvoke(_get_messages(messages), config)
         return {"messages": [response], "msg_count": 1}
 
     workflow = StateGraph(AgentState)
@@ -134,7 +283,11 @@ def get_retrieval_executor(
     workflow.add_node("retrieve", retrieve)
     workflow.add_node("response", call_model)
     workflow.set_entry_point("invoke_retrieval")
-    workflow.add_edge("invoke_retrieval", "retrieve")
+    workflow.add_conditional_edges(
+        "invoke_retrieval",
+        should_retrieve,
+        {"retrieve": "retrieve", "response": "response"},
+    )
     workflow.add_edge("retrieve", "response")
     workflow.add_edge("response", END)
     app = workflow.compile(checkpointer=checkpoint)
@@ -1,5 +1,6 @@
 from datetime import datetime
-from typing import Optional
+from enum import Enum
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -40,3 +41,53 @@ class Thread(BaseModel):
     updated_at: datetime
     """The last time the thread was updated."""
     metadata: Optional[dict] = None
+
+
+class IngestJobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+class IngestFileProgress(BaseModel):
+    name: str
+    """The name of the uploaded file."""
+    status: IngestJobStatus = IngestJobStatus.QUEUED
+    """The ingestion status of the file."""
+    chunks: int = 0
+    """The number of chunks indexed for the file so far."""
+    error: Optional[str] = None
+    """A client-safe error message if the file failed to ingest."""
+
+
+class IngestJob(BaseModel):
+    job_id: str
+    """The ID of the ingestion job."""
+    user_id: str
+    """The ID of the user that submitted the job."""
+    status: IngestJobStatus = IngestJobStatus.QUEUED
+    """The overall status of the job."""
+    files: List[IngestFileProgress]
+    """Per-file progress, in upload order."""
+    created_at: datetime
+    """The time the job was submitted."""
+    updated_at: datetime
+    """The last time the job made progress."""
+
+
+class Document(BaseModel):
+    document_id: str
+    """The ID of the document."""
+    namespace: str
+    """The ID of the assistant or thread the document was uploaded to."""
+    source: str
+    """The name of the uploaded file."""
+    content_hash: str
+    """The SHA-256 of the content of the file."""
+    chunks: int
+    """The number of chunks indexed for the file."""
+    created_at: datetime
+    """The time the file was first uploaded."""
+    updated_at: datetime
+    """The last time the file was replaced."""
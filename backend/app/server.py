@@ -4,18 +4,30 @@ from pathlib import Path
 import orjson
 import structlog
 from fastapi import FastAPI, Form, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.exceptions import HTTPException
+from fastapi.responses import PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 
 import app.storage as storage
 from app.api import router as api_router
 from app.auth.handlers import AuthedUser
+from app.jobs import ingest_jobs
 from app.lifespan import lifespan
-from app.upload import convert_ingestion_input_to_blob, ingest_runnable
+from app.metrics import METRICS
+from app.schema import IngestJob
+from app.upload import (
+    FileTooLargeError,
+    UploadSizeLimitMiddleware,
+    convert_ingestion_input_to_blob,
+    ingest_runnable,
+    release_blob,
+)
 
 logger = structlog.get_logger(__name__)
 
 app = FastAPI(title="OpenGPTs API", lifespan=lifespan)
+app.add_middleware(UploadSizeLimitMiddleware)
 
 
 # Get root of app, used to point to directory containing static files
@@ -28,8 +40,8 @@ app.include_router(api_router)
 @app.post("/ingest", description="Upload files to the given assistant.")
 async def ingest_files(
     files: list[UploadFile], user: AuthedUser, config: str = Form(...)
-) -> None:
-    """Ingest a list of files."""
+) -> IngestJob:
+    """Enqueue a job that ingests a list of files."""
     config = orjson.loads(config)
 
     assistant_id = config["configurable"].get("assistant_id")
@@ -44,8 +56,34 @@ async def ingest_files(
         if thread is None:
             raise HTTPException(status_code=404, detail="Thread not found.")
 
-    file_blobs = [convert_ingestion_input_to_blob(file) for file in files]
-    return ingest_runnable.batch(file_blobs, config)
+    file_blobs = []
+    try:
+        for file in files:
+            # Spooling to disk is blocking I/O, keep it off the event loop.
+            file_blobs.append(
+                await run_in_threadpool(convert_ingestion_input_to_blob, file)
+            )
+    except FileTooLargeError as e:
+        for blob in file_blobs:
+            release_blob(blob)
+        raise HTTPException(status_code=413, detail=str(e))
+    except BaseException:
+        for blob in file_blobs:
+            release_blob(blob)
+        raise
+
+    return ingest_jobs.submit(
+        user.user_id, ingest_runnable, file_blobs, config, cleanup=release_blob
+    )
+
+
+@app.get("/ingest/{job_id}", description="Get the status of an ingestion job.")
+async def get_ingest_job(job_id: str, user: AuthedUser) -> IngestJob:
+    """Get the status and per-file progress of an ingestion job."""
+    job = ingest_jobs.get(user.user_id, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Ingestion job not found.")
+    return job
 
 
 @app.get("/health")
@@ -53,6 +91,12 @@ async def health() -> dict:
     return {"status": "ok"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> str:
+    """Metrics of this server process, in the Prometheus text format."""
+    return METRICS.render()
+
+
 ui_dir = str(ROOT / "ui")
 
 if os.path.exists(ui_dir):
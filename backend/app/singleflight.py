@@ -0,0 +1,210 @@
+"""Share one call between concurrent identical requests.
+
+When a public assistant is shared, many users ask it the same thing at once,
+and each of its runs would send the same prompt to the LLM and the same
+queries to the tools. Calls with the same key made while one is in flight
+wait for it instead, and get its result, or its chunks as they are produced.
+
+The shared call keeps running as long as any caller waits for it, and is
+cancelled when all of them are.
+"""
+import asyncio
+import os
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    TypeVar,
+)
+
+import orjson
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage, BaseMessageChunk
+from langchain_core.runnables import RunnableConfig
+from langgraph.prebuilt import ToolExecutor, ToolInvocation
+
+from app.chat_models import DelegatingChatModel
+from app.llm_cache import cache_key
+from app.metrics import METRICS
+from app.tool_cache import RunResults
+from app.tool_executors import run_tool
+
+T = TypeVar("T")
+
+SINGLE_FLIGHT = int(os.environ.get("SINGLE_FLIGHT", "1"))
+"""Whether identical concurrent LLM and tool calls share one call. 0 disables."""
+
+CALLS = METRICS.counter(
+    "singleflight_calls_total", "Calls made on behalf of concurrent requests."
+)
+FOLLOWERS = METRICS.counter(
+    "singleflight_followers_total",
+    "Requests that waited for an identical call in flight instead of making one.",
+)
+
+
+class _Flight:
+    """A call in flight, and the chunks it produced so far."""
+
+    def __init__(self) -> None:
+        self.chunks: List[Any] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+        self.task: Optional[asyncio.Task] = None
+        self._updated = asyncio.Event()
+
+    def _notify(self) -> None:
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def run(self, chunks: AsyncIterator[Any]) -> None:
+        try:
+            async for chunk in chunks:
+                self.chunks.append(chunk)
+                self._notify()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self._notify()
+
+    async def follow(self) -> AsyncIterator[Any]:
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.finished:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._updated.wait()
+
+
+class SingleFlight:
+    """Calls in flight, by key."""
+
+    def __init__(self, name: str, *, enabled: bool = True) -> None:
+        self.name = name
+        self.enabled = enabled
+        self._flights: Dict[str, _Flight] = {}
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def stream(
+        self, key: str, call: Callable[[], AsyncIterator[T]]
+    ) -> AsyncIterator[T]:
+        """Yield the chunks of `call()`, or of the identical call in flight."""
+        if not self.enabled:
+            async for chunk in call():
+                yield chunk
+            return
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.create_task(flight.run(call()))
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            CALLS.inc(group=self.name)
+        else:
+            FOLLOWERS.inc(group=self.name)
+
+        flight.waiters += 1
+        try:
+            async for chunk in flight.follow():
+                yield chunk
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.finished:
+                # Nobody waits for the call anymore, and later requests must
+                # not join it once cancelled.
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    async def do(self, key: str, call: Callable[[], Awaitable[T]]) -> T:
+        """Return the result of `call()`, or of the identical call in flight."""
+
+        async def once() -> AsyncIterator[T]:
+            yield await call()
+
+        results = self.stream(key, once)
+        try:
+            return await results.__anext__()
+        finally:
+            await results.aclose()
+
+
+class SingleFlightChatModel(DelegatingChatModel):
+    """Chat model that shares its calls with identical concurrent ones."""
+
+    flights: SingleFlight
+
+    async def _acall(
+        self,
+        messages: List[BaseMessage],
+        config: RunnableConfig,
+        *,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[BaseMessageChunk]:
+        key = cache_key(self.inner._get_llm_string(stop=stop, **kwargs), messages)
+        parent = super()._acall
+        async for chunk in self.flights.stream(
+            key, lambda: parent(messages, config, stop=stop, **kwargs)
+        ):
+            yield chunk
+
+
+def tool_call_key(tool: Any, args: Any) -> str:
+    """Return the key of a call of a tool.
+
+    Tools are keyed by identity: the tools of OpenGPTs are created once and
+    shared by the assistants that have the same configuration, while tools
+    configured with private credentials are not.
+    """
+    return f"{id(tool)}:{orjson.dumps(args, option=orjson.OPT_SORT_KEYS).decode()}"
+
+
+# PUBLIC API
+
+LLM_CALLS = SingleFlight("llm", enabled=bool(SINGLE_FLIGHT))
+
+TOOL_CALLS = SingleFlight("tool", enabled=bool(SINGLE_FLIGHT))
+
+
+def with_single_flight(llm: BaseChatModel) -> BaseChatModel:
+    """Return the model, sharing its calls with identical concurrent ones."""
+    if not LLM_CALLS.enabled:
+        return llm
+    return SingleFlightChatModel(inner=llm, flights=LLM_CALLS)
+
+
+async def invoke_tool(
+    tool_executor: ToolExecutor,
+    action: ToolInvocation,
+    run_results: Optional[RunResults] = None,
+) -> Any:
+    """Run a tool call with the workers of the tool, sharing it with identical
+    concurrent ones.
+
+    Calls of cached tools made earlier in the run, per `run_results`, are not
+    made again.
+    """
+    tool = tool_executor.tool_map.get(action.tool)
+    if tool is None:
+        return await tool_executor.ainvoke(action)
+    if run_results is not None:
+        found, result = run_results.get(tool, action.tool_input)
+        if found:
+            return result
+    return await TOOL_CALLS.do(
+        tool_call_key(tool, action.tool_input),
+        lambda: run_tool(tool, action.tool_input),
+    )
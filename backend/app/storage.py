@@ -6,7 +6,8 @@ from langchain_core.runnables import RunnableConfig
 
 from app.agent import agent
 from app.lifespan import get_pg_pool
-from app.schema import Assistant, Thread, User
+from app.schema import Assistant, Document, Thread, User
+from app.vector_cache import VECTOR_CACHE
 
 
 async def list_assistants(user_id: str) -> List[Assistant]:
@@ -83,20 +84,39 @@ async def put_assistant(
     )
 
 
+async def _delete_namespace_vectors(conn, namespace: str) -> None:
+    """Delete the chunks and documents uploaded to an assistant or thread."""
+    await conn.execute(
+        "DELETE FROM langchain_pg_embedding WHERE cmetadata->>'namespace' = $1",
+        namespace,
+    )
+    await conn.execute("DELETE FROM document WHERE namespace = $1", namespace)
+    await conn.execute(
+        "DELETE FROM namespace_embedding WHERE namespace = $1", namespace
+    )
+
+
 async def delete_assistant(user_id: str, assistant_id: str) -> None:
-    """Delete an assistant by ID."""
+    """Delete an assistant by ID, with the files uploaded to it."""
     async with get_pg_pool().acquire() as conn:
-        await conn.execute(
-            "DELETE FROM assistant WHERE assistant_id = $1 AND user_id = $2",
-            assistant_id,
-            user_id,
-        )
+        async with conn.transaction():
+            deleted = await conn.fetchval(
+                "DELETE FROM assistant WHERE assistant_id = $1 AND user_id = $2 "
+                "RETURNING assistant_id",
+                assistant_id,
+                user_id,
+            )
+            if deleted is not None:
+                await _delete_namespace_vectors(conn, assistant_id)
+    VECTOR_CACHE.invalidate(assistant_id)
 
 
 async def list_threads(user_id: str) -> List[Thread]:
     """List all threads for the current user."""
     async with get_pg_pool().acquire() as conn:
-        records = await conn.fetch("SELECT * FROM thread WHERE user_id = $1", user_id)
+        records = await conn.fetch(
+            "SELECT * FROM thread WHERE user_id = $1 AND deleted_at IS NULL", user_id
+        )
         return [Thread(**record) for record in records]
 
 
@@ -104,7 +124,8 @@ async def get_thread(user_id: str, thread_id: str) -> Optional[Thread]:
     """Get a thread by ID."""
     async with get_pg_pool().acquire() as conn:
         record = await conn.fetchrow(
-            "SELECT * FROM thread WHERE thread_id = $1 AND user_id = $2",
+            "SELECT * FROM thread WHERE thread_id = $1 AND user_id = $2 "
+            "AND deleted_at IS NULL",
             thread_id,
             user_id,
         )
@@ -212,15 +233,15 @@ def get_assistant_type(config: dict) -> str:
 
 async def put_thread(
     user_id: str, thread_id: str, *, assistant_id: str, name: str
-) -> Thread:
-    """Modify a thread."""
+) -> Optional[Thread]:
+    """Modify a thread. Returns None if the thread was deleted."""
     updated_at = datetime.now(timezone.utc)
     assistant = await get_assistant(user_id, assistant_id)
     metadata = (
         {"assistant_type": get_assistant_type(assistant.config)} if assistant else None
     )
     async with get_pg_pool().acquire() as conn:
-        await conn.execute(
+        written = await conn.fetchval(
             (
                 "INSERT INTO thread (thread_id, user_id, assistant_id, name, updated_at, metadata) VALUES ($1, $2, $3, $4, $5, $6) "
                 "ON CONFLICT (thread_id) DO UPDATE SET "
@@ -228,7 +249,10 @@ async def put_thread(
                 "assistant_id = EXCLUDED.assistant_id, "
                 "name = EXCLUDED.name, "
                 "updated_at = EXCLUDED.updated_at, "
-                "metadata = EXCLUDED.metadata;"
+                "metadata = EXCLUDED.metadata "
+                # Deleted threads are being removed, don't bring them back.
+                "WHERE thread.deleted_at IS NULL "
+                "RETURNING thread_id;"
             ),
             thread_id,
             user_id,
@@ -237,6 +261,8 @@ async def put_thread(
             updated_at,
             metadata,
         )
+        if written is None:
+            return None
         return Thread(
             thread_id=thread_id,
             user_id=user_id,
@@ -248,13 +274,81 @@ async def put_thread(
 
 
 async def delete_thread(user_id: str, thread_id: str):
-    """Delete a thread by ID."""
+    """Delete a thread by ID.
+
+    The thread is only marked deleted. Its checkpoints and the files uploaded
+    to it are removed in the background by `app.thread_gc`.
+    """
     async with get_pg_pool().acquire() as conn:
         await conn.execute(
-            "DELETE FROM thread WHERE thread_id = $1 AND user_id = $2",
+            "UPDATE thread SET deleted_at = $3 "
+            "WHERE thread_id = $1 AND user_id = $2 AND deleted_at IS NULL",
             thread_id,
             user_id,
+            datetime.now(timezone.utc),
+        )
+    VECTOR_CACHE.invalidate(thread_id)
+
+
+async def owns_namespace(user_id: str, namespace: str) -> bool:
+    """Whether the namespace is an assistant or a thread of the user."""
+    async with get_pg_pool().acquire() as conn:
+        return await conn.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM assistant WHERE assistant_id::text = $1 "
+            "AND user_id = $2) OR EXISTS (SELECT 1 FROM thread "
+            "WHERE thread_id::text = $1 AND user_id = $2 AND deleted_at IS NULL)",
+            namespace,
+            user_id,
+        )
+
+
+_DOCUMENT_COLUMNS = (
+    "document_id, namespace, source, content_hash, "
+    "cardinality(chunk_ids) AS chunks, created_at, updated_at"
+)
+
+
+async def list_documents(namespace: str) -> List[Document]:
+    """List the files uploaded to an assistant or thread."""
+    async with get_pg_pool().acquire() as conn:
+        records = await conn.fetch(
+            f"SELECT {_DOCUMENT_COLUMNS} FROM document WHERE namespace = $1 "
+            "ORDER BY source",
+            namespace,
+        )
+        return [Document(**record) for record in records]
+
+
+async def get_document(document_id: str) -> Optional[Document]:
+    """Get an uploaded file by ID."""
+    async with get_pg_pool().acquire() as conn:
+        record = await conn.fetchrow(
+            f"SELECT {_DOCUMENT_COLUMNS} FROM document WHERE document_id = $1",
+            document_id,
         )
+        if record is None:
+            return None
+        return Document(**record)
+
+
+async def delete_document(document_id: str) -> None:
+    """Delete an uploaded file and its chunks."""
+    async with get_pg_pool().acquire() as conn:
+        async with conn.transaction():
+            record = await conn.fetchrow(
+                "DELETE FROM document WHERE document_id = $1 "
+                "RETURNING namespace, chunk_ids",
+                document_id,
+            )
+            if record is None:
+                return
+            await conn.execute(
+                "DELETE FROM langchain_pg_embedding "
+                "WHERE cmetadata->>'namespace' = $1 AND custom_id = ANY($2)",
+                record["namespace"],
+                record["chunk_ids"],
+            )
+    VECTOR_CACHE.invalidate(record["namespace"])
 
 
 async def get_or_create_user(sub: str) -> tuple[User, bool]:
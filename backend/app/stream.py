@@ -1,14 +1,40 @@
 import functools
-from typing import Any, AsyncIterator, Dict, Optional, Sequence, Union
+from typing import Any, AsyncIterator, Dict, NamedTuple, Optional, Sequence, Union
 
 import orjson
 import structlog
+from langchain_core.documents import Document
 from langchain_core.messages import AnyMessage, BaseMessage, message_chunk_to_message
 from langchain_core.runnables import Runnable, RunnableConfig
 
+from app.tool_executors import TOOL_CALL_RUN_NAME
+
 logger = structlog.get_logger(__name__)
 
-MessagesStream = AsyncIterator[Union[list[AnyMessage], str]]
+
+class StreamEvent(NamedTuple):
+    """An event of the run other than messages, sent as is to the client."""
+
+    event: str
+    data: Dict[str, Any]
+
+
+MessagesStream = AsyncIterator[Union[list[AnyMessage], str, StreamEvent]]
+
+# Number of characters of each retrieved document sent ahead of the answer.
+_SNIPPET_LENGTH = 200
+
+
+def _document_ref(doc: Document) -> Dict[str, Any]:
+    """Compact reference to a retrieved document, for rendering sources."""
+    metadata = doc.metadata or {}
+    score = metadata.get("score", metadata.get("relevance_score"))
+    return {
+        "source": metadata.get("source"),
+        "title": metadata.get("title"),
+        "score": score,
+        "snippet": doc.page_content[:_SNIPPET_LENGTH],
+    }
 
 
 async def astream_state(
@@ -16,7 +42,15 @@ async def astream_state(
     input: Union[Sequence[AnyMessage], Dict[str, Any]],
     config: RunnableConfig,
 ) -> MessagesStream:
-    """Stream messages from the runnable."""
+    """Stream messages from the runnable.
+
+    Yields the run id first, then lists of new or updated messages. When a
+    retriever finishes, a "retrieval" event with references to the retrieved
+    documents is yielded right away, before the model starts answering. Each tool call of
+    an agent yields a "tool_start" event when it starts, then its message and
+    a "tool_end" event with its duration as soon as it finishes, before the
+    other calls made at the same time.
+    """
     root_run_id: Optional[str] = None
     messages: dict[str, BaseMessage] = {}
 
@@ -52,6 +86,42 @@ async def astream_state(
             else:
                 messages[message.id] += message
             yield [messages[message.id]]
+        elif event["event"] == "on_chain_start" and event["name"] == TOOL_CALL_RUN_NAME:
+            yield StreamEvent(
+                "tool_start",
+                {
+                    "run_id": event["run_id"],
+                    "tool": event["metadata"].get("tool"),
+                    "tool_call_id": event["metadata"].get("tool_call_id"),
+                },
+            )
+        elif event["event"] == "on_chain_end" and event["name"] == TOOL_CALL_RUN_NAME:
+            message = event["data"].get("output")
+            if isinstance(message, BaseMessage):
+                messages[message.id] = message
+                yield [message]
+            yield StreamEvent(
+                "tool_end",
+                {
+                    "run_id": event["run_id"],
+                    "tool": event["metadata"].get("tool"),
+                    "tool_call_id": event["metadata"].get("tool_call_id"),
+                    "duration": message.response_metadata.get("duration")
+                    if isinstance(message, BaseMessage)
+                    else None,
+                },
+            )
+        elif event["event"] == "on_retriever_end":
+            output = event["data"].get("output") or {}
+            documents = output.get("documents", [])
+            yield StreamEvent(
+                "retrieval",
+                {
+                    "run_id": event["run_id"],
+                    "query": event["data"].get("input", {}).get("query"),
+                    "documents": [_document_ref(doc) for doc in documents],
+                },
+            )
 
 
 def _default(obj) -> Any:
@@ -75,6 +145,8 @@ async def to_sse(messages_stream: MessagesStream) -> AsyncIterator[dict]:
                     "event": "metadata",
                     "data": orjson.dumps({"run_id": chunk}).decode(),
                 }
+            elif isinstance(chunk, StreamEvent):
+                yield {"event": chunk.event, "data": dumps(chunk.data).decode()}
             else:
                 yield {
                     "event": "data",
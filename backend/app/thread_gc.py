@@ -0,0 +1,154 @@
+"""Background removal of the data of deleted threads.
+
+Deleting a thread only marks it deleted (migration 10), which hides it right
+away. The checkpoints and uploaded chunks of deleted threads are removed by
+this task in batches of bounded size, each in its own short transaction, so
+that deleting a long thread never holds locks for long. The thread row is
+removed last.
+
+Every server process runs the task. Concurrent runs delete disjoint or
+already deleted rows, which is harmless.
+"""
+import asyncio
+import os
+import time
+from typing import List
+
+import asyncpg
+import structlog
+
+from app.metrics import METRICS
+
+logger = structlog.get_logger(__name__)
+
+THREAD_GC_INTERVAL = float(os.environ.get("THREAD_GC_INTERVAL", "60"))
+"""Seconds between runs of the garbage collection of deleted threads."""
+
+THREAD_GC_BATCH_SIZE = int(os.environ.get("THREAD_GC_BATCH_SIZE", "1000"))
+"""Maximum number of rows deleted per transaction."""
+
+THREAD_GC_MAX_THREADS = int(os.environ.get("THREAD_GC_MAX_THREADS", "100"))
+"""Maximum number of deleted threads collected per run."""
+
+# Tables holding data of a thread, and the expression matching its id.
+# Checkpoint writes and blobs are deleted before the checkpoints that refer
+# to them.
+_THREAD_TABLES = (
+    ("checkpoint_writes", "thread_id"),
+    ("checkpoint_blobs", "thread_id"),
+    ("checkpoints", "thread_id"),
+    ("langchain_pg_embedding", "cmetadata->>'namespace'"),
+    ("document", "namespace"),
+    ("namespace_embedding", "namespace"),
+)
+
+_DELETE_BATCH_SQL = {
+    table: f"""
+DELETE FROM {table}
+WHERE ctid = ANY(ARRAY(
+    SELECT ctid FROM {table} WHERE {column} = $1 LIMIT $2
+))
+"""
+    for table, column in _THREAD_TABLES
+}
+
+_DELETED_THREADS_SQL = """
+SELECT thread_id::text
+FROM thread
+WHERE deleted_at IS NOT NULL
+ORDER BY deleted_at
+LIMIT $1
+"""
+
+_BACKLOG_SQL = "SELECT count(*) FROM thread WHERE deleted_at IS NOT NULL"
+
+_DELETE_THREAD_SQL = (
+    "DELETE FROM thread WHERE thread_id = $1 AND deleted_at IS NOT NULL"
+)
+
+DELETED_ROWS = METRICS.counter(
+    "thread_gc_deleted_rows_total", "Rows of deleted threads removed, per table."
+)
+COLLECTED_THREADS = METRICS.counter(
+    "thread_gc_collected_threads_total", "Deleted threads fully removed."
+)
+GC_SECONDS = METRICS.counter(
+    "thread_gc_seconds_total", "Time spent removing the data of deleted threads."
+)
+BACKLOG = METRICS.gauge(
+    "thread_gc_backlog_threads", "Deleted threads whose data is not removed yet."
+)
+
+
+def _rowcount(status: str) -> int:
+    # asyncpg returns the command tag, e.g. "DELETE 42".
+    return int(status.rsplit(" ", 1)[-1])
+
+
+async def collect_thread(
+    pool: asyncpg.pool.Pool, thread_id: str, batch_size: int
+) -> int:
+    """Remove the data of a deleted thread, then the thread. Returns the
+    number of rows removed."""
+    total = 0
+    for table, _ in _THREAD_TABLES:
+        while True:
+            async with pool.acquire() as conn:
+                deleted = _rowcount(
+                    await conn.execute(_DELETE_BATCH_SQL[table], thread_id, batch_size)
+                )
+            if deleted:
+                DELETED_ROWS.inc(deleted, table=table)
+                total += deleted
+            if deleted < batch_size:
+                break
+    async with pool.acquire() as conn:
+        await conn.execute(_DELETE_THREAD_SQL, thread_id)
+    COLLECTED_THREADS.inc()
+    return total
+
+
+async def collect_garbage(
+    pool: asyncpg.pool.Pool, *, batch_size: int, max_threads: int
+) -> List[str]:
+    """Remove the data of up to `max_threads` deleted threads, oldest first.
+
+    Returns the ids of the threads removed.
+    """
+    start = time.perf_counter()
+    async with pool.acquire() as conn:
+        thread_ids = [
+            row[0] for row in await conn.fetch(_DELETED_THREADS_SQL, max_threads)
+        ]
+    try:
+        for thread_id in thread_ids:
+            rows = await collect_thread(pool, thread_id, batch_size)
+            logger.info("Removed deleted thread", thread_id=thread_id, rows=rows)
+    finally:
+        GC_SECONDS.inc(time.perf_counter() - start)
+        async with pool.acquire() as conn:
+            BACKLOG.set(await conn.fetchval(_BACKLOG_SQL))
+    return thread_ids
+
+
+async def run_thread_gc(
+    pool: asyncpg.pool.Pool,
+    *,
+    interval: float = THREAD_GC_INTERVAL,
+    batch_size: int = THREAD_GC_BATCH_SIZE,
+    max_threads: int = THREAD_GC_MAX_THREADS,
+) -> None:
+    """Collect deleted threads every `interval` seconds, until cancelled."""
+    while True:
+        try:
+            collected = await collect_garbage(
+                pool, batch_size=batch_size, max_threads=max_threads
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Failed to remove deleted threads")
+            collected = []
+        # Keep going right away while there is a backlog.
+        if len(collected) < max_threads:
+            await asyncio.sleep(interval)
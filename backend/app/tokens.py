@@ -0,0 +1,38 @@
+"""Token counting shared by the code that fits text into prompts."""
+from functools import lru_cache
+from typing import Optional
+
+import structlog
+import tiktoken
+
+logger = structlog.get_logger(__name__)
+
+# Used to estimate token counts when the tokenizer cannot be loaded.
+_CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=16)
+def _get_encoding(model: Optional[str] = None) -> Optional[tiktoken.Encoding]:
+    try:
+        if model is not None:
+            try:
+                return tiktoken.encoding_for_model(model)
+            except KeyError:
+                # Not an OpenAI model.
+                pass
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # The encoding is downloaded on first use, which fails offline.
+        logger.warning("Could not load the tokenizer, estimating token counts")
+        return None
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """Count the tokens of a text, as seen by the given OpenAI model.
+
+    Other providers tokenize differently, so this is an estimate for them.
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return -(-len(text) // _CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
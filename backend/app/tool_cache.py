@@ -0,0 +1,215 @@
+"""Cache of the results of search tools.
+
+The search tools of OpenGPTs are asked the same queries again and again,
+across threads and users. Their factories in app/tools.py declare how long a
+result stays fresh with `cached_results`, and calls of those tools with the
+same arguments are answered from the cache for that long, without calling
+the provider again. Results are kept in memory and, unless disabled, in the
+`tool_cache` table (migration 12), which is shared by all server processes.
+
+Within a run, an agent that calls a cached tool again with the same arguments
+gets the result of the earlier call, see `RunResults`.
+
+Some tools return their errors as results. Those results, and the timeouts
+of app.tool_executors, are neither cached nor reused: the factories declare
+what the errors of their tools look like with `cached_results`.
+
+The TTL of a tool can be set with the name of the tool, e.g.
+TOOL_CACHE_TTL_WIKIPEDIA, 0 disables the cache of that tool.
+"""
+import hashlib
+import os
+import re
+from functools import wraps
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+import asyncpg
+import orjson
+from langchain_core.tools import BaseTool
+
+from app.metrics import METRICS
+from app.ttl_cache import TTLCache
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+TOOL_CACHE = int(os.environ.get("TOOL_CACHE", "1"))
+"""Whether to cache the results of the tools that declare a TTL. 0 disables."""
+
+TOOL_CACHE_MAX_ENTRIES = int(os.environ.get("TOOL_CACHE_MAX_ENTRIES", "1000"))
+"""Number of tool results kept in memory by each server process."""
+
+TOOL_CACHE_POSTGRES = int(os.environ.get("TOOL_CACHE_POSTGRES", "1"))
+"""Whether to share the cached tool results through Postgres. 0 disables."""
+
+RESULT_TTL = "result_ttl"
+"""Key of the TTL of the results of a tool in its metadata."""
+
+RESULT_ERROR_PATTERN = "result_error_pattern"
+"""Key of the pattern of the errors returned by a tool in its metadata."""
+
+ERROR_PREFIX = "Error: "
+"""Start of the error messages returned to the model instead of a result."""
+
+_WHITESPACE = re.compile(r"\s+")
+
+HITS = METRICS.counter(
+    "tool_cache_hits_total", "Tool calls answered from the cache, per tool and tier."
+)
+MISSES = METRICS.counter(
+    "tool_cache_misses_total", "Calls of cached tools not found in the cache."
+)
+
+
+def _normalize(value: Any) -> Any:
+    # Queries that only differ in spacing get the same results.
+    if isinstance(value, str):
+        return _WHITESPACE.sub(" ", value).strip()
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def tool_result_key(name: str, tool_input: Any) -> str:
+    """Return the key of the result of a call of a tool."""
+    payload = orjson.dumps(
+        [name, _normalize(tool_input)],
+        option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS,
+        default=str,
+    )
+    return hashlib.sha256(payload).hexdigest()
+
+
+def result_ttl(tool: BaseTool) -> float:
+    """Return the seconds the results of the tool are cached for, 0 if never."""
+    declared = (tool.metadata or {}).get(RESULT_TTL)
+    if declared is None:
+        return 0.0
+    suffix = re.sub(r"\W", "_", tool.name).upper()
+    return float(os.environ.get(f"TOOL_CACHE_TTL_{suffix}", declared))
+
+
+def is_error_result(tool: BaseTool, result: Any) -> bool:
+    """Return whether a result of the tool is an error message."""
+    if not isinstance(result, str):
+        return False
+    if result.startswith(ERROR_PREFIX):
+        return True
+    pattern = (tool.metadata or {}).get(RESULT_ERROR_PATTERN)
+    return pattern is not None and re.match(pattern, result) is not None
+
+
+class ToolResultCache(TTLCache):
+    """Two tier cache of tool results: in memory, then in Postgres."""
+
+    table = "tool_cache"
+    value_column = "result"
+
+    def __init__(
+        self,
+        *,
+        enabled: bool,
+        max_entries: int,
+        get_pool: Callable[[], Optional[asyncpg.pool.Pool]],
+    ) -> None:
+        super().__init__(max_entries=max_entries, get_pool=get_pool)
+        self.enabled = enabled
+
+    def encode(self, value: Any) -> Any:
+        orjson.dumps(value)
+        return value
+
+    async def lookup(self, key: str, name: str) -> Tuple[bool, Any]:
+        """Return whether the result of the call is cached, and the result."""
+        tier, result = await self.get(key)
+        if tier is None:
+            MISSES.inc(tool=name)
+            return False, None
+        HITS.inc(tool=name, tier=tier)
+        return True, result
+
+    async def update(self, key: str, name: str, result: Any, ttl: float) -> None:
+        """Cache the result of the call for `ttl` seconds."""
+        await self.set(key, result, ttl, tool=name)
+
+    async def get_or_call(
+        self, tool: BaseTool, tool_input: Any, call: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """Return the cached result of the call, or the result of `call()`.
+
+        Failed calls, which raise or return an error message, are not cached.
+        """
+        ttl = result_ttl(tool)
+        if not self.enabled or ttl <= 0:
+            return await call()
+        key = tool_result_key(tool.name, tool_input)
+        found, result = await self.lookup(key, tool.name)
+        if found:
+            return result
+        result = await call()
+        if not is_error_result(tool, result):
+            await self.update(key, tool.name, result, ttl)
+        return result
+
+
+class RunResults:
+    """Results of the calls of cached tools made earlier in the current run."""
+
+    def __init__(self) -> None:
+        self._results: Dict[str, Any] = {}
+
+    def add(self, name: str, tool_input: Any, result: Any) -> None:
+        self._results[tool_result_key(name, tool_input)] = result
+
+    def get(self, tool: Optional[BaseTool], tool_input: Any) -> Tuple[bool, Any]:
+        """Return whether the tool was called with the same input in this run,
+        and the result of that call. Calls that failed are made again."""
+        if tool is None or (tool.metadata or {}).get(RESULT_TTL) is None:
+            return False, None
+        key = tool_result_key(tool.name, tool_input)
+        if key not in self._results or is_error_result(tool, self._results[key]):
+            return False, None
+        HITS.inc(tool=tool.name, tier="run")
+        return True, self._results[key]
+
+
+def _get_pg_pool() -> Optional[asyncpg.pool.Pool]:
+    if not TOOL_CACHE_POSTGRES:
+        return None
+    # app.lifespan imports this module.
+    from app.lifespan import get_pg_pool
+
+    return get_pg_pool()
+
+
+# PUBLIC API
+
+TOOL_RESULT_CACHE = ToolResultCache(
+    enabled=bool(TOOL_CACHE), max_entries=TOOL_CACHE_MAX_ENTRIES, get_pool=_get_pg_pool
+)
+
+
+def cached_results(
+    ttl: float, *, error_pattern: Optional[str] = None
+) -> Callable[[F], F]:
+    """Declare that the results of the tools returned by the decorated
+    factory stay fresh for `ttl` seconds.
+
+    Results matching `error_pattern`, a regular expression matched at the
+    start of string results, are errors returned by the tools.
+    """
+
+    def decorator(factory: F) -> F:
+        @wraps(factory)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            tool = factory(*args, **kwargs)
+            metadata = {**(tool.metadata or {}), RESULT_TTL: ttl}
+            if error_pattern is not None:
+                metadata[RESULT_ERROR_PATTERN] = error_pattern
+            tool.metadata = metadata
+            return tool
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
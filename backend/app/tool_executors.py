@@ -0,0 +1,191 @@
+"""Bounded executors, and deadlines, for the calls of each tool.
+
+Tools without async implementation, such as DuckDuckGo, Arxiv or the
+retrievers of Wikipedia and PubMed, would otherwise block a thread of the
+default executor of the event loop, which is shared with everything else in
+the process. Each tool gets a pool of threads of its own instead, or a bound
+on its calls in flight for async tools, so that a slow search only delays
+the calls of that tool.
+
+A call that takes longer than its deadline, including the time waiting for a
+thread, returns an error message to the model. The thread of a timed out call
+cannot be interrupted, it stays busy until the call returns.
+
+Limits are read from the environment, e.g. TOOL_WORKERS, and can be set per
+tool by suffixing the name of the tool, e.g. TOOL_TIMEOUT_DUCKDUCKGO_SEARCH.
+"""
+import asyncio
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Any, Dict
+
+import structlog
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.tools import BaseTool, StructuredTool, Tool
+
+from app.metrics import METRICS
+from app.tool_cache import ERROR_PREFIX, TOOL_RESULT_CACHE
+
+logger = structlog.get_logger(__name__)
+
+TOOL_WORKERS = int(os.environ.get("TOOL_WORKERS", "4"))
+"""Calls of each tool running at once. Further calls wait for a worker."""
+
+TOOL_TIMEOUT = float(os.environ.get("TOOL_TIMEOUT", "60"))
+"""Seconds after which a tool call returns an error. 0 waits forever."""
+
+CALLS = METRICS.counter("tool_calls_total", "Tool calls, per tool and outcome.")
+QUEUE_SECONDS = METRICS.counter(
+    "tool_queue_seconds_total", "Seconds tool calls waited for a worker, per tool."
+)
+RUN_SECONDS = METRICS.counter(
+    "tool_run_seconds_total", "Seconds tool calls ran, per tool."
+)
+RUNNING = METRICS.gauge("tool_calls_running", "Tool calls running, per tool.")
+
+_pools: Dict[str, "ToolPool"] = {}
+
+TOOL_CALL_RUN_NAME = "tool_call"
+"""Name of the run of each tool call of the agents, streamed as tool events."""
+
+
+def _setting(name: str, tool: str, default: str) -> str:
+    suffix = re.sub(r"\W", "_", tool).upper()
+    return os.environ.get(f"{name}_{suffix}", os.environ.get(name, default))
+
+
+def _is_blocking(tool: BaseTool) -> bool:
+    """Whether the async calls of the tool would run in a thread."""
+    if isinstance(tool, (Tool, StructuredTool)):
+        if tool.coroutine is None:
+            return True
+        # Tools of retrievers call them with functools.partial.
+        retriever = getattr(tool.coroutine, "keywords", {}).get("retriever")
+        return isinstance(retriever, BaseRetriever) and (
+            type(retriever)._aget_relevant_documents
+            is BaseRetriever._aget_relevant_documents
+        )
+    return type(tool)._arun is BaseTool._arun
+
+
+class ToolTimeoutError(TimeoutError):
+    """Raised when a tool call takes longer than the deadline of the tool."""
+
+
+class ToolPool:
+    """Workers for the calls of one tool."""
+
+    def __init__(self, name: str, workers: int, timeout: float) -> None:
+        self.name = name
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=f"tool-{name}"
+        )
+        self._slots = asyncio.Semaphore(workers)
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def _started(self, submitted: float) -> float:
+        started = time.monotonic()
+        QUEUE_SECONDS.inc(started - submitted, tool=self.name)
+        with self._lock:
+            self._running += 1
+            RUNNING.set(self._running, tool=self.name)
+        return started
+
+    def _finished(self, started: float) -> None:
+        RUN_SECONDS.inc(time.monotonic() - started, tool=self.name)
+        with self._lock:
+            self._running -= 1
+            RUNNING.set(self._running, tool=self.name)
+
+    async def _call(self, tool: BaseTool, tool_input: Any, submitted: float) -> Any:
+        if _is_blocking(tool):
+
+            def call() -> Any:
+                started = self._started(submitted)
+                try:
+                    return tool.invoke(tool_input)
+                finally:
+                    self._finished(started)
+
+            # Runs with the context of the caller, for callbacks and tracing.
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, copy_context().run, call
+            )
+
+        async with self._slots:
+            started = self._started(submitted)
+            try:
+                return await tool.ainvoke(tool_input)
+            finally:
+                self._finished(started)
+
+    async def call(self, tool: BaseTool, tool_input: Any) -> Any:
+        """Return the output of the tool, raising ToolTimeoutError on timeout."""
+        submitted = time.monotonic()
+        try:
+            output = await asyncio.wait_for(
+                self._call(tool, tool_input, submitted), self.timeout or None
+            )
+        except asyncio.TimeoutError:
+            CALLS.inc(tool=self.name, outcome="timeout")
+            logger.warning("Tool call timed out", tool=self.name, timeout=self.timeout)
+            raise ToolTimeoutError(
+                f"{ERROR_PREFIX}{self.name} did not respond within {self.timeout:g} "
+                "seconds. Try again later, or answer without it."
+            ) from None
+        except Exception:
+            CALLS.inc(tool=self.name, outcome="error")
+            raise
+        CALLS.inc(tool=self.name, outcome="ok")
+        return output
+
+    async def run(self, tool: BaseTool, tool_input: Any) -> Any:
+        """Return the output of the tool, or an error message on timeout."""
+        try:
+            return await self.call(tool, tool_input)
+        except ToolTimeoutError as e:
+            return str(e)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# PUBLIC API
+
+
+def get_tool_pool(name: str) -> ToolPool:
+    """Return the workers of a tool, shared by the whole process."""
+    pool = _pools.get(name)
+    if pool is None:
+        pool = _pools[name] = ToolPool(
+            name,
+            workers=int(_setting("TOOL_WORKERS", name, str(TOOL_WORKERS))),
+            timeout=float(_setting("TOOL_TIMEOUT", name, str(TOOL_TIMEOUT))),
+        )
+    return pool
+
+
+async def run_tool(tool: BaseTool, tool_input: Any) -> Any:
+    """Call the tool with the workers and deadline of the tool, or answer from
+    the cache of its results."""
+    pool = get_tool_pool(tool.name)
+    try:
+        return await TOOL_RESULT_CACHE.get_or_call(
+            tool, tool_input, lambda: pool.call(tool, tool_input)
+        )
+    except ToolTimeoutError as e:
+        return str(e)
+
+
+def shutdown_tool_pools() -> None:
+    """Stop the threads of the tools, without waiting for running calls."""
+    for pool in _pools.values():
+        pool.shutdown()
+    _pools.clear()
@@ -1,6 +1,6 @@
 from enum import Enum
 from functools import lru_cache
-from typing import Annotated, Literal
+from typing import Annotated, Literal, Optional
 
 from langchain.tools.retriever import create_retriever_tool
 from langchain_community.agent_toolkits.connery import ConneryToolkit
@@ -24,7 +24,21 @@ from langchain_core.tools import Tool
 from pydantic import BaseModel, Field
 from typing_extensions import TypedDict
 
-from app.upload import vstore
+from app.context_packing import RETRIEVAL_MAX_TOKENS
+from app.quantization import EMBEDDING_QUANTIZATION, EMBEDDING_RESCORE_FACTOR
+from app.tool_cache import cached_results
+from app.upload import EMBEDDING_ROUTER, vstore
+from app.vector_cache import VECTOR_CACHE
+from app.vectorstore import PGSearchRetriever, SearchMode
+
+
+# Seconds the results of search tools stay fresh: web search results and news
+# change within hours, papers and encyclopedia articles within days.
+_HOUR = 3600
+_DAY = 24 * _HOUR
+
+# The Tavily tools return the repr of the exceptions they catch.
+_EXCEPTION_REPR = r"\w+(Error|Exception|Timeout)\("
 
 
 class DDGInput(BaseModel):
@@ -211,32 +225,52 @@ If the user is referencing particular files, that is often a good hint that info
 If the user asks a vague question, they are likely meaning to look up info from this retriever, and you should call it!"""
 
 
-def get_retriever(assistant_id: str, thread_id: str):
-    return vstore.as_retriever(
-        search_kwargs={"filter": {"namespace": {"$in": [assistant_id, thread_id]}}}
+def get_retriever(
+    assistant_id: Optional[str],
+    thread_id: Optional[str],
+    search_mode: SearchMode = SearchMode.VECTOR,
+):
+    return PGSearchRetriever(
+        vectorstore=vstore,
+        # The agents are built without an assistant or a thread at import time.
+        namespaces=[namespace for namespace in (assistant_id, thread_id) if namespace],
+        mode=search_mode,
+        max_tokens=RETRIEVAL_MAX_TOKENS,
+        quantization=EMBEDDING_QUANTIZATION,
+        rescore_factor=EMBEDDING_RESCORE_FACTOR,
+        cache=VECTOR_CACHE,
+        resolve=EMBEDDING_ROUTER.search_targets,
     )
 
 
 @lru_cache(maxsize=5)
-def get_retrieval_tool(assistant_id: str, thread_id: str, description: str):
+def get_retrieval_tool(
+    assistant_id: str,
+    thread_id: str,
+    description: str,
+    search_mode: SearchMode = SearchMode.VECTOR,
+):
     return create_retriever_tool(
-        get_retriever(assistant_id, thread_id),
+        get_retriever(assistant_id, thread_id, search_mode),
         "Retriever",
         description,
     )
 
 
 @lru_cache(maxsize=1)
+@cached_results(ttl=_HOUR)
 def _get_duck_duck_go():
     return DuckDuckGoSearchRun(args_schema=DDGInput)
 
 
 @lru_cache(maxsize=1)
+@cached_results(ttl=_DAY, error_pattern="Arxiv exception: ")
 def _get_arxiv():
     return ArxivQueryRun(api_wrapper=ArxivAPIWrapper(), args_schema=ArxivInput)
 
 
 @lru_cache(maxsize=1)
+@cached_results(ttl=_HOUR)
 def _get_you_search():
     return create_retriever_tool(
         YouRetriever(n_hits=3, n_snippets_per_hit=3),
@@ -246,6 +280,7 @@ def _get_you_search():
 
 
 @lru_cache(maxsize=1)
+@cached_results(ttl=_DAY)
 def _get_sec_filings():
     return create_retriever_tool(
         KayAiRetriever.create(
@@ -257,6 +292,7 @@ def _get_sec_filings():
 
 
 @lru_cache(maxsize=1)
+@cached_results(ttl=_HOUR)
 def _get_press_releases():
     return create_retriever_tool(
         KayAiRetriever.create(
@@ -268,6 +304,7 @@ def _get_press_releases():
 
 
 @lru_cache(maxsize=1)
+@cached_results(ttl=_DAY)
 def _get_pubmed():
     return create_retriever_tool(
         PubMedRetriever(), "pub_med_search", "Search for a query on PubMed"
@@ -275,6 +312,7 @@ def _get_pubmed():
 
 
 @lru_cache(maxsize=1)
+@cached_results(ttl=_DAY)
 def _get_wikipedia():
     return create_retriever_tool(
         WikipediaRetriever(), "wikipedia", "Search for a query on Wikipedia"
@@ -282,12 +320,14 @@ def _get_wikipedia():
 
 
 @lru_cache(maxsize=1)
+@cached_results(ttl=_HOUR, error_pattern=_EXCEPTION_REPR)
 def _get_tavily():
     tavily_search = TavilySearchAPIWrapper()
     return TavilySearchResults(api_wrapper=tavily_search, name="search_tavily")
 
 
 @lru_cache(maxsize=1)
+@cached_results(ttl=_HOUR, error_pattern=_EXCEPTION_REPR)
 def _get_tavily_answer():
     tavily_search = TavilySearchAPIWrapper()
     return _TavilyAnswer(api_wrapper=tavily_search, name="search_tavily_answer")
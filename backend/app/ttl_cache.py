@@ -0,0 +1,172 @@
+"""Two tier caches with a TTL: in memory, then in Postgres.
+
+Each server process keeps the recently used entries in memory, and shares
+them with the other processes through a table with a `key` primary key, an
+`expires_at` timestamp and a JSONB value column (migrations 11 and 12). The
+expired rows of every table are removed by one background task,
+`run_cache_pruning`.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, ClassVar, Optional, Sequence, Tuple
+
+import asyncpg
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+CACHE_PRUNE_INTERVAL = float(os.environ.get("CACHE_PRUNE_INTERVAL", "3600"))
+"""Seconds between removals of the expired cache entries from Postgres."""
+
+
+class TTLCache:
+    """Two tier cache: in memory, then in the `table` shared by all processes."""
+
+    table: ClassVar[str]
+    """Table of the entries, with `key`, `expires_at` and `value_column`."""
+
+    value_column: ClassVar[str]
+    """Column of the JSON encoded values in `table`."""
+
+    def __init__(
+        self,
+        *,
+        max_entries: int,
+        get_pool: Callable[[], Optional[asyncpg.pool.Pool]],
+    ) -> None:
+        self.max_entries = max_entries
+        self.get_pool = get_pool
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def encode(self, value: Any) -> Any:
+        """Return the value as stored in Postgres, raise TypeError if it can't be."""
+        return value
+
+    def decode(self, value: Any) -> Any:
+        """Return the value stored in Postgres as kept in memory."""
+        return value
+
+    def _get_memory(self, key: str) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[1]
+
+    def _set_memory(self, key: str, value: Any, ttl: float) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def _fetch(self, key: str) -> Optional[Tuple[Any, float]]:
+        pool = self.get_pool()
+        if pool is None:
+            return None
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(
+                f"""
+                SELECT {self.value_column},
+                    EXTRACT(EPOCH FROM expires_at - CURRENT_TIMESTAMP)
+                FROM {self.table}
+                WHERE key = $1 AND expires_at > CURRENT_TIMESTAMP
+                """,
+                key,
+            )
+        return (row[0], float(row[1])) if row is not None else None
+
+    async def _store(self, key: str, value: Any, ttl: float, columns: dict) -> None:
+        pool = self.get_pool()
+        if pool is None:
+            return
+        names = [*columns, self.value_column]
+        params = ", ".join(f"${i + 2}" for i in range(len(names)))
+        async with pool.acquire() as conn:
+            await conn.execute(
+                f"""
+                INSERT INTO {self.table} (key, {", ".join(names)}, expires_at)
+                VALUES (
+                    $1, {params},
+                    CURRENT_TIMESTAMP + make_interval(secs => ${len(names) + 2})
+                )
+                ON CONFLICT (key) DO UPDATE SET
+                    {self.value_column} = EXCLUDED.{self.value_column},
+                    expires_at = EXCLUDED.expires_at
+                """,
+                key,
+                *columns.values(),
+                value,
+                float(ttl),
+            )
+
+    async def get(self, key: str) -> Tuple[Optional[str], Any]:
+        """Return the tier the key was found in, None if it was not, and the
+        cached value."""
+        found, value = self._get_memory(key)
+        if found:
+            return "memory", value
+        try:
+            row = await self._fetch(key)
+        except Exception:
+            # The cache is an optimization, a failure to read it is a miss.
+            logger.exception("Failed to read the cache", table=self.table)
+            row = None
+        if row is None:
+            return None, None
+        value = self.decode(row[0])
+        self._set_memory(key, value, row[1])
+        return "postgres", value
+
+    async def set(self, key: str, value: Any, ttl: float, **columns: Any) -> None:
+        """Cache the value for `ttl` seconds, with the other `columns` of the
+        table."""
+        self._set_memory(key, value, ttl)
+        try:
+            encoded = self.encode(value)
+        except TypeError:
+            # Only JSON values can be shared through Postgres.
+            return
+        try:
+            await self._store(key, encoded, ttl, columns)
+        except Exception:
+            logger.exception("Failed to write the cache", table=self.table)
+
+    def clear(self) -> None:
+        """Drop the entries cached in memory."""
+        with self._lock:
+            self._entries.clear()
+
+
+# PUBLIC API
+
+
+async def run_cache_pruning(
+    pool: asyncpg.pool.Pool,
+    caches: Sequence[TTLCache],
+    *,
+    interval: float = CACHE_PRUNE_INTERVAL,
+) -> None:
+    """Remove the expired entries of the caches from Postgres every `interval`
+    seconds."""
+    tables = sorted({cache.table for cache in caches})
+    while True:
+        for table in tables:
+            try:
+                async with pool.acquire() as conn:
+                    await conn.execute(
+                        f"DELETE FROM {table} WHERE expires_at <= CURRENT_TIMESTAMP"
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to remove expired cache entries", table=table)
+        await asyncio.sleep(interval)
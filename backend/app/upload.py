@@ -11,11 +11,16 @@ from __future__ import annotations
 
 import mimetypes
 import os
-from typing import BinaryIO, List, Optional
+import tempfile
+from contextlib import suppress
+from functools import lru_cache
+from typing import BinaryIO, Callable, List, Optional
 
-from fastapi import UploadFile
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
 from langchain_community.vectorstores.pgvector import PGVector
 from langchain_core.document_loaders.blob_loaders import Blob
+from langchain_core.embeddings import Embeddings
 from langchain_core.runnables import (
     ConfigurableField,
     RunnableConfig,
@@ -25,13 +30,42 @@ from langchain_core.vectorstores import VectorStore
 from langchain_openai import AzureOpenAIEmbeddings, OpenAIEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter, TextSplitter
 from pydantic import ConfigDict
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-from app.ingest import ingest_blob
-from app.parsing import MIMETYPE_BASED_PARSER
+from app.documents import DocumentRegistry, hash_blob
+from app.http_clients import get_async_http_client, get_http_client
+from app.ingest import delete_chunks, ingest_blob
+from app.parsing import PROCESS_POOL_PARSER
+from app.reindex import EMBEDDING_ROUTE_TTL, EmbeddingRouter
+from app.vector_cache import VECTOR_CACHE
+from app.vectorstore import BulkPGVector
+
+UPLOAD_MAX_FILE_SIZE = int(os.environ.get("UPLOAD_MAX_FILE_SIZE", 50 * 1024 * 1024))
+"""Maximum size in bytes of a single uploaded file."""
+
+UPLOAD_MAX_REQUEST_SIZE = int(
+    os.environ.get("UPLOAD_MAX_REQUEST_SIZE", 10 * UPLOAD_MAX_FILE_SIZE)
+)
+"""Maximum size in bytes of an upload request, which may carry several files."""
+
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR") or None
+"""Directory uploads are spooled to; defaults to the system temp directory."""
+
+INGEST_EMBEDDING_CONCURRENCY = int(os.environ.get("INGEST_EMBEDDING_CONCURRENCY", "4"))
+"""Maximum number of concurrent embedding requests per ingested file."""
+
+_SPOOL_PREFIX = "opengpts-upload-"
+_COPY_CHUNK_SIZE = 1024 * 1024
+# Number of leading bytes used to sniff the mime-type of a file.
+_MIMETYPE_SNIFF_SIZE = 1024
+
+
+class FileTooLargeError(ValueError):
+    """Raised when an uploaded file exceeds UPLOAD_MAX_FILE_SIZE."""
 
 
 def _guess_mimetype(file_name: str, file_bytes: bytes) -> str:
-    """Guess the mime-type of a file based on its name or bytes."""
+    """Guess the mime-type of a file based on its name or leading bytes."""
     # Guess based on the file extension
     mime_type, _ = mimetypes.guess_type(file_name)
 
@@ -53,7 +87,7 @@ def _guess_mimetype(file_name: str, file_bytes: bytes) -> str:
 
     # Check for CSV-like plain text content (commas, tabs, newlines)
     try:
-        decoded = file_bytes[:1024].decode("utf-8", errors="ignore")
+        decoded = file_bytes[:_MIMETYPE_SNIFF_SIZE].decode("utf-8", errors="ignore")
         if all(char in decoded for char in (",", "\n")) or all(
             char in decoded for char in ("\t", "\n")
         ):
@@ -66,47 +100,148 @@ def _guess_mimetype(file_name: str, file_bytes: bytes) -> str:
     return "application/octet-stream"
 
 
-def convert_ingestion_input_to_blob(file: UploadFile) -> Blob:
-    """Convert ingestion input to blob."""
-    file_data = file.file.read()
+def convert_ingestion_input_to_blob(
+    file: UploadFile, *, max_size: int = UPLOAD_MAX_FILE_SIZE
+) -> Blob:
+    """Convert ingestion input to a blob backed by a spooled temp file.
+
+    The upload is copied to disk in chunks, so memory use does not depend on
+    the size of the file. Call `release_blob` once the blob has been ingested.
+    """
     file_name = file.filename
 
     # Check if file_name is a valid string
     if not isinstance(file_name, str):
         raise TypeError(f"Expected string for file name, got {type(file_name)}")
 
-    mimetype = _guess_mimetype(file_name, file_data)
-    return Blob.from_data(
-        data=file_data,
-        path=file_name,
-        mime_type=mimetype,
+    fd, path = tempfile.mkstemp(prefix=_SPOOL_PREFIX, dir=UPLOAD_SPOOL_DIR)
+    header = b""
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as spool:
+            while chunk := file.file.read(_COPY_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise FileTooLargeError(
+                        f"File {file_name} exceeds the maximum size of {max_size} bytes"
+                    )
+                if len(header) < _MIMETYPE_SNIFF_SIZE:
+                    header += chunk[: _MIMETYPE_SNIFF_SIZE - len(header)]
+                spool.write(chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+
+    return Blob.from_path(
+        path,
+        mime_type=_guess_mimetype(file_name, header),
+        metadata={"source": file_name},
     )
 
 
-def _determine_azure_or_openai_embeddings() -> PGVector:
+class UploadSizeLimitMiddleware:
+    """Reject upload requests over UPLOAD_MAX_REQUEST_SIZE with a 413.
+
+    Starlette spools the whole multipart body to disk before the endpoint
+    runs, so the limit is checked against the Content-Length header, and
+    while the body is received for requests that do not declare their length.
+    """
+
+    def __init__(self, app: ASGIApp, *, max_size: int = UPLOAD_MAX_REQUEST_SIZE):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        if not headers.get(b"content-type", b"").startswith(b"multipart/form-data"):
+            return await self.app(scope, receive, send)
+
+        error = HTTPException(
+            status_code=413,
+            detail=f"Upload exceeds the maximum size of {self.max_size} bytes",
+        )
+        content_length = headers.get(b"content-length")
+        if content_length is not None:
+            try:
+                length = int(content_length)
+            except ValueError:
+                length = -1
+            if length < 0:
+                response = JSONResponse(
+                    {"detail": "Invalid Content-Length header"}, status_code=400
+                )
+                return await response(scope, receive, send)
+            if length > self.max_size:
+                response = JSONResponse({"detail": error.detail}, status_code=413)
+                return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    # FastAPI turns HTTPExceptions raised while the body is
+                    # parsed into error responses.
+                    raise error
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def release_blob(blob: Blob) -> None:
+    """Delete the spooled temp file backing a blob, if any."""
+    if blob.path and os.path.basename(str(blob.path)).startswith(_SPOOL_PREFIX):
+        with suppress(FileNotFoundError):
+            os.unlink(blob.path)
+
+
+def _get_embeddings(model: str) -> Embeddings:
     if os.environ.get("OPENAI_API_KEY"):
-        return PGVector(
-            connection_string=PG_CONNECTION_STRING,
-            embedding_function=OpenAIEmbeddings(),
-            use_jsonb=True,
+        return OpenAIEmbeddings(
+            model=model,
+            http_client=get_http_client(),
+            http_async_client=get_async_http_client(),
         )
     if os.environ.get("AZURE_OPENAI_API_KEY"):
-        return PGVector(
-            connection_string=PG_CONNECTION_STRING,
-            embedding_function=AzureOpenAIEmbeddings(
-                azure_endpoint=os.environ.get("AZURE_OPENAI_API_BASE"),
-                azure_deployment=os.environ.get(
-                    "AZURE_OPENAI_EMBEDDINGS_DEPLOYMENT_NAME"
-                ),
-                openai_api_version=os.environ.get("AZURE_OPENAI_API_VERSION"),
-            ),
-            use_jsonb=True,
+        return AzureOpenAIEmbeddings(
+            http_client=get_http_client(),
+            http_async_client=get_async_http_client(),
+            azure_endpoint=os.environ.get("AZURE_OPENAI_API_BASE"),
+            azure_deployment=model,
+            openai_api_version=os.environ.get("AZURE_OPENAI_API_VERSION"),
         )
     raise ValueError(
         "Either OPENAI_API_KEY or AZURE_OPENAI_API_KEY needs to be set for embeddings to work."
     )
 
 
+@lru_cache(maxsize=None)
+def get_vectorstore(collection_name: str, model: str) -> PGVector:
+    """Return the vectorstore of a collection, creating the collection if needed.
+
+    All the chunks of a collection must be embedded with the same model.
+    """
+    return BulkPGVector(
+        connection_string=PG_CONNECTION_STRING,
+        embedding_function=_get_embeddings(model),
+        collection_name=collection_name,
+        collection_metadata={"model": model},
+        use_jsonb=True,
+    )
+
+
+def collection_for_model(model: str) -> str:
+    """Return the name of the collection of chunks embedded with a model."""
+    if model == EMBEDDING_MODEL:
+        return EMBEDDING_COLLECTION
+    return f"{EMBEDDING_COLLECTION}:{model}"
+
+
 class IngestRunnable(RunnableSerializable[BinaryIO, List[str]]):
     """Runnable for ingesting files into a vectorstore."""
 
@@ -118,6 +253,12 @@ class IngestRunnable(RunnableSerializable[BinaryIO, List[str]]):
     
     ID is used as the namespace, and is filtered on at query time.
     """
+    embedding_concurrency: int = 1
+    """Maximum number of concurrent embedding requests per ingested file."""
+    router: Optional[EmbeddingRouter] = None
+    """Resolves the vectorstore of the namespace, instead of `vectorstore`."""
+    registry: Optional[DocumentRegistry] = None
+    """Records ingested files, so that uploading a file again replaces it."""
 
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
@@ -131,14 +272,53 @@ class IngestRunnable(RunnableSerializable[BinaryIO, List[str]]):
             )
         return self.assistant_id if self.assistant_id is not None else self.thread_id
 
-    def invoke(self, blob: Blob, config: Optional[RunnableConfig] = None) -> List[str]:
-        out = ingest_blob(
-            blob,
-            MIMETYPE_BASED_PARSER,
-            self.text_splitter,
-            self.vectorstore,
-            self.namespace,
-        )
+    def invoke(
+        self,
+        blob: Blob,
+        config: Optional[RunnableConfig] = None,
+        *,
+        on_progress: Optional[Callable[[int], None]] = None,
+    ) -> List[str]:
+        """Ingest the blob and return the ids of its chunks.
+
+        If given, `on_progress` is called with the number of chunks written so
+        far as they are written.
+        """
+        namespace = self.namespace
+        if self.registry is not None:
+            content_hash = hash_blob(blob)
+            existing = self.registry.get(namespace, str(blob.source))
+            if existing is not None and existing.content_hash == content_hash:
+                return existing.chunk_ids
+
+        vectorstore, mirrors = self.vectorstore, []
+        if self.router is not None:
+            vectorstore, mirrors = self.router.ingest_targets(namespace)
+        try:
+            out = ingest_blob(
+                blob,
+                PROCESS_POOL_PARSER,
+                self.text_splitter,
+                vectorstore,
+                namespace,
+                embedding_concurrency=self.embedding_concurrency,
+                mirrors=mirrors,
+                on_progress=on_progress,
+            )
+            if self.registry is not None:
+                try:
+                    self.registry.replace(
+                        namespace, str(blob.source), content_hash, out
+                    )
+                except BaseException:
+                    # Until recorded, the new chunks can't be replaced or
+                    # deleted with the file; the previous ones are kept.
+                    delete_chunks(vectorstore, out, mirrors=mirrors)
+                    raise
+        finally:
+            # Even if ingestion failed, its chunks may have been cached before
+            # they were deleted.
+            VECTOR_CACHE.invalidate(namespace)
         return out
 
 
@@ -150,12 +330,37 @@ PG_CONNECTION_STRING = PGVector.connection_string_from_db_params(
     user=os.environ["POSTGRES_USER"],
     password=os.environ["POSTGRES_PASSWORD"],
 )
-vstore = _determine_azure_or_openai_embeddings()
+
+
+def _default_embedding_model() -> str:
+    # Same provider precedence as _get_embeddings.
+    if os.environ.get("OPENAI_API_KEY"):
+        return "text-embedding-ada-002"
+    return os.environ.get(
+        "AZURE_OPENAI_EMBEDDINGS_DEPLOYMENT_NAME", "text-embedding-ada-002"
+    )
+
+
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL") or _default_embedding_model()
+"""Embedding model (or Azure deployment) of the chunks in EMBEDDING_COLLECTION.
+
+Changing it does not re-embed the existing chunks, use `python -m app.reindex`.
+"""
+
+EMBEDDING_COLLECTION = os.environ.get("EMBEDDING_COLLECTION", "langchain")
+"""Collection of the namespaces that were never reindexed."""
+
+vstore = get_vectorstore(EMBEDDING_COLLECTION, EMBEDDING_MODEL)
+
+EMBEDDING_ROUTER = EmbeddingRouter(vstore, get_vectorstore, ttl=EMBEDDING_ROUTE_TTL)
 
 
 ingest_runnable = IngestRunnable(
     text_splitter=RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200),
     vectorstore=vstore,
+    embedding_concurrency=INGEST_EMBEDDING_CONCURRENCY,
+    router=EMBEDDING_ROUTER,
+    registry=DocumentRegistry(vstore._bind),
 ).configurable_fields(
     assistant_id=ConfigurableField(
         id="assistant_id",
@@ -0,0 +1,214 @@
+"""In-process index of the chunk embeddings of recently searched namespaces.
+
+Most assistants and threads only have a few hundred chunks. Their embeddings
+are loaded once into a float32 matrix and searched with a matrix product,
+which avoids a database round trip per retrieval. Namespaces with more than
+`max_rows` chunks are always searched in Postgres.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import sqlalchemy
+import structlog
+from langchain_core.documents import Document
+from sqlalchemy.engine import Engine
+
+logger = structlog.get_logger(__name__)
+
+VECTOR_CACHE_MAX_MB = int(os.environ.get("VECTOR_CACHE_MAX_MB", "0"))
+"""Memory budget of the in-process vector index. 0 disables it."""
+
+VECTOR_CACHE_MAX_ROWS = int(os.environ.get("VECTOR_CACHE_MAX_ROWS", "5000"))
+"""Namespaces with more chunks than this are always searched in Postgres."""
+
+VECTOR_CACHE_TTL = int(os.environ.get("VECTOR_CACHE_TTL", "300"))
+"""Seconds after which a cached namespace is reloaded.
+
+Ingestion only invalidates the cache of the process it runs in, so this
+bounds how stale the other server processes can be.
+"""
+
+_LOAD_SQL = """
+SELECT document, cmetadata, CAST(embedding AS real[]) AS embedding
+FROM langchain_pg_embedding
+WHERE collection_id = (
+    SELECT uuid FROM langchain_pg_collection WHERE name = :collection_name
+)
+AND cmetadata->>'namespace' = :namespace
+AND embedding IS NOT NULL
+LIMIT :limit
+"""
+
+
+class NamespaceIndex:
+    """Normalized embeddings and contents of the chunks of a namespace."""
+
+    def __init__(
+        self,
+        texts: List[str],
+        metadatas: List[dict],
+        embeddings: Optional[np.ndarray],
+        *,
+        too_large: bool = False,
+    ) -> None:
+        self.texts = texts
+        self.metadatas = metadatas
+        self.matrix = embeddings
+        if embeddings is not None and len(embeddings):
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            self.matrix = embeddings / np.maximum(norms, 1e-12)
+        # Set for namespaces with too many chunks to be searched in memory.
+        self.too_large = too_large
+        self.loaded_at = time.monotonic()
+
+    @property
+    def nbytes(self) -> int:
+        # The texts dominate the size of the metadata, which is not counted.
+        matrix_bytes = self.matrix.nbytes if self.matrix is not None else 0
+        return matrix_bytes + sum(len(text) for text in self.texts)
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[float, int]]:
+        """Return (cosine similarity, row) of the top k rows."""
+        if self.matrix is None or not len(self.texts):
+            return []
+        scores = self.matrix @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [(float(scores[i]), int(i)) for i in top]
+
+
+class VectorCache:
+    """LRU cache of namespace indexes, under a memory budget."""
+
+    def __init__(self, *, max_bytes: int, max_rows: int, ttl: float) -> None:
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self._indexes: "OrderedDict[Tuple[str, str], NamespaceIndex]" = OrderedDict()
+        # Bumped on invalidation, so that loads racing with it are discarded.
+        self._generation = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _load(
+        self, bind: Engine, collection_name: str, namespace: str
+    ) -> NamespaceIndex:
+        start = time.perf_counter()
+        with bind.connect() as conn:
+            rows = conn.execute(
+                sqlalchemy.text(_LOAD_SQL),
+                {
+                    "collection_name": collection_name,
+                    "namespace": namespace,
+                    "limit": self.max_rows + 1,
+                },
+            ).fetchall()
+        if len(rows) > self.max_rows:
+            return NamespaceIndex([], [], None, too_large=True)
+        index = NamespaceIndex(
+            [row[0] for row in rows],
+            [row[1] or {} for row in rows],
+            np.array([row[2] for row in rows], dtype=np.float32) if rows else None,
+        )
+        logger.info(
+            "Loaded namespace into the vector cache",
+            namespace=namespace,
+            rows=len(rows),
+            seconds=round(time.perf_counter() - start, 3),
+        )
+        return index
+
+    def _get(
+        self, bind: Engine, collection_name: str, namespace: str
+    ) -> NamespaceIndex:
+        key = (collection_name, namespace)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None and time.monotonic() - index.loaded_at < self.ttl:
+                self._indexes.move_to_end(key)
+                return index
+            generation = self._generation
+
+        index = self._load(bind, collection_name, namespace)
+
+        with self._lock:
+            if self._generation != generation:
+                # Invalidated while loading, don't cache what may be stale.
+                return index
+            if index.nbytes > self.max_bytes:
+                index = NamespaceIndex([], [], None, too_large=True)
+            previous = self._indexes.pop(key, None)
+            if previous is not None:
+                self._size -= previous.nbytes
+            self._indexes[key] = index
+            self._size += index.nbytes
+            while self._size > self.max_bytes:
+                _, evicted = self._indexes.popitem(last=False)
+                self._size -= evicted.nbytes
+        return index
+
+    def search(
+        self,
+        bind: Engine,
+        collection_name: str,
+        namespaces: Sequence[str],
+        embedding: Sequence[float],
+        k: int,
+    ) -> Optional[Tuple[List[Document], np.ndarray]]:
+        """Return the k chunks of the namespaces closest to the embedding.
+
+        The chunks are returned with their normalized embeddings, one row per
+        chunk. Returns None if any namespace is too large to be searched in
+        memory.
+        """
+        indexes = []
+        for namespace in dict.fromkeys(namespaces):
+            index = self._get(bind, collection_name, namespace)
+            if index.too_large:
+                return None
+            indexes.append(index)
+
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        candidates = [
+            (score, index, row)
+            for index in indexes
+            for score, row in index.search(query, k)
+        ]
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        candidates = candidates[:k]
+        docs = [
+            Document(
+                page_content=index.texts[row],
+                metadata={**index.metadatas[row], "score": score},
+            )
+            for score, index, row in candidates
+        ]
+        embeddings = np.array(
+            [index.matrix[row] for _, index, row in candidates], dtype=np.float32
+        )
+        return docs, embeddings
+
+    def invalidate(self, namespace: str) -> None:
+        """Drop the cached chunks of a namespace, after they changed."""
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._indexes if key[1] == namespace]:
+                self._size -= self._indexes.pop(key).nbytes
+
+
+# PUBLIC API
+
+VECTOR_CACHE = VectorCache(
+    max_bytes=VECTOR_CACHE_MAX_MB * 2**20,
+    max_rows=VECTOR_CACHE_MAX_ROWS,
+    ttl=VECTOR_CACHE_TTL,
+)
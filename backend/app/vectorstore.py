@@ -0,0 +1,417 @@
+"""Postgres access to the chunk embeddings written by PGVector.
+
+PGVector stores chunks in the `langchain_pg_embedding` table. This module
+holds the queries that bypass its ORM layer where the per-row overhead
+matters, and the retriever used to search the chunks of an assistant or
+thread.
+"""
+import io
+import struct
+import time
+import uuid
+from enum import Enum
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import orjson
+import sqlalchemy
+import structlog
+from langchain_community.vectorstores.pgvector import PGVector
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+from sqlalchemy.orm import Session
+
+from app.context_packing import pack_context
+from app.quantization import CANDIDATE_DISTANCE, QUANTIZED_DIMENSIONS, Quantization
+from app.vector_cache import VectorCache
+
+logger = structlog.get_logger(__name__)
+
+EMBEDDING_TABLE = "langchain_pg_embedding"
+
+_COPY_COLUMNS = (
+    "uuid",
+    "collection_id",
+    "embedding",
+    "document",
+    "cmetadata",
+    "custom_id",
+)
+TEXT_SEARCH_CONFIG = "english"
+"""Text search configuration of the `document_tsv` column, see migration 6."""
+
+HNSW_MAX_EF_SEARCH = 1000
+"""Largest `hnsw.ef_search` accepted by pgvector."""
+
+_COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+# The jsonb binary format is a version byte followed by the JSON text.
+_JSONB_VERSION = b"\x01"
+
+
+def _field(value: bytes) -> bytes:
+    return struct.pack(">i", len(value)) + value
+
+
+def _encode_vector(embedding: Sequence[float]) -> bytes:
+    """Encode an embedding in the binary format of the pgvector `vector` type."""
+    dim = len(embedding)
+    return struct.pack(f">hh{dim}f", dim, 0, *embedding)
+
+
+def encode_copy_rows(
+    collection_id: uuid.UUID,
+    texts: Sequence[str],
+    embeddings: Sequence[Sequence[float]],
+    metadatas: Sequence[dict],
+    ids: Sequence[str],
+) -> bytes:
+    """Encode chunk rows in the Postgres binary COPY format."""
+    buf = io.BytesIO()
+    buf.write(_COPY_SIGNATURE)
+    buf.write(struct.pack(">ii", 0, 0))  # flags, header extension length
+    field_count = struct.pack(">h", len(_COPY_COLUMNS))
+    collection_bytes = _field(collection_id.bytes)
+    for text, embedding, metadata, id_ in zip(texts, embeddings, metadatas, ids):
+        buf.write(field_count)
+        buf.write(_field(uuid.uuid4().bytes))
+        buf.write(collection_bytes)
+        buf.write(_field(_encode_vector(embedding)))
+        buf.write(_field(text.encode("utf-8")))
+        buf.write(_field(_JSONB_VERSION + orjson.dumps(metadata)))
+        buf.write(_field(id_.encode("utf-8")))
+    buf.write(struct.pack(">h", -1))
+    return buf.getvalue()
+
+
+class BulkPGVector(PGVector):
+    """PGVector that writes embeddings with a binary COPY.
+
+    Each call to `add_embeddings` is written in a single transaction.
+    """
+
+    _collection_id: Optional[uuid.UUID] = None
+
+    def _get_collection_id(self) -> uuid.UUID:
+        if self._collection_id is None:
+            with Session(self._bind) as session:
+                collection = self.get_collection(session)
+                if not collection:
+                    raise ValueError("Collection not found")
+                self._collection_id = collection.uuid
+        return self._collection_id
+
+    def add_embeddings(
+        self,
+        texts: Iterable[str],
+        embeddings: List[List[float]],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in texts]
+        if not metadatas:
+            metadatas = [{} for _ in texts]
+
+        start = time.perf_counter()
+        data = encode_copy_rows(
+            self._get_collection_id(), texts, embeddings, metadatas, ids
+        )
+        with self._bind.begin() as conn:
+            cursor = conn.connection.cursor()
+            try:
+                cursor.copy_expert(
+                    f"COPY {EMBEDDING_TABLE} ({', '.join(_COPY_COLUMNS)}) "
+                    "FROM STDIN WITH (FORMAT binary)",
+                    io.BytesIO(data),
+                )
+            finally:
+                cursor.close()
+        elapsed = time.perf_counter() - start
+        logger.info(
+            "Bulk inserted chunks",
+            rows=len(texts),
+            seconds=round(elapsed, 3),
+            rows_per_second=round(len(texts) / elapsed) if elapsed else None,
+        )
+        return ids
+
+
+class SearchMode(str, Enum):
+    """How chunks are matched against a query."""
+
+    VECTOR = "vector"
+    """Cosine similarity of the embeddings."""
+    HYBRID = "hybrid"
+    """Vector and full-text search, fused with reciprocal rank fusion."""
+
+
+_NAMESPACE_FILTER = """
+    collection_id = (
+        SELECT uuid FROM langchain_pg_collection WHERE name = :collection_name
+    )
+    AND cmetadata->>'namespace' = ANY(:namespaces)
+"""
+
+_VECTOR_SEARCH_SQL = f"""
+SELECT
+    document,
+    cmetadata,
+    1 - (embedding <=> CAST(:embedding AS vector)) AS score,
+    CAST(embedding AS real[]) AS embedding
+FROM {EMBEDDING_TABLE}
+WHERE {_NAMESPACE_FILTER}
+ORDER BY embedding <=> CAST(:embedding AS vector)
+LIMIT :fetch_k
+"""
+
+# The candidates found with a quantized copy of the embeddings are rescored
+# with the full precision embeddings.
+_RESCORED_VECTOR_SEARCH_SQL = {
+    quantization: f"""
+WITH candidates AS (
+    SELECT uuid
+    FROM {EMBEDDING_TABLE}
+    WHERE {_NAMESPACE_FILTER}
+    ORDER BY {distance}
+    LIMIT :rescore_k
+)
+SELECT
+    document,
+    cmetadata,
+    1 - (embedding <=> CAST(:embedding AS vector)) AS score,
+    CAST(embedding AS real[]) AS embedding
+FROM {EMBEDDING_TABLE}
+JOIN candidates USING (uuid)
+ORDER BY embedding <=> CAST(:embedding AS vector)
+LIMIT :fetch_k
+"""
+    for quantization, distance in CANDIDATE_DISTANCE.items()
+}
+
+# Both searches rank their top `fetch_k` candidates, and each candidate
+# scores 1 / (rrf_k + rank) for every search that found it.
+_HYBRID_SEARCH_SQL = f"""
+WITH semantic AS (
+    SELECT uuid, row_number() OVER (
+        ORDER BY embedding <=> CAST(:embedding AS vector)
+    ) AS rank
+    FROM {EMBEDDING_TABLE}
+    WHERE {_NAMESPACE_FILTER}
+    ORDER BY embedding <=> CAST(:embedding AS vector)
+    LIMIT :fetch_k
+),
+lexical AS (
+    SELECT uuid, row_number() OVER (
+        ORDER BY ts_rank_cd(document_tsv, query) DESC
+    ) AS rank
+    FROM {EMBEDDING_TABLE},
+        websearch_to_tsquery(CAST(:text_search_config AS regconfig), :query) query
+    WHERE {_NAMESPACE_FILTER}
+    AND document_tsv @@ query
+    ORDER BY ts_rank_cd(document_tsv, query) DESC
+    LIMIT :fetch_k
+),
+fused AS (
+    SELECT uuid, sum(1.0 / (:rrf_k + rank)) AS score
+    FROM (SELECT * FROM semantic UNION ALL SELECT * FROM lexical) ranked
+    GROUP BY uuid
+)
+SELECT e.document, e.cmetadata, f.score, CAST(e.embedding AS real[]) AS embedding
+FROM fused f
+JOIN {EMBEDDING_TABLE} e USING (uuid)
+ORDER BY f.score DESC
+LIMIT :fetch_k
+"""
+
+
+def _format_vector(embedding: Sequence[float]) -> str:
+    return "[" + ",".join(map(str, embedding)) + "]"
+
+
+def _stack_embeddings(groups: Sequence[np.ndarray]) -> np.ndarray:
+    """Stack the embeddings of groups of chunks embedded with different models.
+
+    Each group is placed in its own columns, so that chunks of different
+    groups, whose embeddings can not be compared, have a similarity of 0.
+    """
+    groups = [group for group in groups if len(group)]
+    if len(groups) == 1:
+        return groups[0]
+    stacked = np.zeros(
+        (
+            sum(group.shape[0] for group in groups),
+            sum(group.shape[1] for group in groups),
+        ),
+        dtype=np.float32,
+    )
+    row = col = 0
+    for group in groups:
+        stacked[row : row + group.shape[0], col : col + group.shape[1]] = group
+        row += group.shape[0]
+        col += group.shape[1]
+    return stacked
+
+
+class PGSearchRetriever(BaseRetriever):
+    """Retrieve the chunks of the given namespaces in a single query.
+
+    The top `fetch_k` candidates are retrieved, and up to `k` of them are
+    picked with `pack_context`. The relevance score of each chunk is added to
+    its metadata as `score`. In vector mode, small namespaces are searched in
+    `cache` if it is enabled.
+
+    If `resolve` is given, it groups the namespaces by the vectorstore, and so
+    the embedding model, their chunks are searched in. Otherwise all of them
+    are searched in `vectorstore`.
+    """
+
+    vectorstore: PGVector
+    namespaces: List[str]
+    mode: SearchMode = SearchMode.VECTOR
+    k: int = 4
+    """Maximum number of chunks to return."""
+    fetch_k: int = 20
+    """Number of candidates to pick the chunks from."""
+    rrf_k: int = 60
+    """Constant of reciprocal rank fusion, damps the weight of the top ranks."""
+    lambda_mult: float = 0.7
+    """Trade-off between relevance (1) and diversity (0) of the chunks."""
+    max_tokens: Optional[int] = None
+    """Maximum number of tokens of the returned chunks."""
+    quantization: Quantization = Quantization.NONE
+    """Copy of the embeddings searched for candidates in vector mode."""
+    rescore_factor: int = 4
+    """Candidates rescored with the full embeddings, per candidate returned.
+
+    At most HNSW_MAX_EF_SEARCH candidates are rescored."""
+    cache: Optional[VectorCache] = None
+    resolve: Optional[
+        Callable[[Sequence[str]], List[Tuple[PGVector, List[str]]]]
+    ] = None
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    def _search_params(
+        self,
+        vectorstore: PGVector,
+        namespaces: List[str],
+        query: str,
+        embedding: List[float],
+    ) -> dict:
+        return {
+            "collection_name": vectorstore.collection_name,
+            "namespaces": namespaces,
+            "embedding": _format_vector(embedding),
+            "query": query,
+            "text_search_config": TEXT_SEARCH_CONFIG,
+            "fetch_k": max(self.fetch_k, self.k),
+            "rescore_k": min(
+                max(self.fetch_k, self.k) * self.rescore_factor, HNSW_MAX_EF_SEARCH
+            ),
+            "rrf_k": self.rrf_k,
+        }
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        if self.resolve is None:
+            groups = [(self.vectorstore, list(self.namespaces))]
+        else:
+            groups = self.resolve(self.namespaces)
+
+        docs: List[Document] = []
+        embeddings: List[np.ndarray] = []
+        for vectorstore, namespaces in groups:
+            group_docs, group_embeddings = self._search_group(
+                vectorstore, namespaces, query
+            )
+            docs.extend(group_docs)
+            embeddings.append(group_embeddings)
+        if not docs:
+            return []
+        return pack_context(
+            docs,
+            _stack_embeddings(embeddings),
+            [doc.metadata["score"] for doc in docs],
+            k=self.k,
+            lambda_mult=self.lambda_mult,
+            max_tokens=self.max_tokens,
+        )
+
+    def _search_group(
+        self, vectorstore: PGVector, namespaces: List[str], query: str
+    ) -> Tuple[List[Document], np.ndarray]:
+        embedding = vectorstore.embeddings.embed_query(query)
+        candidates = None
+        if self.mode == SearchMode.VECTOR and self.cache and self.cache.enabled:
+            candidates = self.cache.search(
+                vectorstore._bind,
+                vectorstore.collection_name,
+                namespaces,
+                embedding,
+                max(self.fetch_k, self.k),
+            )
+        if candidates is None:
+            candidates = self._search(vectorstore, namespaces, query, embedding)
+        return candidates
+
+    def _fetch(
+        self,
+        vectorstore: PGVector,
+        sql: str,
+        params: dict,
+        *,
+        ef_search: Optional[int] = None,
+    ) -> List[Any]:
+        with vectorstore._bind.begin() as conn:
+            if ef_search is not None:
+                # HNSW index scans return at most hnsw.ef_search rows, 40 by
+                # default, for this transaction only.
+                conn.execute(
+                    sqlalchemy.text(
+                        "SELECT set_config('hnsw.ef_search', :ef_search, true)"
+                    ),
+                    {"ef_search": str(ef_search)},
+                )
+            return conn.execute(sqlalchemy.text(sql), params).fetchall()
+
+    def _search(
+        self,
+        vectorstore: PGVector,
+        namespaces: List[str],
+        query: str,
+        embedding: List[float],
+    ) -> Tuple[List[Document], np.ndarray]:
+        params = self._search_params(vectorstore, namespaces, query, embedding)
+        if self.mode == SearchMode.HYBRID:
+            rows = self._fetch(vectorstore, _HYBRID_SEARCH_SQL, params)
+        elif (
+            self.quantization != Quantization.NONE
+            and len(embedding) == QUANTIZED_DIMENSIONS
+        ):
+            rows = self._fetch(
+                vectorstore,
+                _RESCORED_VECTOR_SEARCH_SQL[self.quantization],
+                params,
+                ef_search=params["rescore_k"],
+            )
+            if len(rows) < params["fetch_k"]:
+                # The index finds the nearest rows of the whole table, before
+                # they are filtered by namespace, so small namespaces sharing
+                # the table with large ones may get too few. They are cheap
+                # to search exactly.
+                rows = self._fetch(vectorstore, _VECTOR_SEARCH_SQL, params)
+        else:
+            rows = self._fetch(vectorstore, _VECTOR_SEARCH_SQL, params)
+        docs = [
+            Document(
+                page_content=document,
+                metadata={**(cmetadata or {}), "score": float(score)},
+            )
+            for document, cmetadata, score, _ in rows
+        ]
+        return docs, np.array([row[3] for row in rows], dtype=np.float32)
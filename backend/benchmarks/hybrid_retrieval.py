@@ -0,0 +1,183 @@
+"""Benchmark vector and hybrid retrieval on a synthetic corpus.
+
+Each synthetic chunk describes a few random topics and mentions a unique part
+number. Two kinds of queries are run against it:
+
+- exact: asks for a part number, which embeddings capture poorly.
+- semantic: restates the topics of a chunk in a different order.
+
+Embeddings are computed locally by hashing words, so no API key is needed.
+The benchmark needs a migrated Postgres database, configured with the usual
+POSTGRES_* environment variables, and writes to its own collection.
+
+Usage (from the backend directory):
+
+    poetry run python -m benchmarks.hybrid_retrieval --docs 5000 --queries 200
+"""
+import argparse
+import hashlib
+import math
+import os
+import random
+import re
+import statistics
+import time
+import uuid
+from typing import Dict, List, Tuple
+
+from langchain_community.vectorstores.pgvector import PGVector
+from langchain_core.embeddings import Embeddings
+
+from app.vectorstore import BulkPGVector, PGSearchRetriever, SearchMode
+
+COLLECTION_NAME = "benchmark_hybrid_retrieval"
+NAMESPACE = "benchmark"
+
+_TOPICS = (
+    "battery charging voltage thermal sensor firmware bootloader calibration "
+    "bearing lubrication spindle torque encoder motor inverter relay fuse "
+    "gasket valve pressure pump flow filter coolant radiator compressor "
+    "display backlight touchscreen driver memory cache bus controller "
+    "antenna signal bandwidth latency packet router switch cable connector "
+    "hinge bracket chassis panel screw fastener clamp weld alloy coating"
+).split()
+
+
+class HashingEmbeddings(Embeddings):
+    """Bag of words embeddings, hashed into a fixed number of dimensions.
+
+    Like dense embedding models, they barely tell identifiers apart: all
+    numbers share a dimension.
+    """
+
+    def __init__(self, dim: int = 256) -> None:
+        self.dim = dim
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dim
+        for word in re.findall(r"\w+", text.lower()):
+            if any(char.isdigit() for char in word):
+                word = "<number>"
+            digest = hashlib.md5(word.encode()).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.dim] += 1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+def _part_number(rng: random.Random) -> str:
+    letters = "".join(rng.choices("ABCDEFGHJKLMNPQRSTUVWXYZ", k=2))
+    return f"{letters}-{rng.randint(10000, 99999)}-{rng.choice('ABCDEF')}"
+
+
+def make_corpus(num_docs: int, seed: int) -> List[Tuple[str, List[str], str]]:
+    """Return (text, topics, part number) for each synthetic chunk."""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(num_docs):
+        topics = rng.sample(_TOPICS, 6)
+        part = _part_number(rng)
+        text = (
+            f"Maintenance note for part number {part}. "
+            f"Covers {', '.join(topics[:3])} and also {', '.join(topics[3:])}."
+        )
+        corpus.append((text, topics, part))
+    return corpus
+
+
+def make_queries(
+    corpus: List[Tuple[str, List[str], str]], num_queries: int, seed: int
+) -> Dict[str, List[Tuple[str, str]]]:
+    """Return (query, expected chunk text) pairs for each kind of query."""
+    rng = random.Random(seed)
+    exact, semantic = [], []
+    for text, topics, part in rng.sample(corpus, num_queries):
+        exact.append((f"Which note covers part {part}?", text))
+        shuffled = rng.sample(topics, len(topics))
+        semantic.append((f"notes about {' '.join(shuffled)}", text))
+    return {"exact": exact, "semantic": semantic}
+
+
+def ingest(vectorstore: BulkPGVector, corpus, batch_size: int = 500) -> None:
+    texts = [text for text, _, _ in corpus]
+    embeddings = vectorstore.embeddings.embed_documents(texts)
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start : start + batch_size]
+        vectorstore.add_embeddings(
+            texts=batch,
+            embeddings=embeddings[start : start + batch_size],
+            metadatas=[{"namespace": NAMESPACE} for _ in batch],
+            ids=[str(uuid.uuid4()) for _ in batch],
+        )
+
+
+def run(retriever: PGSearchRetriever, queries: List[Tuple[str, str]]) -> dict:
+    latencies, hits = [], 0
+    for query, expected in queries:
+        start = time.perf_counter()
+        docs = retriever.invoke(query)
+        latencies.append(time.perf_counter() - start)
+        hits += any(doc.page_content == expected for doc in docs)
+    latencies.sort()
+    return {
+        "recall": hits / len(queries),
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(0.95 * (len(latencies) - 1))] * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the benchmark collection."
+    )
+    args = parser.parse_args()
+
+    vectorstore = BulkPGVector(
+        connection_string=PGVector.connection_string_from_db_params(
+            driver="psycopg2",
+            host=os.environ["POSTGRES_HOST"],
+            port=int(os.environ["POSTGRES_PORT"]),
+            database=os.environ["POSTGRES_DB"],
+            user=os.environ["POSTGRES_USER"],
+            password=os.environ["POSTGRES_PASSWORD"],
+        ),
+        embedding_function=HashingEmbeddings(),
+        collection_name=COLLECTION_NAME,
+        pre_delete_collection=True,
+        use_jsonb=True,
+    )
+    corpus = make_corpus(args.docs, args.seed)
+    queries = make_queries(corpus, min(args.queries, args.docs), args.seed)
+    try:
+        start = time.perf_counter()
+        ingest(vectorstore, corpus)
+        print(f"Ingested {args.docs} chunks in {time.perf_counter() - start:.1f}s")
+
+        print(f"{'mode':<8} {'queries':<9} {'recall@k':>9} {'p50 ms':>8} {'p95 ms':>8}")
+        for mode in SearchMode:
+            retriever = PGSearchRetriever(
+                vectorstore=vectorstore, namespaces=[NAMESPACE], mode=mode, k=args.k
+            )
+            for kind, pairs in queries.items():
+                result = run(retriever, pairs)
+                print(
+                    f"{mode.value:<8} {kind:<9} {result['recall']:>9.3f} "
+                    f"{result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f}"
+                )
+    finally:
+        if not args.keep:
+            vectorstore.delete_collection()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Benchmark quantized candidate search against exact vector search.
+
+Random 1536-dimension embeddings are drawn around a few hundred cluster
+centers, so that each query has close neighbours. Recall@k is measured
+against an exact search computed with NumPy.
+
+The benchmark needs a Postgres database migrated to at least migration 7,
+configured with the usual POSTGRES_* environment variables, and writes to its
+own collection.
+
+Usage (from the backend directory):
+
+    poetry run python -m benchmarks.quantized_retrieval --docs 20000 --queries 100
+"""
+import argparse
+import os
+import statistics
+import time
+from typing import Dict, List
+
+import numpy as np
+from langchain_community.vectorstores.pgvector import PGVector
+from langchain_core.embeddings import Embeddings
+
+from app.quantization import QUANTIZED_DIMENSIONS, Quantization
+from app.vectorstore import BulkPGVector, PGSearchRetriever
+
+COLLECTION_NAME = "benchmark_quantized_retrieval"
+NAMESPACE = "benchmark"
+
+
+class LookupEmbeddings(Embeddings):
+    """Embeddings of the benchmark queries, looked up by query text."""
+
+    def __init__(self, vectors: Dict[str, List[float]]) -> None:
+        self.vectors = vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.vectors[text] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.vectors[text]
+
+
+def make_vectors(num: int, num_clusters: int, rng: np.random.Generator):
+    centers = rng.standard_normal((num_clusters, QUANTIZED_DIMENSIONS))
+    vectors = centers[rng.integers(num_clusters, size=num)] + 0.5 * rng.standard_normal(
+        (num, QUANTIZED_DIMENSIONS)
+    )
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def run(retriever: PGSearchRetriever, queries: Dict[str, List[int]]) -> dict:
+    latencies, recalls = [], []
+    for query, expected in queries.items():
+        start = time.perf_counter()
+        docs = retriever.invoke(query)
+        latencies.append(time.perf_counter() - start)
+        found = {int(doc.page_content.split()[-1]) for doc in docs}
+        recalls.append(len(found.intersection(expected)) / len(expected))
+    latencies.sort()
+    return {
+        "recall": statistics.mean(recalls),
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(0.95 * (len(latencies) - 1))] * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the benchmark collection."
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    corpus = make_vectors(args.docs, max(1, args.docs // 50), rng)
+    query_vectors = corpus[rng.choice(args.docs, args.queries, replace=False)]
+    noise = rng.standard_normal(query_vectors.shape) / np.sqrt(QUANTIZED_DIMENSIONS)
+    query_vectors = query_vectors + 0.5 * noise
+    exact = np.argsort(-(query_vectors @ corpus.T), axis=1)[:, : args.k]
+    queries = {f"query {i}": exact[i].tolist() for i in range(args.queries)}
+
+    vectorstore = BulkPGVector(
+        connection_string=PGVector.connection_string_from_db_params(
+            driver="psycopg2",
+            host=os.environ["POSTGRES_HOST"],
+            port=int(os.environ["POSTGRES_PORT"]),
+            database=os.environ["POSTGRES_DB"],
+            user=os.environ["POSTGRES_USER"],
+            password=os.environ["POSTGRES_PASSWORD"],
+        ),
+        embedding_function=LookupEmbeddings(
+            {query: query_vectors[i].tolist() for i, query in enumerate(queries)}
+        ),
+        collection_name=COLLECTION_NAME,
+        pre_delete_collection=True,
+        use_jsonb=True,
+    )
+    try:
+        start = time.perf_counter()
+        for offset in range(0, args.docs, 1000):
+            batch = corpus[offset : offset + 1000]
+            vectorstore.add_embeddings(
+                texts=[f"doc {offset + i}" for i in range(len(batch))],
+                embeddings=batch.tolist(),
+                metadatas=[{"namespace": NAMESPACE} for _ in range(len(batch))],
+            )
+        print(f"Ingested {args.docs} embeddings in {time.perf_counter() - start:.1f}s")
+
+        print(
+            f"{'search':<10} {'rescore':>8} {'recall@k':>9} {'p50 ms':>8} {'p95 ms':>8}"
+        )
+        for quantization in Quantization:
+            factors = [1] if quantization == Quantization.NONE else [1, 4, 10]
+            for factor in factors:
+                retriever = PGSearchRetriever(
+                    vectorstore=vectorstore,
+                    namespaces=[NAMESPACE],
+                    k=args.k,
+                    fetch_k=args.k,
+                    # Rank by relevance only, like the exact search.
+                    lambda_mult=1.0,
+                    quantization=quantization,
+                    rescore_factor=factor,
+                )
+                result = run(retriever, queries)
+                print(
+                    f"{quantization.value:<10} {factor:>8} {result['recall']:>9.3f} "
+                    f"{result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f}"
+                )
+    finally:
+        if not args.keep:
+            vectorstore.delete_collection()
+
+
+if __name__ == "__main__":
+    main()
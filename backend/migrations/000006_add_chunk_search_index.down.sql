@@ -0,0 +1,5 @@
+DROP INDEX IF EXISTS ix_langchain_pg_embedding_namespace;
+
+DROP INDEX IF EXISTS ix_langchain_pg_embedding_document_tsv;
+
+ALTER TABLE langchain_pg_embedding DROP COLUMN IF EXISTS document_tsv;
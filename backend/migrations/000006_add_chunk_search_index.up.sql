@@ -0,0 +1,33 @@
+-- The vectorstore tables are created by PGVector when the server starts,
+-- which is after the migrations have run on a fresh database.
+-- Create them here with the same schema so they can be indexed.
+CREATE TABLE IF NOT EXISTS langchain_pg_collection (
+    uuid UUID PRIMARY KEY,
+    name VARCHAR,
+    cmetadata JSON
+);
+
+CREATE TABLE IF NOT EXISTS langchain_pg_embedding (
+    uuid UUID PRIMARY KEY,
+    collection_id UUID REFERENCES langchain_pg_collection(uuid) ON DELETE CASCADE,
+    embedding VECTOR,
+    document VARCHAR,
+    cmetadata JSONB,
+    custom_id VARCHAR
+);
+
+CREATE INDEX IF NOT EXISTS ix_cmetadata_gin
+    ON langchain_pg_embedding USING gin (cmetadata jsonb_path_ops);
+
+-- Full-text search over chunk contents, used by hybrid retrieval.
+-- The text search configuration must match TEXT_SEARCH_CONFIG in app/vectorstore.py.
+ALTER TABLE langchain_pg_embedding
+    ADD COLUMN IF NOT EXISTS document_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('english', coalesce(document, ''))) STORED;
+
+CREATE INDEX IF NOT EXISTS ix_langchain_pg_embedding_document_tsv
+    ON langchain_pg_embedding USING gin (document_tsv);
+
+-- Retrieval filters chunks by the assistant or thread they were uploaded to.
+CREATE INDEX IF NOT EXISTS ix_langchain_pg_embedding_namespace
+    ON langchain_pg_embedding ((cmetadata->>'namespace'));
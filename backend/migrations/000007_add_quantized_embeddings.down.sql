@@ -0,0 +1,11 @@
+DROP INDEX IF EXISTS ix_langchain_pg_embedding_bit;
+
+DROP INDEX IF EXISTS ix_langchain_pg_embedding_half;
+
+DROP TRIGGER IF EXISTS langchain_pg_embedding_quantize ON langchain_pg_embedding;
+
+DROP FUNCTION IF EXISTS langchain_pg_embedding_quantize();
+
+ALTER TABLE langchain_pg_embedding
+    DROP COLUMN IF EXISTS embedding_bit,
+    DROP COLUMN IF EXISTS embedding_half;
@@ -0,0 +1,32 @@
+-- Quantized copies of the embeddings, searched to find candidates that are
+-- then rescored with the full precision embeddings. Only embeddings with the
+-- 1536 dimensions of the OpenAI embedding models are quantized, the indexes
+-- need a fixed number of dimensions.
+ALTER TABLE langchain_pg_embedding
+    ADD COLUMN IF NOT EXISTS embedding_half halfvec(1536),
+    ADD COLUMN IF NOT EXISTS embedding_bit bit(1536);
+
+CREATE OR REPLACE FUNCTION langchain_pg_embedding_quantize() RETURNS trigger AS $$
+BEGIN
+    IF NEW.embedding IS NOT NULL AND vector_dims(NEW.embedding) = 1536 THEN
+        NEW.embedding_half := NEW.embedding::halfvec(1536);
+        NEW.embedding_bit := binary_quantize(NEW.embedding)::bit(1536);
+    ELSE
+        NEW.embedding_half := NULL;
+        NEW.embedding_bit := NULL;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS langchain_pg_embedding_quantize ON langchain_pg_embedding;
+CREATE TRIGGER langchain_pg_embedding_quantize
+    BEFORE INSERT OR UPDATE OF embedding ON langchain_pg_embedding
+    FOR EACH ROW EXECUTE FUNCTION langchain_pg_embedding_quantize();
+
+-- Existing rows are quantized by `python -m app.quantization`, in batches.
+CREATE INDEX IF NOT EXISTS ix_langchain_pg_embedding_half
+    ON langchain_pg_embedding USING hnsw (embedding_half halfvec_cosine_ops);
+
+CREATE INDEX IF NOT EXISTS ix_langchain_pg_embedding_bit
+    ON langchain_pg_embedding USING hnsw (embedding_bit bit_hamming_ops);
@@ -0,0 +1,5 @@
+DROP INDEX IF EXISTS ix_langchain_pg_embedding_custom_id;
+
+DROP TABLE IF EXISTS reindex_job;
+
+DROP TABLE IF EXISTS namespace_embedding;
@@ -0,0 +1,30 @@
+-- The collection, and so the embedding model, searched for each namespace.
+-- Namespaces without a row use the default collection.
+CREATE TABLE IF NOT EXISTS namespace_embedding (
+    namespace VARCHAR(255) PRIMARY KEY,
+    collection_name VARCHAR NOT NULL,
+    model VARCHAR NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+);
+
+-- Re-embedding of the chunks of a namespace into another collection.
+CREATE TABLE IF NOT EXISTS reindex_job (
+    job_id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    namespace VARCHAR(255) NOT NULL,
+    source_collection VARCHAR NOT NULL,
+    target_collection VARCHAR NOT NULL,
+    model VARCHAR NOT NULL,
+    status VARCHAR(16) NOT NULL,
+    total_chunks INTEGER NOT NULL DEFAULT 0,
+    done_chunks INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC'),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+);
+
+-- At most one running job per namespace, looked up on every ingestion.
+CREATE UNIQUE INDEX IF NOT EXISTS ix_reindex_job_running
+    ON reindex_job (namespace) WHERE status = 'running';
+
+CREATE INDEX IF NOT EXISTS ix_langchain_pg_embedding_custom_id
+    ON langchain_pg_embedding (collection_id, custom_id);
@@ -0,0 +1,15 @@
+-- Files ingested into a namespace, and the ids of their chunks. A file is
+-- identified by its name within a namespace, so uploading it again replaces
+-- its chunks.
+CREATE TABLE IF NOT EXISTS document (
+    document_id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    namespace VARCHAR(255) NOT NULL,
+    source VARCHAR NOT NULL,
+    content_hash VARCHAR(64) NOT NULL,
+    chunk_ids TEXT[] NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC'),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_document_namespace_source
+    ON document (namespace, source);
@@ -0,0 +1,5 @@
+DROP INDEX IF EXISTS ix_thread_deleted_at;
+
+DELETE FROM thread WHERE deleted_at IS NOT NULL;
+
+ALTER TABLE thread DROP COLUMN IF EXISTS deleted_at;
@@ -0,0 +1,6 @@
+-- Deleted threads are hidden right away, and their data is removed in the
+-- background, see app/thread_gc.py.
+ALTER TABLE thread ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP WITH TIME ZONE;
+
+CREATE INDEX IF NOT EXISTS ix_thread_deleted_at
+    ON thread (deleted_at) WHERE deleted_at IS NOT NULL;
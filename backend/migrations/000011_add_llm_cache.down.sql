@@ -0,0 +1 @@
+DROP TABLE IF EXISTS llm_cache;
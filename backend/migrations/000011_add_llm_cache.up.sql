@@ -0,0 +1,10 @@
+-- Responses of the LLMs to the prompts of assistants that cache them, see
+-- app/llm_cache.py.
+CREATE TABLE IF NOT EXISTS llm_cache (
+    key VARCHAR(64) PRIMARY KEY,
+    response JSONB NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC'),
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_llm_cache_expires_at ON llm_cache (expires_at);
@@ -0,0 +1,10 @@
+-- Results of the search tools that declare a TTL, see app/tool_cache.py.
+CREATE TABLE IF NOT EXISTS tool_cache (
+    key VARCHAR(64) PRIMARY KEY,
+    tool VARCHAR(255) NOT NULL,
+    result JSONB NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC'),
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_tool_cache_expires_at ON tool_cache (expires_at);
@@ -0,0 +1,48 @@
+"""Test the selection of retrieved chunks for the prompt."""
+import numpy as np
+from langchain_core.documents import Document
+
+from app.context_packing import pack_context
+from app.tokens import count_tokens
+
+
+def _doc(text: str, source: str = "a.txt") -> Document:
+    return Document(page_content=text, metadata={"source": source})
+
+
+def test_mmr_skips_near_duplicates() -> None:
+    docs = [_doc("first"), _doc("first again"), _doc("other")]
+    embeddings = np.array([[1.0, 0.0], [1.0, 0.01], [0.6, 0.8]])
+    picked = pack_context(docs, embeddings, [0.9, 0.89, 0.5], k=2)
+    assert [doc.page_content for doc in picked] == ["first", "other"]
+
+
+def test_overlap_between_chunks_of_a_file_is_removed() -> None:
+    shared = "text shared by both chunks of the file"
+    docs = [
+        _doc(f"The start of the file. {shared}"),
+        _doc(f"{shared} and the end of the file."),
+        _doc(f"{shared} and the end of the file.", source="b.txt"),
+    ]
+    embeddings = np.array([[1.0, 0.0], [0.0, 1.0], [0.7, 0.7]])
+    picked = pack_context(docs, embeddings, [1.0, 0.9, 0.1], k=3)
+    assert [doc.page_content for doc in picked] == [
+        f"The start of the file. {shared}",
+        " and the end of the file.",
+        f"{shared} and the end of the file.",
+    ]
+
+
+def test_chunks_contained_in_picked_chunks_are_skipped() -> None:
+    docs = [_doc("a long chunk that contains the other one"), _doc("the other one")]
+    embeddings = np.array([[1.0, 0.0], [0.0, 1.0]])
+    picked = pack_context(docs, embeddings, [1.0, 0.5], k=2)
+    assert len(picked) == 1
+
+
+def test_chunks_are_packed_within_the_token_budget() -> None:
+    docs = [_doc("short one", "a.txt"), _doc("long " * 100, "b.txt"), _doc("tiny", "c")]
+    embeddings = np.eye(3)
+    budget = count_tokens("short one") + count_tokens("tiny")
+    picked = pack_context(docs, embeddings, [1.0, 0.9, 0.8], k=3, max_tokens=budget)
+    assert [doc.page_content for doc in picked] == ["short one", "tiny"]
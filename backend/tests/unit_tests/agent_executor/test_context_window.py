@@ -0,0 +1,123 @@
+"""Test fitting the thread history into a token budget."""
+from typing import Any, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+    ToolMessage,
+)
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langgraph.checkpoint.memory import MemorySaver
+
+from app.chatbot import get_chatbot_executor
+from app.context_window import SUMMARY_MESSAGE_ID, window_messages
+
+
+class RecordingChatModel(BaseChatModel):
+    """Chat model that records its prompts and numbers its replies."""
+
+    prompts: List[List[BaseMessage]] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "recording"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        self.prompts.append(messages)
+        if "Progressively summarize" in messages[0].content:
+            content = f"summary {len(self.prompts)}"
+        else:
+            content = f"reply {len(self.prompts)}"
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content))])
+
+
+def _turn(i: int, tool: bool = False) -> List[BaseMessage]:
+    messages: List[Any] = [HumanMessage(content=f"question {i} " * 20, id=f"h{i}")]
+    if tool:
+        call = {"name": "search", "args": {"query": "x"}, "id": f"call{i}"}
+        messages.append(AIMessage(content="", tool_calls=[call], id=f"c{i}"))
+        messages.append(ToolMessage(content="result " * 20, tool_call_id=f"call{i}"))
+    messages.append(AIMessage(content=f"answer {i} " * 20, id=f"a{i}"))
+    return messages
+
+
+def test_history_within_budget_is_kept() -> None:
+    messages = _turn(0) + _turn(1)
+    summary, folded, kept = window_messages(messages, max_tokens=10000)
+    assert summary is None
+    assert folded == []
+    assert kept == messages
+
+
+def test_old_turns_are_folded_whole() -> None:
+    messages = _turn(0, tool=True) + _turn(1, tool=True) + _turn(2) + _turn(3)
+    _, folded, kept = window_messages(messages, max_tokens=200)
+    assert [m.id for m in folded if m.id] == [
+        "h0",
+        "c0",
+        "a0",
+        "h1",
+        "c1",
+        "a1",
+        "h2",
+        "a2",
+    ]
+    assert [m.tool_call_id for m in folded if isinstance(m, ToolMessage)] == [
+        "call0",
+        "call1",
+    ]
+    assert [m.id for m in kept] == ["h3", "a3"]
+
+
+def test_last_turn_is_always_kept() -> None:
+    messages = _turn(0) + _turn(1, tool=True)
+    _, folded, kept = window_messages(messages, max_tokens=10)
+    assert [m.id for m in folded] == ["h0", "a0"]
+    assert kept == messages[2:]
+
+
+def test_summarized_turns_are_not_folded_again() -> None:
+    summary = SystemMessage(
+        content="earlier", id=SUMMARY_MESSAGE_ID, additional_kwargs={}
+    )
+    summary.additional_kwargs["summarized_until"] = "a0"
+    messages = _turn(0) + [summary] + _turn(1) + _turn(2)
+    current, folded, kept = window_messages(messages, max_tokens=100)
+    assert current is summary
+    assert [m.id for m in folded] == ["h1", "a1"]
+    assert [m.id for m in kept] == ["h2", "a2"]
+
+
+async def test_chatbot_keeps_a_rolling_summary() -> None:
+    llm = RecordingChatModel(prompts=[])
+    app = get_chatbot_executor(
+        llm, "You are a helpful assistant.", MemorySaver(), context_max_tokens=150
+    )
+    config = {"configurable": {"thread_id": "1"}}
+    for i in range(4):
+        await app.ainvoke([HumanMessage(content=f"question {i} " * 20)], config)
+
+    state = (await app.aget_state(config)).values
+    summaries = [m for m in state if m.id == SUMMARY_MESSAGE_ID]
+    assert len(summaries) == 1
+    summary_prompts = [
+        p for p in llm.prompts if "Progressively summarize" in p[0].content
+    ]
+    assert summary_prompts
+    # Each turn is summarized once, on top of the previous summary.
+    for turn in range(3):
+        assert sum(f"question {turn}" in p[0].content for p in summary_prompts) <= 1
+
+    last_prompt = llm.prompts[-1]
+    assert isinstance(last_prompt[0], SystemMessage)
+    assert summaries[0].content in last_prompt[0].content
+    assert not any(m.id == SUMMARY_MESSAGE_ID for m in last_prompt)
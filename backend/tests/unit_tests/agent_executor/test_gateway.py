@@ -0,0 +1,147 @@
+"""Test the gateway of the calls to LLM providers."""
+import asyncio
+from types import SimpleNamespace
+from typing import AsyncIterator, Dict, List, Optional
+
+import pytest
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+
+from app.gateway import (
+    QUEUE_DEPTH,
+    REJECTIONS,
+    RETRIES,
+    GatewayLimits,
+    ProviderGateway,
+    ProviderUnavailableError,
+    retry_after,
+    with_gateway,
+)
+
+
+class StatusError(Exception):
+    def __init__(self, status_code: int, headers: Optional[Dict] = None) -> None:
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+def _gateway(name: str, **limits) -> ProviderGateway:
+    return ProviderGateway("test", name, GatewayLimits(**limits))
+
+
+def _call(outcomes: List, attempts: List[int]):
+    """Return a call failing with, or yielding, the outcomes in turn."""
+
+    async def call() -> AsyncIterator[str]:
+        attempts.append(1)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        for chunk in outcome:
+            yield chunk
+
+    return call
+
+
+async def _collect(gateway: ProviderGateway, call) -> List[str]:
+    return [chunk async for chunk in gateway.stream(call)]
+
+
+def test_retry_after() -> None:
+    assert retry_after(StatusError(429, {"retry-after": "2"})) == 2
+    assert retry_after(StatusError(429, {"retry-after-ms": "150"})) == 0.15
+    assert retry_after(StatusError(429)) is None
+
+
+async def test_rate_limited_calls_are_retried() -> None:
+    gateway = _gateway("retried")
+    attempts: List[int] = []
+    outcomes = [StatusError(429, {"retry-after": "0.01"}), ["a", "b"]]
+    assert await _collect(gateway, _call(outcomes, attempts)) == ["a", "b"]
+    assert len(attempts) == 2
+    assert RETRIES.value(provider="test", model="retried") == 1
+
+
+async def test_client_errors_are_not_retried() -> None:
+    gateway = _gateway("client_error")
+    attempts: List[int] = []
+    with pytest.raises(StatusError):
+        await _collect(gateway, _call([StatusError(400), ["a"]], attempts))
+    assert len(attempts) == 1
+
+
+async def test_streamed_calls_are_not_retried() -> None:
+    gateway = _gateway("streamed")
+    attempts: List[int] = []
+
+    async def call() -> AsyncIterator[str]:
+        attempts.append(1)
+        yield "a"
+        raise StatusError(503)
+
+    with pytest.raises(StatusError):
+        await _collect(gateway, call)
+    assert len(attempts) == 1
+
+
+async def test_retries_are_limited_by_the_budget() -> None:
+    gateway = _gateway("budget", retry_budget=0, max_retries=100)
+    gateway._budget._balance = 2
+    attempts: List[int] = []
+    outcomes = [StatusError(503, {"retry-after": "0"}) for _ in range(10)]
+    with pytest.raises(StatusError):
+        await _collect(gateway, _call(outcomes, attempts))
+    assert len(attempts) == 3
+
+
+async def test_circuit_opens_after_consecutive_failures() -> None:
+    gateway = _gateway("circuit", max_retries=0, circuit_failures=2, circuit_reset=0.05)
+    attempts: List[int] = []
+    outcomes = [StatusError(500), StatusError(500), ["a"]]
+    for _ in range(2):
+        with pytest.raises(StatusError):
+            await _collect(gateway, _call(outcomes, attempts))
+
+    with pytest.raises(ProviderUnavailableError):
+        await _collect(gateway, _call(outcomes, attempts))
+    assert len(attempts) == 2
+    assert REJECTIONS.value(provider="test", model="circuit", reason="circuit_open")
+
+    await asyncio.sleep(0.05)
+    assert await _collect(gateway, _call(outcomes, attempts)) == ["a"]
+
+
+async def test_calls_beyond_the_queue_are_rejected() -> None:
+    gateway = _gateway("queue", max_in_flight=1, max_queue=1)
+    release = asyncio.Event()
+
+    async def call() -> AsyncIterator[str]:
+        await release.wait()
+        yield "a"
+
+    running = asyncio.create_task(_collect(gateway, call))
+    queued = asyncio.create_task(_collect(gateway, call))
+    await asyncio.sleep(0.01)
+    assert QUEUE_DEPTH.value(provider="test", model="queue") == 1
+    with pytest.raises(ProviderUnavailableError):
+        await _collect(gateway, call)
+    assert REJECTIONS.value(provider="test", model="queue", reason="queue_full") == 1
+
+    release.set()
+    assert await asyncio.gather(running, queued) == [["a"], ["a"]]
+    assert QUEUE_DEPTH.value(provider="test", model="queue") == 0
+
+
+async def test_models_are_only_called_asynchronously() -> None:
+    """Sync calls would bypass the limits of the gateway."""
+    llm = with_gateway(
+        GenericFakeChatModel(messages=iter([AIMessage("a"), AIMessage("b")])),
+        "test",
+        "sync",
+    )
+    with pytest.raises(NotImplementedError):
+        llm.invoke("hi")
+    with pytest.raises(NotImplementedError):
+        list(llm.stream("hi"))
+    assert (await llm.ainvoke("hi")).content == "a"
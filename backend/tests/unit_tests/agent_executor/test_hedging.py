@@ -0,0 +1,91 @@
+"""Test hedging slow LLM calls."""
+import asyncio
+from typing import Any, AsyncIterator, List, Optional
+
+import pytest
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk
+
+from app.hedging import HEDGE_WINS, HEDGES, HedgedChatModel
+
+
+class DelayedChatModel(BaseChatModel):
+    """Streams `answer` after `delay` seconds, or fails if `fail`."""
+
+    answer: str
+    delay: float = 0
+    fail: bool = False
+    started: int = 0
+    cancelled: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return self.answer
+
+    def _generate(self, messages: List[BaseMessage], stop=None, **kwargs: Any):
+        raise NotImplementedError
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        self.started += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.fail:
+            raise ConnectionError("provider is down")
+        for word in self.answer.split(" "):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word))
+
+
+async def test_fast_calls_are_not_hedged() -> None:
+    primary = DelayedChatModel(answer="primary")
+    hedge = DelayedChatModel(answer="hedge")
+    hedges = HEDGES.value(model="primary")
+    llm = HedgedChatModel(inner=primary, hedge=hedge, hedge_after=0.05)
+    assert (await llm.ainvoke("question")).content == "primary"
+    assert hedge.started == 0
+    assert HEDGES.value(model="primary") == hedges
+
+
+async def test_slow_calls_are_hedged_and_the_loser_cancelled() -> None:
+    primary = DelayedChatModel(answer="slow", delay=1)
+    hedge = DelayedChatModel(answer="fast")
+    wins = HEDGE_WINS.value(model="slow", winner="hedge")
+    llm = HedgedChatModel(inner=primary, hedge=hedge, hedge_after=0.01)
+    assert (await llm.ainvoke("question")).content == "fast"
+    await asyncio.sleep(0)
+    assert primary.cancelled == 1
+    assert HEDGE_WINS.value(model="slow", winner="hedge") == wins + 1
+
+
+async def test_primary_can_win_after_hedging() -> None:
+    primary = DelayedChatModel(answer="primary", delay=0.02)
+    hedge = DelayedChatModel(answer="hedge", delay=1)
+    llm = HedgedChatModel(inner=primary, hedge=hedge, hedge_after=0.01)
+    assert (await llm.ainvoke("question")).content == "primary"
+    await asyncio.sleep(0)
+    assert hedge.started == 1
+    assert hedge.cancelled == 1
+
+
+async def test_failed_primary_falls_back_to_the_hedge() -> None:
+    primary = DelayedChatModel(answer="primary", fail=True)
+    hedge = DelayedChatModel(answer="hedge")
+    llm = HedgedChatModel(inner=primary, hedge=hedge, hedge_after=10)
+    assert (await llm.ainvoke("question")).content == "hedge"
+
+
+async def test_error_of_the_primary_is_raised_when_both_fail() -> None:
+    primary = DelayedChatModel(answer="primary", fail=True)
+    hedge = DelayedChatModel(answer="hedge", fail=True)
+    llm = HedgedChatModel(inner=primary, hedge=hedge, hedge_after=10)
+    with pytest.raises(ConnectionError):
+        await llm.ainvoke("question")
@@ -0,0 +1,127 @@
+"""Test the HTTP clients shared by the clients of LLM providers."""
+import asyncio
+from typing import AsyncIterator
+
+import httpx
+import pytest
+from langchain_anthropic import ChatAnthropic
+
+from app import llms
+from app.http_clients import (
+    HTTP_MAX_CONNECTIONS,
+    POOL_CONNECTIONS,
+    PREWARMED,
+    close_http_clients,
+    get_async_http_client,
+    get_http_client,
+    prewarm_http_clients,
+)
+from app.metrics import METRICS
+
+
+@pytest.fixture
+async def server_url() -> AsyncIterator[str]:
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Answer each request, keeping the connection open.
+        try:
+            while await reader.readuntil(b"\r\n\r\n"):
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    host, port = server.sockets[0].getsockname()[:2]
+    yield f"http://{host}:{port}"
+    await close_http_clients()
+    server.close()
+
+
+async def test_clients_are_shared_per_proxy() -> None:
+    client = get_async_http_client()
+    assert get_async_http_client() is client
+    assert get_async_http_client("http://proxy:8080") is not client
+    assert get_http_client() is get_http_client()
+    assert client._transport._pool._max_connections == HTTP_MAX_CONNECTIONS
+
+    await close_http_clients()
+
+
+async def test_closed_clients_can_still_be_used(server_url: str) -> None:
+    """Models keep the clients they were created with, closing drops only the
+    connections."""
+    client = get_async_http_client()
+    sync_client = get_http_client()
+    await client.get(server_url)
+    await asyncio.to_thread(sync_client.get, server_url)
+
+    await close_http_clients()
+    assert not client.is_closed and not sync_client.is_closed
+    assert client._transport._pool.connections == []
+    assert sync_client._transport._pool.connections == []
+    assert get_async_http_client() is client
+
+    assert (await client.get(server_url)).status_code == 200
+    response = await asyncio.to_thread(sync_client.get, server_url)
+    assert response.status_code == 200
+
+
+async def test_prewarm_opens_connections(server_url: str) -> None:
+    await prewarm_http_clients([server_url], connections=3)
+
+    host = "127.0.0.1"
+    assert PREWARMED.value(host=host) == 3
+    METRICS.render()
+    assert POOL_CONNECTIONS.value(state="idle", client="async", proxy="") == 3
+    assert POOL_CONNECTIONS.value(state="active", client="async", proxy="") == 0
+
+    # Requests reuse the prewarmed connections.
+    response = await get_async_http_client().get(server_url)
+    assert response.status_code == 200
+    METRICS.render()
+    assert POOL_CONNECTIONS.value(state="idle", client="async", proxy="") == 3
+
+
+async def test_prewarm_failures_are_logged() -> None:
+    # Nothing listens on the port, the server starts nonetheless.
+    await prewarm_http_clients(["http://127.0.0.1:1"], connections=2)
+    await close_http_clients()
+
+
+async def test_anthropic_model_uses_the_shared_clients(monkeypatch) -> None:
+    requests = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        requests.append(request.url.path)
+        return httpx.Response(
+            200,
+            json={
+                "id": "msg_1",
+                "type": "message",
+                "role": "assistant",
+                "model": "claude-3-haiku-20240307",
+                "content": [{"type": "text", "text": "hi"}],
+                "stop_reason": "end_turn",
+                "stop_sequence": None,
+                "usage": {"input_tokens": 1, "output_tokens": 1},
+            },
+        )
+
+    transport = httpx.MockTransport(handle)
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+    monkeypatch.setattr(
+        llms, "get_http_client", lambda: httpx.Client(transport=transport)
+    )
+    monkeypatch.setattr(
+        llms, "get_async_http_client", lambda: httpx.AsyncClient(transport=transport)
+    )
+    llms.get_anthropic_llm.cache_clear()
+    try:
+        model = llms.get_anthropic_llm()
+        while not isinstance(model, ChatAnthropic):
+            model = model.inner
+        assert model.invoke("hi").content == "hi"
+        assert (await model.ainvoke("hi")).content == "hi"
+    finally:
+        llms.get_anthropic_llm.cache_clear()
+    assert requests == ["/v1/messages", "/v1/messages"]
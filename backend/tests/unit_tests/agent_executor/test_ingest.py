@@ -0,0 +1,205 @@
+"""Test the ingestion pipeline."""
+import threading
+from typing import Any, Dict, List, Optional
+
+import pytest
+from langchain.text_splitter import CharacterTextSplitter
+from langchain_community.document_loaders import Blob
+from langchain_core.embeddings import Embeddings
+
+from app.ingest import ingest_blob
+from app.parsing import MIMETYPE_BASED_PARSER
+from tests.unit_tests.utils import InMemoryVectorStore
+
+
+class BatchLimitedEmbeddings(Embeddings):
+    """Embeddings that reject requests with more than `max_inputs` texts."""
+
+    def __init__(self, max_inputs: int) -> None:
+        self.max_inputs = max_inputs
+        self.calls: List[int] = []
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self._lock:
+            self.calls.append(len(texts))
+        if len(texts) > self.max_inputs:
+            raise ValueError("Too many inputs. The max number of inputs is 2.")
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return [float(len(text))]
+
+
+class EmbeddingVectorStore(InMemoryVectorStore):
+    """In-memory vectorstore that accepts precomputed embeddings."""
+
+    def __init__(self, embeddings: Embeddings) -> None:
+        super().__init__()
+        self._embeddings = embeddings
+        self.vectors: Dict[str, List[float]] = {}
+        self.ids: List[str] = []
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embeddings
+
+    def add_embeddings(
+        self,
+        texts: List[str],
+        embeddings: List[List[float]],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        # Use the texts as ids to make the write order easy to check.
+        for text, embedding in zip(texts, embeddings):
+            self.vectors[text] = embedding
+        if ids is not None:
+            self.ids.extend(ids)
+        return list(texts)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> None:
+        self.ids = [id_ for id_ in self.ids if id_ not in (ids or [])]
+
+
+def _blob(num_chunks: int) -> Blob:
+    text = "\n\n".join(f"chunk {i}" for i in range(num_chunks))
+    return Blob.from_data(text, path="test.txt", mime_type="text/plain")
+
+
+def test_ingest_blob_preserves_chunk_order() -> None:
+    """Batches are embedded concurrently but written in document order."""
+    embeddings = BatchLimitedEmbeddings(max_inputs=100)
+    vectorstore = EmbeddingVectorStore(embeddings)
+    ids = ingest_blob(
+        _blob(25),
+        MIMETYPE_BASED_PARSER,
+        CharacterTextSplitter(chunk_size=5, chunk_overlap=0),
+        vectorstore,
+        "namespace",
+        batch_size=3,
+        embedding_concurrency=4,
+    )
+    assert ids == [f"chunk {i}" for i in range(25)]
+    assert sorted(embeddings.calls) == sorted([3] * 8 + [1])
+
+
+def test_ingest_blob_reports_chunks_as_they_are_written() -> None:
+    progress: List[int] = []
+    ingest_blob(
+        _blob(7),
+        MIMETYPE_BASED_PARSER,
+        CharacterTextSplitter(chunk_size=5, chunk_overlap=0),
+        EmbeddingVectorStore(BatchLimitedEmbeddings(max_inputs=100)),
+        "namespace",
+        batch_size=3,
+        on_progress=progress.append,
+    )
+    assert progress == [3, 6, 7]
+
+
+def test_ingest_blob_splits_batches_over_provider_limits() -> None:
+    """Batches that exceed the provider limits are split until they fit."""
+    embeddings = BatchLimitedEmbeddings(max_inputs=2)
+    vectorstore = EmbeddingVectorStore(embeddings)
+    ids = ingest_blob(
+        _blob(8),
+        MIMETYPE_BASED_PARSER,
+        CharacterTextSplitter(chunk_size=5, chunk_overlap=0),
+        vectorstore,
+        "namespace",
+        batch_size=8,
+    )
+    assert ids == [f"chunk {i}" for i in range(8)]
+    assert embeddings.calls == [8, 4, 2, 2, 4, 2, 2]
+
+
+def test_ingest_blob_raises_embedding_errors() -> None:
+    """Errors that are not about the batch size are not retried."""
+
+    class BrokenEmbeddings(BatchLimitedEmbeddings):
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            raise RuntimeError("invalid api key")
+
+    with pytest.raises(RuntimeError):
+        ingest_blob(
+            _blob(4),
+            MIMETYPE_BASED_PARSER,
+            CharacterTextSplitter(chunk_size=5, chunk_overlap=0),
+            EmbeddingVectorStore(BrokenEmbeddings(max_inputs=2)),
+            "namespace",
+            batch_size=2,
+        )
+
+
+def test_ingest_blob_writes_mirrors_with_the_same_ids() -> None:
+    """Mirrors get every chunk, embedded with their own embeddings."""
+
+    class DoubleEmbeddings(BatchLimitedEmbeddings):
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            return [[2 * float(len(text))] for text in texts]
+
+    vectorstore = EmbeddingVectorStore(BatchLimitedEmbeddings(max_inputs=100))
+    mirror = EmbeddingVectorStore(DoubleEmbeddings(max_inputs=100))
+    ingest_blob(
+        _blob(5),
+        MIMETYPE_BASED_PARSER,
+        CharacterTextSplitter(chunk_size=5, chunk_overlap=0),
+        vectorstore,
+        "namespace",
+        batch_size=2,
+        embedding_concurrency=2,
+        mirrors=[mirror],
+    )
+    assert mirror.ids == vectorstore.ids
+    assert len(set(mirror.ids)) == 5
+    assert mirror.vectors["chunk 0"] == [14.0]
+    assert vectorstore.vectors["chunk 0"] == [7.0]
+
+
+def test_ingest_blob_ignores_mirror_errors() -> None:
+    """A failing mirror does not fail the ingestion."""
+
+    class BrokenEmbeddings(BatchLimitedEmbeddings):
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            raise RuntimeError("invalid api key")
+
+    ids = ingest_blob(
+        _blob(4),
+        MIMETYPE_BASED_PARSER,
+        CharacterTextSplitter(chunk_size=5, chunk_overlap=0),
+        EmbeddingVectorStore(BatchLimitedEmbeddings(max_inputs=100)),
+        "namespace",
+        batch_size=2,
+        mirrors=[EmbeddingVectorStore(BrokenEmbeddings(max_inputs=100))],
+    )
+    assert ids == [f"chunk {i}" for i in range(4)]
+
+
+def test_ingest_blob_deletes_written_chunks_on_failure() -> None:
+    """Chunks of a failed ingestion are not left behind, in the mirrors too."""
+
+    class FailingEmbeddings(BatchLimitedEmbeddings):
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            if "chunk 4" in texts:
+                raise RuntimeError("invalid api key")
+            return super().embed_documents(texts)
+
+    vectorstore = EmbeddingVectorStore(FailingEmbeddings(max_inputs=100))
+    mirror = EmbeddingVectorStore(BatchLimitedEmbeddings(max_inputs=100))
+    progress: List[int] = []
+    with pytest.raises(RuntimeError):
+        ingest_blob(
+            _blob(6),
+            MIMETYPE_BASED_PARSER,
+            CharacterTextSplitter(chunk_size=5, chunk_overlap=0),
+            vectorstore,
+            "namespace",
+            batch_size=2,
+            mirrors=[mirror],
+            on_progress=progress.append,
+        )
+    assert progress == [2, 4]
+    assert vectorstore.ids == []
+    assert mirror.ids == []
@@ -0,0 +1,79 @@
+import threading
+import time
+from typing import Any, List
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.document_loaders import Blob
+from langchain_core.runnables import RunnableLambda
+
+from app.jobs import IngestJobManager
+from app.schema import IngestJob, IngestJobStatus
+from app.upload import IngestRunnable
+from tests.unit_tests.utils import InMemoryVectorStore
+
+
+def _wait_for_job(manager: IngestJobManager, user_id: str, job_id: str) -> IngestJob:
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        job = manager.get(user_id, job_id)
+        if job.status in (IngestJobStatus.SUCCEEDED, IngestJobStatus.FAILED):
+            return job
+        time.sleep(0.01)
+    raise AssertionError("Ingestion job did not finish in time")
+
+
+def test_ingest_job_reports_per_file_progress() -> None:
+    """Jobs run off the request path and record chunk counts per file."""
+    manager = IngestJobManager(max_workers=1, max_retained_jobs=10)
+    runnable = IngestRunnable(
+        text_splitter=RecursiveCharacterTextSplitter(),
+        vectorstore=InMemoryVectorStore(),
+        assistant_id="TheParrot",
+    )
+    blobs = [
+        Blob.from_data(b"first file", path="first.txt", mime_type="text/plain"),
+        Blob.from_data(b"\x00\x01", path="second.bin", mime_type="application/x"),
+    ]
+    try:
+        job = manager.submit("user", runnable, blobs, {})
+        assert [f.name for f in job.files] == ["first.txt", "second.bin"]
+
+        job = _wait_for_job(manager, "user", job.job_id)
+        assert job.status == IngestJobStatus.FAILED
+        assert job.files[0].status == IngestJobStatus.SUCCEEDED
+        assert job.files[0].chunks == 1
+        assert job.files[1].status == IngestJobStatus.FAILED
+        assert job.files[1].error is not None
+
+        # Jobs are only visible to the user that submitted them.
+        assert manager.get("someone-else", job.job_id) is None
+    finally:
+        manager.shutdown()
+
+
+def test_shutdown_cleans_up_queued_jobs() -> None:
+    """The blobs of jobs cancelled before they started are cleaned up."""
+    manager = IngestJobManager(max_workers=1, max_retained_jobs=10)
+    started, release = threading.Event(), threading.Event()
+
+    def block(blob: Blob, **kwargs: Any) -> List[str]:
+        started.set()
+        release.wait(5)
+        return []
+
+    cleaned: List[str] = []
+    blobs = [Blob.from_data(b"", path=f"{i}.txt") for i in range(2)]
+    try:
+        for blob in blobs:
+            manager.submit(
+                "user",
+                RunnableLambda(block),
+                [blob],
+                {},
+                cleanup=lambda blob: cleaned.append(blob.source),
+            )
+        assert started.wait(5)
+        manager.shutdown()
+        assert cleaned == ["1.txt"]
+    finally:
+        release.set()
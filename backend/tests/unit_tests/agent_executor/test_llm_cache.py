@@ -0,0 +1,91 @@
+"""Test the cache of LLM responses."""
+from typing import List
+
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langgraph.checkpoint.memory import MemorySaver
+
+from app.chatbot import get_chatbot_executor
+from app.llm_cache import HITS, MISSES, CachedChatModel, LLMCache, cache_key
+from app.stream import astream_state
+
+
+def _cached(*responses: str) -> CachedChatModel:
+    inner = GenericFakeChatModel(
+        messages=iter([AIMessage(content=response) for response in responses])
+    )
+    cache = LLMCache(ttl=60, max_entries=10, get_pool=lambda: None)
+    return CachedChatModel(inner=inner, response_cache=cache)
+
+
+def test_key_ignores_ids() -> None:
+    call = {"name": "search", "args": {"query": "x"}}
+    first = [
+        HumanMessage(content="question", id="1"),
+        AIMessage(content="", tool_calls=[{**call, "id": "a"}], id="2"),
+        ToolMessage(content="result", tool_call_id="a", id="3"),
+    ]
+    second = [
+        HumanMessage(content="question", id="4"),
+        AIMessage(content="", tool_calls=[{**call, "id": "b"}], id="5"),
+        ToolMessage(content="result", tool_call_id="b", id="6"),
+    ]
+    assert cache_key("model", first) == cache_key("model", second)
+    assert cache_key("model", first) != cache_key("other model", first)
+    assert cache_key("model", first) != cache_key("model", first[:1])
+
+
+async def test_identical_prompts_are_answered_from_the_cache() -> None:
+    llm = _cached("first", "second")
+    hits = HITS.value(tier="memory")
+    misses = MISSES.value()
+
+    first = await llm.ainvoke([HumanMessage(content="question", id="1")])
+    again = await llm.ainvoke([HumanMessage(content="question", id="2")])
+    other = await llm.ainvoke([HumanMessage(content="other question")])
+
+    assert [first.content, again.content, other.content] == [
+        "first",
+        "first",
+        "second",
+    ]
+    assert first.id != again.id
+    assert HITS.value(tier="memory") == hits + 1
+    assert MISSES.value() == misses + 2
+
+
+async def test_expired_responses_are_not_used() -> None:
+    llm = _cached("first", "second")
+    llm.response_cache.ttl = 0
+    await llm.ainvoke("question")
+    assert (await llm.ainvoke("question")).content == "second"
+
+
+async def _stream(app, thread_id: str) -> List[BaseMessage]:
+    streamed = []
+    async for chunk in astream_state(
+        app,
+        [HumanMessage(content="question")],
+        {"configurable": {"thread_id": thread_id}},
+    ):
+        if isinstance(chunk, list):
+            streamed.extend(chunk)
+    return streamed
+
+
+async def test_hits_are_streamed() -> None:
+    app = get_chatbot_executor(
+        _cached("the answer"),
+        "You are a helpful assistant.",
+        MemorySaver(),
+        context_max_tokens=0,
+    )
+    first = await _stream(app, "1")
+    second = await _stream(app, "2")
+
+    for streamed in (first, second):
+        answers = {m.id for m in streamed if m.type in ("ai", "AIMessageChunk")}
+        # The run of the inner model is not streamed.
+        assert len(answers) == 1
+        assert streamed[-1].content == "the answer"
+    assert first[-1].id != second[-1].id
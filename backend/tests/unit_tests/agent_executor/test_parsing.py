@@ -1,10 +1,18 @@
 """Test parsing logic."""
 import mimetypes
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
 
+import pytest
 from langchain_community.document_loaders import Blob
 
-from app.parsing import MIMETYPE_BASED_PARSER, SUPPORTED_MIMETYPES
-from tests.unit_tests.fixtures import get_sample_paths
+from app.parsing import (
+    MIMETYPE_BASED_PARSER,
+    SUPPORTED_MIMETYPES,
+    ParsingError,
+    ProcessPoolParser,
+)
+from tests.unit_tests.fixtures import HERE, get_sample_paths
 
 
 def test_list_of_supported_mimetypes() -> None:
@@ -39,3 +47,76 @@ def test_attempt_to_parse_each_fixture() -> None:
 
     known_missing = {"application/msword"}
     assert set(SUPPORTED_MIMETYPES) - known_missing == seen_mimetypes
+
+
+def test_process_pool_parser_matches_in_process_parser() -> None:
+    """Parsing in worker processes yields the same documents."""
+    parser = ProcessPoolParser(
+        max_workers=1,
+        cpu_time_limit=30,
+        memory_limit=0,
+        pdf_pages_per_task=1,
+    )
+    try:
+        for path in get_sample_paths():
+            type_, _ = mimetypes.guess_type(path)
+            if type_ not in SUPPORTED_MIMETYPES or type_ == "application/msword":
+                continue
+            blob = Blob.from_path(path)
+            documents = parser.parse(blob)
+            expected = MIMETYPE_BASED_PARSER.parse(blob)
+            assert [d.page_content for d in documents] == [
+                d.page_content for d in expected
+            ], f"Failed to parse {path}"
+    finally:
+        parser.shutdown()
+
+
+def test_process_pool_parser_splits_large_pdfs_into_page_ranges() -> None:
+    """Large PDFs are parsed in page ranges, yielded in page order."""
+    parser = ProcessPoolParser(
+        max_workers=2,
+        cpu_time_limit=30,
+        memory_limit=0,
+        pdf_pages_per_task=2,
+    )
+    blob = Blob.from_path(HERE / "multipage.pdf")
+    try:
+        documents = parser.parse(blob)
+    finally:
+        parser.shutdown()
+
+    # Each page is a document, as when the PDF is parsed in one piece.
+    assert [d.metadata for d in documents] == [
+        d.metadata for d in MIMETYPE_BASED_PARSER.parse(blob)
+    ]
+    assert [d.metadata["page"] for d in documents] == ["0", "1", "2", "3", "4"]
+    for i, document in enumerate(documents):
+        assert f"Page {i + 1} of the multipage sample" in document.page_content
+
+
+def test_broken_pool_is_only_replaced_once() -> None:
+    """A thread seeing a broken pool does not shut down its replacement."""
+    parser = ProcessPoolParser(
+        max_workers=1,
+        cpu_time_limit=30,
+        memory_limit=0,
+        pdf_pages_per_task=1,
+    )
+    broken = parser._get_executor()
+    future = Future()
+    parser._executors[future] = broken
+    future.set_exception(BrokenProcessPool("A worker died"))
+    blob = Blob.from_data(b"", path="x.pdf")
+    try:
+        with pytest.raises(ParsingError):
+            parser._result(future, blob)
+        replacement = parser._get_executor()
+        assert replacement is not broken
+
+        # Another thread waiting on a task of the broken pool fails too.
+        with pytest.raises(ParsingError):
+            parser._result(future, blob)
+        assert parser._get_executor() is replacement
+    finally:
+        parser.shutdown()
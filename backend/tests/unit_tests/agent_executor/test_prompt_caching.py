@@ -0,0 +1,106 @@
+"""Test marking the stable prefix of prompts for provider prompt caching."""
+from typing import Any, Dict, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langgraph.checkpoint.memory import MemorySaver
+
+from app.chatbot import get_chatbot_executor
+from app.gateway import with_gateway
+from app.prompt_caching import (
+    CACHED_INPUT_TOKENS,
+    INPUT_TOKENS,
+    cached_system_message,
+    with_prompt_caching,
+)
+
+
+class RecordingChatModel(BaseChatModel):
+    """Chat model that records its calls and reports cached input tokens."""
+
+    calls: List[Dict[str, Any]] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "recording"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        self.calls.append({"messages": messages, **kwargs})
+        message = AIMessage(
+            content="reply",
+            usage_metadata={
+                "input_tokens": 1200,
+                "output_tokens": 10,
+                "total_tokens": 1210,
+                "input_token_details": {"cache_read": 1000, "cache_creation": 0},
+            },
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+async def test_system_prefix_and_tools_are_cache_breakpoints() -> None:
+    model = RecordingChatModel(calls=[])
+    tools = [{"name": "search"}, {"name": "fetch"}]
+    llm = with_prompt_caching(model).bind(tools=tools)
+
+    await llm.ainvoke(
+        [cached_system_message("Instructions.", "\n\nDocuments."), HumanMessage("hi")]
+    )
+
+    [call] = model.calls
+    assert call["messages"][0].content == [
+        {
+            "type": "text",
+            "text": "Instructions.",
+            "cache_control": {"type": "ephemeral"},
+        },
+        {"type": "text", "text": "\n\nDocuments."},
+    ]
+    assert call["messages"][1:] == [HumanMessage("hi")]
+    assert call["tools"] == [
+        {"name": "search"},
+        {"name": "fetch", "cache_control": {"type": "ephemeral"}},
+    ]
+    # The tools bound to the assistant are left untouched.
+    assert tools[-1] == {"name": "fetch"}
+
+
+async def test_summary_is_sent_after_the_cached_prefix() -> None:
+    model = RecordingChatModel(calls=[])
+    app = get_chatbot_executor(
+        with_prompt_caching(model),
+        "Be helpful.",
+        MemorySaver(),
+        context_max_tokens=200,
+    )
+    config = {"configurable": {"thread_id": "1"}}
+    for i in range(4):
+        await app.ainvoke([HumanMessage(f"question {i} " * 20)], config)
+
+    blocks = model.calls[-1]["messages"][0].content
+    assert blocks[0] == {
+        "type": "text",
+        "text": "Be helpful.",
+        "cache_control": {"type": "ephemeral"},
+    }
+    assert blocks[1]["text"].startswith("\n\nSummary of the earlier conversation:")
+
+
+async def test_cached_input_tokens_are_counted() -> None:
+    llm = with_gateway(RecordingChatModel(calls=[]), "test", "prompt-caching")
+
+    response = await llm.ainvoke([HumanMessage("hi")])
+
+    labels = {"provider": "test", "model": "prompt-caching"}
+    assert INPUT_TOKENS.value(**labels) == 1200
+    assert CACHED_INPUT_TOKENS.value(kind="cache_read", **labels) == 1000
+    assert CACHED_INPUT_TOKENS.value(kind="cache_creation", **labels) == 0
+    # The usage stays on the message of the run.
+    assert response.usage_metadata["input_token_details"]["cache_read"] == 1000
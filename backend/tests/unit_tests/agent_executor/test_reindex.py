@@ -0,0 +1,51 @@
+"""Test the routing of namespaces to the collection of their embedding model."""
+from typing import Dict, List, Sequence
+
+from app.reindex import EmbeddingRouter, Route
+
+
+class FakeVectorStore:
+    def __init__(self, collection_name: str) -> None:
+        self.collection_name = collection_name
+
+
+class InMemoryRouter(EmbeddingRouter):
+    """Router that reads the routes from a dict instead of Postgres."""
+
+    def __init__(self, routes: Dict[str, Route], **kwargs) -> None:
+        super().__init__(
+            FakeVectorStore("langchain"),
+            lambda collection_name, model: FakeVectorStore(collection_name),
+            **kwargs,
+        )
+        self.routes = routes
+        self.fetches: List[List[str]] = []
+
+    def _fetch_routes(self, namespaces: Sequence[str]) -> Dict[str, Route]:
+        self.fetches.append(list(namespaces))
+        return {namespace: self.routes.get(namespace) for namespace in namespaces}
+
+
+def test_search_targets_groups_namespaces_by_collection() -> None:
+    router = InMemoryRouter({"thread": ("langchain:new", "new")}, ttl=30)
+    targets = router.search_targets(["assistant", "thread"])
+    assert [(store.collection_name, group) for store, group in targets] == [
+        ("langchain", ["assistant"]),
+        ("langchain:new", ["thread"]),
+    ]
+
+    router.search_targets(["assistant", "thread"])
+    assert router.fetches == [["assistant", "thread"]]
+
+
+def test_invalidate_refetches_route() -> None:
+    router = InMemoryRouter({}, ttl=30)
+    router.search_targets(["assistant", "thread"])
+    router.routes["thread"] = ("langchain:new", "new")
+    router.invalidate("thread")
+    targets = router.search_targets(["assistant", "thread"])
+    assert router.fetches == [["assistant", "thread"], ["thread"]]
+    assert [store.collection_name for store, _ in targets] == [
+        "langchain",
+        "langchain:new",
+    ]
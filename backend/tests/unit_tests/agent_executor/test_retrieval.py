@@ -0,0 +1,187 @@
+"""Test the retrieval executor."""
+import json
+from typing import List
+
+import pytest
+
+from langchain_core.documents import Document
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.retrievers import BaseRetriever
+from langgraph.checkpoint.memory import MemorySaver
+
+from app.retrieval import QueryRewrite, _is_self_contained, get_retrieval_executor
+from app.stream import astream_state, to_sse
+
+
+class RecordingRetriever(BaseRetriever):
+    queries: List[str] = []
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None):
+        self.queries.append(query)
+        return [Document(page_content=query)]
+
+
+def test_is_self_contained() -> None:
+    assert _is_self_contained("How do I configure a Postgres checkpointer?")
+    assert not _is_self_contained("How does it handle state?")
+    assert not _is_self_contained("And for Azure?")
+    assert not _is_self_contained("Why?")
+
+
+async def _run(query_rewrite: QueryRewrite, follow_up: str, rewrite: str) -> List[str]:
+    retriever = RecordingRetriever(queries=[])
+    llm = GenericFakeChatModel(
+        messages=iter([AIMessage(content="first"), AIMessage(content="second")])
+    )
+    rewrite_llm = GenericFakeChatModel(messages=iter([AIMessage(content=rewrite)]))
+    executor = get_retrieval_executor(
+        llm,
+        retriever,
+        "You are a helpful assistant.",
+        MemorySaver(),
+        query_rewrite=query_rewrite,
+        rewrite_llm=rewrite_llm,
+    )
+    config = {"configurable": {"thread_id": "thread"}}
+    await executor.ainvoke(
+        {"messages": [HumanMessage(content="What is LangGraph?")]}, config
+    )
+    output = await executor.ainvoke(
+        {"messages": [HumanMessage(content=follow_up)]}, config
+    )
+    assert output["messages"][-1].content == "second"
+    return retriever.queries
+
+
+async def test_heuristic_skips_rewrite_for_self_contained_questions() -> None:
+    queries = await _run(
+        QueryRewrite.HEURISTIC,
+        "How do I configure a Postgres checkpointer?",
+        "postgres checkpointer",
+    )
+    assert queries == [
+        "What is LangGraph?",
+        "How do I configure a Postgres checkpointer?",
+    ]
+
+
+async def test_speculative_reuses_results_when_rewrite_matches() -> None:
+    queries = await _run(
+        QueryRewrite.SPECULATIVE,
+        "How does it handle state?",
+        "how does it handle state",
+    )
+    assert queries == ["What is LangGraph?", "How does it handle state?"]
+
+
+async def test_speculative_retrieves_rewritten_query() -> None:
+    queries = await _run(
+        QueryRewrite.SPECULATIVE, "How does it handle state?", "LangGraph state"
+    )
+    assert queries[-1] == "LangGraph state"
+
+
+async def test_retrieved_documents_are_streamed_before_the_answer() -> None:
+    llm = GenericFakeChatModel(messages=iter([AIMessage(content="the answer")]))
+    executor = get_retrieval_executor(
+        llm,
+        RecordingRetriever(queries=[]),
+        "You are a helpful assistant.",
+        MemorySaver(),
+    )
+    events = [
+        event
+        async for event in to_sse(
+            astream_state(
+                executor,
+                {"messages": [HumanMessage(content="What is LangGraph?")]},
+                {"configurable": {"thread_id": "thread"}},
+            )
+        )
+    ]
+    names = [event["event"] for event in events]
+    assert "retrieval" in names
+    retrieval = json.loads(events[names.index("retrieval")]["data"])
+    assert retrieval["query"] == "What is LangGraph?"
+    assert retrieval["documents"] == [
+        {
+            "source": None,
+            "title": None,
+            "score": None,
+            "snippet": "What is LangGraph?",
+        }
+    ]
+    # The answer is streamed after the documents.
+    answer_events = [
+        i
+        for i, event in enumerate(events)
+        if event["event"] == "data" and "the answer" in event["data"]
+    ]
+    assert answer_events and names.index("retrieval") < answer_events[0]
+
+
+async def test_answer_is_streamed_as_tokens() -> None:
+    llm = GenericFakeChatModel(messages=iter([AIMessage(content="the final answer")]))
+    executor = get_retrieval_executor(
+        llm,
+        RecordingRetriever(queries=[]),
+        "You are a helpful assistant.",
+        MemorySaver(),
+    )
+    chunks = [
+        event["data"]["chunk"].content
+        async for event in executor.astream_events(
+            {"messages": [HumanMessage(content="What is LangGraph?")]},
+            {"configurable": {"thread_id": "thread"}},
+            version="v1",
+        )
+        if event["event"] == "on_chat_model_stream"
+    ]
+    assert len(chunks) > 1
+    assert "".join(chunks) == "the final answer"
+
+
+@pytest.mark.parametrize(
+    "rewrite, query",
+    [
+        ("LangGraph state", "LangGraph state"),
+        ("how does it handle state", "how does it handle state"),
+    ],
+)
+async def test_speculative_streams_only_the_retrieval_used(
+    rewrite: str, query: str
+) -> None:
+    retriever = RecordingRetriever(queries=[])
+    executor = get_retrieval_executor(
+        GenericFakeChatModel(
+            messages=iter([AIMessage(content="first"), AIMessage(content="second")])
+        ),
+        retriever,
+        "You are a helpful assistant.",
+        MemorySaver(),
+        query_rewrite=QueryRewrite.SPECULATIVE,
+        rewrite_llm=GenericFakeChatModel(messages=iter([AIMessage(content=rewrite)])),
+    )
+    config = {"configurable": {"thread_id": "thread"}}
+    await executor.ainvoke(
+        {"messages": [HumanMessage(content="What is LangGraph?")]}, config
+    )
+    events = [
+        event
+        async for event in to_sse(
+            astream_state(
+                executor,
+                {"messages": [HumanMessage(content="How does it handle state?")]},
+                config,
+            )
+        )
+    ]
+
+    # The message itself was searched for, but the client only hears about
+    # the search the answer is based on.
+    assert "How does it handle state?" in retriever.queries
+    retrievals = [
+        json.loads(event["data"]) for event in events if event["event"] == "retrieval"
+    ]
+    assert [retrieval["query"] for retrieval in retrievals] == [query]
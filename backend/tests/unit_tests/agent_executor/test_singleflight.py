@@ -0,0 +1,140 @@
+"""Test sharing identical concurrent calls."""
+import asyncio
+from typing import Any, AsyncIterator, List, Optional
+
+import pytest
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_core.tools import tool
+from langgraph.prebuilt import ToolExecutor, ToolInvocation
+
+from app.singleflight import FOLLOWERS, SingleFlight, SingleFlightChatModel, invoke_tool
+
+
+class SlowChatModel(BaseChatModel):
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "slow"
+
+    def _generate(self, messages: List[BaseMessage], stop=None, **kwargs: Any):
+        raise NotImplementedError
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        self.calls += 1
+        for word in ("the ", "answer"):
+            await asyncio.sleep(0.01)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word))
+
+
+async def test_concurrent_calls_share_one_call() -> None:
+    flights = SingleFlight("test")
+    calls = []
+
+    async def call(value: str) -> str:
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value.upper()
+
+    followers = FOLLOWERS.value(group="test")
+    results = await asyncio.gather(
+        flights.do("a", lambda: call("a")),
+        flights.do("a", lambda: call("a")),
+        flights.do("b", lambda: call("b")),
+    )
+    assert results == ["A", "A", "B"]
+    assert calls == ["a", "b"]
+    assert FOLLOWERS.value(group="test") == followers + 1
+    # Calls made after the first one finished are not shared.
+    assert await flights.do("a", lambda: call("a")) == "A"
+    assert calls == ["a", "b", "a"]
+
+
+async def test_late_followers_get_every_chunk() -> None:
+    flights = SingleFlight("test")
+
+    async def chunks() -> AsyncIterator[int]:
+        for i in range(3):
+            await asyncio.sleep(0.01)
+            yield i
+
+    async def collect() -> List[int]:
+        return [chunk async for chunk in flights.stream("key", chunks)]
+
+    first = asyncio.create_task(collect())
+    await asyncio.sleep(0.015)
+    assert await asyncio.gather(first, collect()) == [[0, 1, 2], [0, 1, 2]]
+
+
+async def test_errors_are_shared() -> None:
+    flights = SingleFlight("test")
+
+    async def fail() -> None:
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    results = await asyncio.gather(
+        flights.do("key", fail), flights.do("key", fail), return_exceptions=True
+    )
+    assert [type(result) for result in results] == [ValueError, ValueError]
+
+
+async def test_call_is_cancelled_with_its_last_caller() -> None:
+    flights = SingleFlight("test")
+    cancelled = asyncio.Event()
+
+    async def call() -> None:
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    first = asyncio.create_task(flights.do("key", call))
+    second = asyncio.create_task(flights.do("key", call))
+    await asyncio.sleep(0.01)
+    first.cancel()
+    await asyncio.sleep(0.01)
+    assert not cancelled.is_set()
+    second.cancel()
+    await asyncio.wait_for(cancelled.wait(), 1)
+    with pytest.raises(asyncio.CancelledError):
+        await second
+
+
+async def test_chat_model_calls_are_shared() -> None:
+    inner = SlowChatModel()
+    llm = SingleFlightChatModel(inner=inner, flights=SingleFlight("test"))
+    first, second = await asyncio.gather(
+        llm.ainvoke("question"), llm.ainvoke("question")
+    )
+    assert first.content == second.content == "the answer"
+    assert first.id != second.id
+    assert inner.calls == 1
+
+
+async def test_tool_calls_are_shared() -> None:
+    calls = []
+
+    @tool
+    async def search(query: str) -> str:
+        """Search for the query."""
+        calls.append(query)
+        await asyncio.sleep(0.01)
+        return f"results for {query}"
+
+    executor = ToolExecutor([search])
+    action = ToolInvocation(tool="search", tool_input={"query": "x"})
+    results = await asyncio.gather(
+        invoke_tool(executor, action), invoke_tool(executor, action)
+    )
+    assert results == ["results for x", "results for x"]
+    assert calls == ["x"]
@@ -0,0 +1,195 @@
+"""Test the cache of the results of search tools."""
+import threading
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.tools import StructuredTool
+from langgraph.prebuilt import ToolExecutor, ToolInvocation
+
+from app.agent_types import xml_agent
+from app.agent_types.tools_agent import _run_results
+from app.message_types import LiberalFunctionMessage
+from app.singleflight import invoke_tool
+from app.tool_cache import (
+    HITS,
+    TOOL_RESULT_CACHE,
+    ToolResultCache,
+    cached_results,
+    result_ttl,
+    tool_result_key,
+)
+from app.tool_executors import get_tool_pool, run_tool
+
+
+def _search_tool(name: str, ttl=None):
+    calls = []
+
+    def factory():
+        def search(query: str) -> str:
+            calls.append(query)
+            return f"results for {query} #{len(calls)}"
+
+        return StructuredTool.from_function(search, name=name, description="Search.")
+
+    return (cached_results(ttl=ttl)(factory) if ttl else factory)(), calls
+
+
+def _cache() -> ToolResultCache:
+    return ToolResultCache(enabled=True, max_entries=10, get_pool=lambda: None)
+
+
+def test_key_normalizes_spacing() -> None:
+    assert tool_result_key("search", {"query": " llm  caching "}) == tool_result_key(
+        "search", {"query": "llm caching"}
+    )
+    assert tool_result_key("search", "x") != tool_result_key("other", "x")
+
+
+def test_ttl_is_declared_by_the_factory(monkeypatch) -> None:
+    tool, _ = _search_tool("declared_search", ttl=60)
+    uncached, _ = _search_tool("uncached_search")
+
+    assert result_ttl(tool) == 60
+    assert result_ttl(uncached) == 0
+    monkeypatch.setenv("TOOL_CACHE_TTL_DECLARED_SEARCH", "5")
+    assert result_ttl(tool) == 5
+
+
+async def test_results_are_cached_per_tool_and_input() -> None:
+    cache = _cache()
+    tool, calls = _search_tool("cached_search", ttl=60)
+
+    async def call(query: str):
+        return await cache.get_or_call(
+            tool, {"query": query}, lambda: tool.ainvoke(query)
+        )
+
+    assert await call("a") == "results for a #1"
+    assert await call("a ") == "results for a #1"
+    assert await call("b") == "results for b #2"
+    assert calls == ["a", "b"]
+    assert HITS.value(tool="cached_search", tier="memory") == 1
+
+
+async def test_tools_without_ttl_are_not_cached() -> None:
+    cache = _cache()
+    tool, calls = _search_tool("side_effect")
+
+    for _ in range(2):
+        await cache.get_or_call(tool, "a", lambda: tool.ainvoke("a"))
+    assert calls == ["a", "a"]
+
+
+async def test_error_results_are_not_cached() -> None:
+    cache = _cache()
+    results = ["Search exception: rate limited", "results"]
+
+    def search(query: str) -> str:
+        return results.pop(0)
+
+    tool = cached_results(ttl=60, error_pattern="Search exception: ")(
+        lambda: StructuredTool.from_function(
+            search, name="flaky_search", description="Search."
+        )
+    )()
+
+    for expected in ["Search exception: rate limited", "results", "results"]:
+        assert await cache.get_or_call(tool, "a", lambda: tool.ainvoke("a")) == expected
+    assert results == []
+
+
+async def test_timed_out_calls_are_not_cached() -> None:
+    release = threading.Event()
+    calls = []
+
+    def slow(query: str) -> str:
+        calls.append(query)
+        release.wait(5)
+        return "late"
+
+    tool = cached_results(ttl=60)(
+        lambda: StructuredTool.from_function(slow, name="slow_cached", description=".")
+    )()
+    get_tool_pool("slow_cached").timeout = 0.05
+    try:
+        assert (await run_tool(tool, "a")).startswith("Error: slow_cached")
+        release.set()
+        get_tool_pool("slow_cached").timeout = 5
+        assert await run_tool(tool, "a") == "late"
+    finally:
+        release.set()
+        TOOL_RESULT_CACHE.clear()
+    assert calls == ["a", "a"]
+
+
+async def test_calls_made_earlier_in_the_run_are_reused() -> None:
+    tool, calls = _search_tool("run_search", ttl=60)
+    uncached, uncached_calls = _search_tool("run_action")
+    call = {"name": "run_search", "args": {"query": "a"}, "id": "1"}
+    action_call = {"name": "run_action", "args": {"query": "a"}, "id": "2"}
+    messages = [
+        HumanMessage("first question"),
+        AIMessage("", tool_calls=[{**call, "id": "0"}]),
+        ToolMessage("from the previous run", tool_call_id="0"),
+        HumanMessage("second question"),
+        AIMessage("", tool_calls=[call, action_call]),
+        ToolMessage("earlier result", tool_call_id="1"),
+        ToolMessage("earlier action", tool_call_id="2"),
+    ]
+    executor = ToolExecutor([tool, uncached])
+    run_results = _run_results(messages)
+
+    assert (
+        await invoke_tool(
+            executor,
+            ToolInvocation(tool="run_search", tool_input={"query": "a"}),
+            run_results,
+        )
+        == "earlier result"
+    )
+    assert calls == []
+    assert HITS.value(tool="run_search", tier="run") == 1
+    # Tools without a TTL may have side effects, they are called again.
+    await invoke_tool(
+        executor,
+        ToolInvocation(tool="run_action", tool_input={"query": "a"}),
+        run_results,
+    )
+    assert uncached_calls == ["a"]
+
+
+def test_xml_agent_reuses_calls_made_earlier_in_the_run() -> None:
+    tool, _ = _search_tool("xml_search", ttl=60)
+    messages = [
+        HumanMessage("question"),
+        AIMessage("<tool>xml_search</tool><tool_input>a"),
+        LiberalFunctionMessage(content="earlier result", name="xml_search"),
+        AIMessage("<tool>xml_search</tool><tool_input>a"),
+    ]
+
+    assert xml_agent._run_results(messages).get(tool, "a") == (
+        True,
+        "earlier result",
+    )
+    assert xml_agent._run_results(messages + [HumanMessage("next")]).get(tool, "a") == (
+        False,
+        None,
+    )
+
+
+def test_failed_calls_made_earlier_in_the_run_are_not_reused() -> None:
+    tool, _ = _search_tool("failed_search", ttl=60)
+    call = {"name": "failed_search", "args": {"query": "a"}, "id": "1"}
+    timeout = "Error: failed_search did not respond within 60 seconds."
+    messages = [
+        HumanMessage("question"),
+        AIMessage("", tool_calls=[call]),
+        ToolMessage(timeout, tool_call_id="1"),
+    ]
+    assert _run_results(messages).get(tool, {"query": "a"}) == (False, None)
+
+    messages = [
+        HumanMessage("question"),
+        AIMessage("<tool>failed_search</tool><tool_input>a"),
+        LiberalFunctionMessage(content=timeout, name="failed_search"),
+    ]
+    assert xml_agent._run_results(messages).get(tool, "a") == (False, None)
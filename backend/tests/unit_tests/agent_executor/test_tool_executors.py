@@ -0,0 +1,107 @@
+"""Test the workers and deadlines of tool calls."""
+import asyncio
+import threading
+import time
+from typing import List
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.tools import StructuredTool, create_retriever_tool, tool
+
+from app.tool_executors import (
+    CALLS,
+    QUEUE_SECONDS,
+    RUN_SECONDS,
+    ToolPool,
+    _is_blocking,
+)
+
+
+class SyncRetriever(BaseRetriever):
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return [Document(page_content=threading.current_thread().name)]
+
+
+def test_tools_without_async_implementation_are_blocking() -> None:
+    @tool
+    def sync_search(query: str) -> str:
+        """Search."""
+        return query
+
+    @tool
+    async def async_search(query: str) -> str:
+        """Search."""
+        return query
+
+    retriever_tool = create_retriever_tool(SyncRetriever(), "wikipedia", "Search.")
+
+    assert _is_blocking(sync_search)
+    assert not _is_blocking(async_search)
+    assert _is_blocking(retriever_tool)
+
+
+async def test_blocking_tools_run_in_their_own_threads() -> None:
+    @tool
+    def thread_name(query: str) -> str:
+        """Return the name of the thread running the tool."""
+        return threading.current_thread().name
+
+    retriever_tool = create_retriever_tool(SyncRetriever(), "threads", "Search.")
+
+    assert (await ToolPool("thread_name", 2, 5).run(thread_name, "x")).startswith(
+        "tool-thread_name"
+    )
+    assert "tool-threads" in await ToolPool("threads", 2, 5).run(retriever_tool, "x")
+    assert CALLS.value(tool="thread_name", outcome="ok") == 1
+
+
+async def test_slow_calls_time_out_without_blocking_other_tools() -> None:
+    release = threading.Event()
+
+    def slow(query: str) -> str:
+        release.wait(5)
+        return "late"
+
+    slow_tool = StructuredTool.from_function(slow, name="slow", description="Slow.")
+    fast_tool = StructuredTool.from_function(
+        lambda query: "fast", name="fast", description="Fast."
+    )
+    slow_pool = ToolPool("slow", 1, 0.1)
+
+    try:
+        results = await asyncio.gather(
+            slow_pool.run(slow_tool, "x"),
+            slow_pool.run(slow_tool, "y"),
+            ToolPool("fast", 1, 1).run(fast_tool, "x"),
+        )
+    finally:
+        release.set()
+        slow_pool.shutdown()
+
+    assert results[0].startswith("Error: slow did not respond within 0.1 seconds")
+    assert results[1].startswith("Error: slow")
+    assert results[2] == "fast"
+    assert CALLS.value(tool="slow", outcome="timeout") == 2
+
+
+async def test_queue_time_is_measured_apart_from_run_time() -> None:
+    @tool
+    async def bounded(query: str) -> str:
+        """Sleep a bit."""
+        await asyncio.sleep(0.05)
+        return query
+
+    pool = ToolPool("bounded", 1, 5)
+    started = time.monotonic()
+    assert await asyncio.gather(pool.run(bounded, "a"), pool.run(bounded, "b")) == [
+        "a",
+        "b",
+    ]
+
+    # The calls ran one after the other, the second one waited for the first.
+    assert time.monotonic() - started >= 0.1
+    assert RUN_SECONDS.value(tool="bounded") >= 0.1
+    assert QUEUE_SECONDS.value(tool="bounded") >= 0.05
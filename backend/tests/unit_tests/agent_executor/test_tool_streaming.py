@@ -0,0 +1,136 @@
+"""Test streaming the results of parallel tool calls as they complete."""
+import asyncio
+import json
+from typing import Any, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.tools import tool
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.utils import runnable
+
+from app.agent_types.tools_agent import get_tools_agent_executor
+from app.stream import astream_state, to_sse
+
+
+class ToolCallingModel(BaseChatModel):
+    """Chat model that calls both tools, then answers."""
+
+    @property
+    def _llm_type(self) -> str:
+        return "tool-calling"
+
+    def bind_tools(self, tools: Any, **kwargs: Any) -> "ToolCallingModel":
+        return self
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if messages[-1].type == "tool":
+            message = AIMessage(content="the answer")
+        else:
+            message = AIMessage(
+                content="",
+                tool_calls=[
+                    {"name": "slow_lookup", "args": {"query": "a"}, "id": "slow"},
+                    {"name": "fast_lookup", "args": {"query": "a"}, "id": "fast"},
+                ],
+            )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+@tool
+async def slow_lookup(query: str) -> str:
+    """Look up slowly."""
+    await asyncio.sleep(0.2)
+    return "slow result"
+
+
+@tool
+async def fast_lookup(query: str) -> str:
+    """Look up quickly."""
+    return "fast result"
+
+
+async def test_tool_results_are_streamed_as_they_complete() -> None:
+    executor = get_tools_agent_executor(
+        [slow_lookup, fast_lookup],
+        ToolCallingModel(),
+        "You are a helpful assistant.",
+        False,
+        MemorySaver(),
+    )
+    events = [
+        event
+        async for event in to_sse(
+            astream_state(
+                executor,
+                [HumanMessage(content="question")],
+                {"configurable": {"thread_id": "thread"}},
+            )
+        )
+    ]
+
+    def index(name: str, predicate=lambda data: True) -> int:
+        return next(
+            i
+            for i, event in enumerate(events)
+            if event["event"] == name and predicate(json.loads(event["data"]))
+        )
+
+    def tool_call(tool_call_id: str):
+        return lambda data: data["tool_call_id"] == tool_call_id
+
+    def tool_message(content: str):
+        return lambda data: any(m.get("content") == content for m in data)
+
+    # Both calls start before either finishes.
+    assert index("tool_start", tool_call("fast")) < index("tool_end", tool_call("fast"))
+    assert index("tool_start", tool_call("slow")) < index("tool_end", tool_call("fast"))
+    # The fast result is streamed before the slow call finishes.
+    assert index("data", tool_message("fast result")) < index(
+        "tool_end", tool_call("slow")
+    )
+    slow_end = json.loads(events[index("tool_end", tool_call("slow"))]["data"])
+    assert slow_end["tool"] == "slow_lookup"
+    assert slow_end["duration"] >= 0.2
+
+    # The streamed messages are the ones saved in the thread.
+    state = await executor.aget_state({"configurable": {"thread_id": "thread"}})
+    streamed = json.loads(events[index("data", tool_message("slow result"))]["data"])
+    saved = [m for m in state.values if m.type == "tool"]
+    assert [m.content for m in saved] == ["slow result", "fast result"]
+    assert streamed[0]["id"] in {m.id for m in saved}
+    assert saved[0].response_metadata["duration"] >= 0.2
+
+
+async def test_tool_calls_are_streamed_without_context_propagation(
+    monkeypatch,
+) -> None:
+    """Before Python 3.11, tasks don't inherit the config of the node."""
+    monkeypatch.setattr(runnable, "ASYNCIO_ACCEPTS_CONTEXT", False)
+    executor = get_tools_agent_executor(
+        [slow_lookup, fast_lookup],
+        ToolCallingModel(),
+        "You are a helpful assistant.",
+        False,
+        MemorySaver(),
+    )
+    events = [
+        event
+        async for event in to_sse(
+            astream_state(
+                executor,
+                [HumanMessage(content="question")],
+                {"configurable": {"thread_id": "thread"}},
+            )
+        )
+    ]
+
+    ends = [json.loads(e["data"]) for e in events if e["event"] == "tool_end"]
+    assert sorted(end["tool_call_id"] for end in ends) == ["fast", "slow"]
@@ -1,9 +1,23 @@
+import os
 from io import BytesIO
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
-from fastapi import UploadFile
+import pytest
+from fastapi import FastAPI, UploadFile
+from httpx import ASGITransport, AsyncClient
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-from app.upload import IngestRunnable, _guess_mimetype, convert_ingestion_input_to_blob
+from app.documents import DocumentRecord, DocumentRegistry
+from app import upload
+from app.upload import (
+    FileTooLargeError,
+    IngestRunnable,
+    UploadSizeLimitMiddleware,
+    _default_embedding_model,
+    _guess_mimetype,
+    convert_ingestion_input_to_blob,
+    release_blob,
+)
 from tests.unit_tests.fixtures import get_sample_paths
 from tests.unit_tests.utils import InMemoryVectorStore
 
@@ -26,10 +40,90 @@ def test_ingestion_runnable() -> None:
 
     # Convert the file to blob
     blob = convert_ingestion_input_to_blob(file)
-    ids = runnable.invoke(blob)
+    try:
+        ids = runnable.invoke(blob)
+    finally:
+        release_blob(blob)
     assert len(ids) == 1
 
 
+def test_upload_is_spooled_to_disk() -> None:
+    """Uploads are handed to parsers as path-backed blobs."""
+    file = UploadFile(filename="testfile.pdf", file=BytesIO(b"%PDF-1.4 data"))
+    blob = convert_ingestion_input_to_blob(file)
+    assert blob.data is None
+    assert blob.source == "testfile.pdf"
+    assert blob.mimetype == "application/pdf"
+    assert blob.as_bytes() == b"%PDF-1.4 data"
+
+    release_blob(blob)
+    assert not os.path.exists(blob.path)
+
+
+def test_upload_size_limit(tmp_path, monkeypatch) -> None:
+    """Files over the size limit are rejected and leave nothing behind."""
+    monkeypatch.setattr(upload, "UPLOAD_SPOOL_DIR", str(tmp_path))
+    file = UploadFile(filename="big.txt", file=BytesIO(b"x" * 100))
+    with pytest.raises(FileTooLargeError):
+        convert_ingestion_input_to_blob(file, max_size=10)
+    assert os.listdir(tmp_path) == []
+
+
+async def test_upload_requests_over_the_limit_are_rejected() -> None:
+    """Requests are rejected before their body is spooled."""
+    app = FastAPI()
+    app.add_middleware(UploadSizeLimitMiddleware, max_size=1000)
+    received = []
+
+    @app.post("/upload")
+    async def upload_file(file: UploadFile) -> dict:
+        received.append(await file.read())
+        return {}
+
+    async def chunked(data: bytes) -> AsyncIterator[bytes]:
+        yield data
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        small = await client.post("/upload", files={"file": ("a.txt", b"x")})
+        large = await client.post("/upload", files={"file": ("b.txt", b"x" * 2000)})
+        # Without a Content-Length, the body is counted as it is received.
+        body = (
+            b"--boundary\r\n"
+            b'Content-Disposition: form-data; name="file"; filename="c.txt"\r\n\r\n'
+            + b"x" * 2000
+            + b"\r\n--boundary--\r\n"
+        )
+        streamed = await client.post(
+            "/upload",
+            content=chunked(body),
+            headers={"Content-Type": "multipart/form-data; boundary=boundary"},
+        )
+        malformed = await client.post(
+            "/upload",
+            content=body,
+            headers={
+                "Content-Type": "multipart/form-data; boundary=boundary",
+                "Content-Length": "many",
+            },
+        )
+
+    assert small.status_code == 200
+    assert large.status_code == 413
+    assert streamed.status_code == 413
+    assert malformed.status_code == 400
+    assert received == [b"x"]
+
+
+def test_default_embedding_model_of_each_provider(monkeypatch) -> None:
+    monkeypatch.setenv("AZURE_OPENAI_EMBEDDINGS_DEPLOYMENT_NAME", "my-deployment")
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    assert _default_embedding_model() == "text-embedding-ada-002"
+    monkeypatch.delenv("OPENAI_API_KEY")
+    assert _default_embedding_model() == "my-deployment"
+
+
 def test_mimetype_guessing() -> None:
     """Verify mimetype guessing for all fixtures."""
     name_to_mime = {}
@@ -48,3 +142,80 @@ def test_mimetype_guessing() -> None:
         "sample.rtf": "application/rtf",
         "sample.txt": "text/plain",
     } == name_to_mime
+
+
+class InMemoryDocumentRegistry(DocumentRegistry):
+    """Document registry that records files in a dict instead of Postgres."""
+
+    def __init__(self, vectorstore: InMemoryVectorStore) -> None:
+        super().__init__(None)
+        self.vectorstore = vectorstore
+        self.documents: Dict[Tuple[str, str], DocumentRecord] = {}
+
+    def get(self, namespace: str, source: str) -> Optional[DocumentRecord]:
+        return self.documents.get((namespace, source))
+
+    def replace(
+        self, namespace: str, source: str, content_hash: str, chunk_ids: List[str]
+    ) -> str:
+        existing = self.documents.get((namespace, source))
+        if existing is not None:
+            self.vectorstore.delete(
+                [id_ for id_ in existing.chunk_ids if id_ not in chunk_ids]
+            )
+        self.documents[(namespace, source)] = DocumentRecord(
+            source, content_hash, chunk_ids
+        )
+        return source
+
+
+def _upload(runnable: IngestRunnable, data: bytes) -> List[str]:
+    file = UploadFile(filename="testfile.txt", file=BytesIO(data))
+    blob = convert_ingestion_input_to_blob(file)
+    try:
+        return runnable.invoke(blob)
+    finally:
+        release_blob(blob)
+
+
+def test_ingestion_runnable_replaces_uploaded_files() -> None:
+    """Uploading the same file is a no-op, uploading a new version replaces it."""
+    vectorstore = InMemoryVectorStore()
+    registry = InMemoryDocumentRegistry(vectorstore)
+    runnable = IngestRunnable(
+        text_splitter=RecursiveCharacterTextSplitter(),
+        vectorstore=vectorstore,
+        assistant_id="TheParrot",
+        registry=registry,
+    )
+
+    ids = _upload(runnable, b"test data")
+    assert _upload(runnable, b"test data") == ids
+    assert len(vectorstore.store) == 1
+
+    new_ids = _upload(runnable, b"new test data")
+    assert new_ids != ids
+    assert registry.get("TheParrot", "testfile.txt").chunk_ids == new_ids
+    assert list(vectorstore.store) == new_ids
+
+
+def test_failed_replacement_keeps_the_previous_chunks() -> None:
+    """Chunks written for a file that could not be recorded are deleted."""
+
+    class FailingDocumentRegistry(InMemoryDocumentRegistry):
+        def replace(self, *args: Any) -> str:
+            raise ConnectionError("database unavailable")
+
+    vectorstore = InMemoryVectorStore()
+    runnable = IngestRunnable(
+        text_splitter=RecursiveCharacterTextSplitter(),
+        vectorstore=vectorstore,
+        assistant_id="TheParrot",
+        registry=InMemoryDocumentRegistry(vectorstore),
+    )
+    ids = _upload(runnable, b"test data")
+
+    runnable.registry = FailingDocumentRegistry(vectorstore)
+    with pytest.raises(ConnectionError):
+        _upload(runnable, b"new test data")
+    assert list(vectorstore.store) == ids
@@ -0,0 +1,79 @@
+"""Test the in-process vector index."""
+from typing import Dict, List
+
+import numpy as np
+
+from app.vector_cache import NamespaceIndex, VectorCache
+
+
+class InMemoryVectorCache(VectorCache):
+    """Vector cache that loads namespaces from a dict instead of Postgres."""
+
+    def __init__(self, chunks: Dict[str, List[tuple]], **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.chunks = chunks
+        self.loads: List[str] = []
+
+    def _load(self, bind, collection_name: str, namespace: str) -> NamespaceIndex:
+        self.loads.append(namespace)
+        rows = self.chunks.get(namespace, [])
+        if len(rows) > self.max_rows:
+            return NamespaceIndex([], [], None, too_large=True)
+        return NamespaceIndex(
+            [text for text, _ in rows],
+            [{"namespace": namespace} for _ in rows],
+            np.array([vector for _, vector in rows], dtype=np.float32)
+            if rows
+            else None,
+        )
+
+
+CHUNKS = {
+    "assistant": [("north", [0.0, 1.0]), ("east", [1.0, 0.0]), ("west", [-1.0, 0.0])],
+    "thread": [("north-east", [1.0, 1.0])],
+}
+
+
+def _cache(**kwargs) -> InMemoryVectorCache:
+    options = {"max_bytes": 2**20, "max_rows": 100, "ttl": 300}
+    options.update(kwargs)
+    return InMemoryVectorCache(CHUNKS, **options)
+
+
+def _search(cache: VectorCache, namespaces: List[str], k: int = 2):
+    return cache.search(None, "collection", namespaces, [2.0, 0.1], k)
+
+
+def test_search_returns_top_k_across_namespaces() -> None:
+    cache = _cache()
+    docs, embeddings = _search(cache, ["assistant", "thread"])
+    assert embeddings.shape == (2, 2)
+    assert [doc.page_content for doc in docs] == ["east", "north-east"]
+    assert docs[0].metadata["score"] > docs[1].metadata["score"]
+    assert docs[0].metadata["namespace"] == "assistant"
+
+    _search(cache, ["assistant", "thread"])
+    assert cache.loads == ["assistant", "thread"]
+
+
+def test_invalidate_reloads_namespace() -> None:
+    cache = _cache()
+    _search(cache, ["assistant", "thread"])
+    cache.invalidate("thread")
+    _search(cache, ["assistant", "thread"])
+    assert cache.loads == ["assistant", "thread", "thread"]
+
+
+def test_least_recently_used_namespace_is_evicted() -> None:
+    # Room for the thread and one more chunk, but not all of the assistant.
+    index = NamespaceIndex(["north"], [{}], np.zeros((1, 2), dtype=np.float32))
+    cache = _cache(max_bytes=4 * index.nbytes)
+    _search(cache, ["thread"])
+    _search(cache, ["assistant"])
+    _search(cache, ["thread"])
+    assert cache.loads == ["thread", "assistant", "thread"]
+
+
+def test_large_namespaces_are_not_searched_in_memory() -> None:
+    cache = _cache(max_rows=2)
+    assert _search(cache, ["assistant", "thread"]) is None
@@ -0,0 +1,197 @@
+import os
+import struct
+import uuid
+from typing import Any, List
+
+import numpy as np
+import orjson
+import pytest
+from langchain_community.vectorstores.pgvector import PGVector
+from langchain_core.embeddings import Embeddings
+
+from app.quantization import QUANTIZED_DIMENSIONS, Quantization
+from app.vectorstore import (
+    BulkPGVector,
+    PGSearchRetriever,
+    SearchMode,
+    _stack_embeddings,
+    encode_copy_rows,
+)
+
+
+def _read_field(data: bytes, offset: int) -> tuple[bytes, int]:
+    (length,) = struct.unpack_from(">i", data, offset)
+    offset += 4
+    return data[offset : offset + length], offset + length
+
+
+def test_encode_copy_rows() -> None:
+    """Rows are encoded in the Postgres binary COPY format."""
+    collection_id = uuid.uuid4()
+    data = encode_copy_rows(
+        collection_id,
+        ["hello"],
+        [[0.5, -1.0]],
+        [{"namespace": "ns"}],
+        ["id-1"],
+    )
+    assert data.startswith(b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0))
+    assert data.endswith(struct.pack(">h", -1))
+
+    offset = 19
+    (field_count,) = struct.unpack_from(">h", data, offset)
+    assert field_count == 6
+    offset += 2
+
+    fields = []
+    for _ in range(field_count):
+        value, offset = _read_field(data, offset)
+        fields.append(value)
+    row_id, collection, vector, document, metadata, custom_id = fields
+
+    assert len(row_id) == 16
+    assert collection == collection_id.bytes
+    assert vector == struct.pack(">hhff", 2, 0, 0.5, -1.0)
+    assert document == b"hello"
+    assert metadata[:1] == b"\x01"
+    assert orjson.loads(metadata[1:]) == {"namespace": "ns"}
+    assert custom_id == b"id-1"
+    assert offset == len(data) - 2
+
+
+def test_stack_embeddings_of_different_models() -> None:
+    """Chunks embedded with different models are not similar to each other."""
+    stacked = _stack_embeddings(
+        [np.ones((2, 3), dtype=np.float32), np.ones((1, 2), dtype=np.float32)]
+    )
+    assert stacked.shape == (3, 5)
+    similarity = stacked @ stacked.T
+    assert similarity[0, 1] == 3
+    assert similarity[0, 2] == 0
+    assert similarity[2, 2] == 2
+
+
+class QueryEmbeddings(Embeddings):
+    """Embeds every query as the same vector."""
+
+    def __init__(self, dimensions: int = 3) -> None:
+        self.dimensions = dimensions
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+    def embed_query(self, text: str) -> List[float]:
+        return [1.0] + [0.0] * (self.dimensions - 1)
+
+
+def _vectorstore(dimensions: int = 3) -> BulkPGVector:
+    return BulkPGVector(
+        connection_string=PGVector.connection_string_from_db_params(
+            driver="psycopg2",
+            host=os.environ["POSTGRES_HOST"],
+            port=int(os.environ["POSTGRES_PORT"]),
+            database=os.environ["POSTGRES_DB"],
+            user=os.environ["POSTGRES_USER"],
+            password=os.environ["POSTGRES_PASSWORD"],
+        ),
+        embedding_function=QueryEmbeddings(dimensions),
+        collection_name=f"test-search-{uuid.uuid4()}",
+        use_jsonb=True,
+    )
+
+
+def _search_retriever(**kwargs: Any) -> PGSearchRetriever:
+    """Retriever of a collection of chunks in namespaces "a" and "b"."""
+    vectorstore = _vectorstore()
+    chunks = [
+        ("a", "pump pressure readings", [1.0, 0.0, 0.0]),
+        ("a", "valve flow readings", [0.8, 0.6, 0.0]),
+        ("a", "bearing lubrication schedule", [0.0, 1.0, 0.0]),
+        ("b", "bearing lubrication of the pump", [1.0, 0.0, 0.0]),
+    ]
+    vectorstore.add_embeddings(
+        texts=[text for _, text, _ in chunks],
+        embeddings=[embedding for _, _, embedding in chunks],
+        metadatas=[{"namespace": namespace} for namespace, _, _ in chunks],
+    )
+    return PGSearchRetriever(vectorstore=vectorstore, lambda_mult=1.0, **kwargs)
+
+
+def test_vector_search_returns_k_of_the_fetch_k_candidates() -> None:
+    retriever = _search_retriever(namespaces=["a"], k=1, fetch_k=2)
+    docs = retriever.invoke("bearing")
+    assert [doc.page_content for doc in docs] == ["pump pressure readings"]
+    assert docs[0].metadata["score"] == pytest.approx(1.0)
+
+    retriever.k = 2
+    assert [doc.page_content for doc in retriever.invoke("bearing")] == [
+        "pump pressure readings",
+        "valve flow readings",
+    ]
+    # At least k candidates are fetched.
+    retriever.k, retriever.fetch_k = 4, 1
+    assert len(retriever.invoke("bearing")) == 3
+
+
+def test_search_is_limited_to_the_namespaces() -> None:
+    for mode in SearchMode:
+        retriever = _search_retriever(namespaces=["b"], mode=mode, k=4)
+        assert [doc.page_content for doc in retriever.invoke("bearing")] == [
+            "bearing lubrication of the pump"
+        ]
+        retriever.namespaces = ["missing"]
+        assert retriever.invoke("bearing") == []
+
+
+def test_hybrid_search_fuses_the_ranks_of_both_searches() -> None:
+    retriever = _search_retriever(
+        namespaces=["a"], mode=SearchMode.HYBRID, k=3, fetch_k=3, rrf_k=60
+    )
+    docs = retriever.invoke("bearing")
+
+    # Last by embedding, but the only keyword match: it wins once fused.
+    assert [doc.page_content for doc in docs] == [
+        "bearing lubrication schedule",
+        "pump pressure readings",
+        "valve flow readings",
+    ]
+    assert [doc.metadata["score"] for doc in docs] == pytest.approx(
+        [1 / (60 + 3) + 1 / (60 + 1), 1 / (60 + 1), 1 / (60 + 2)]
+    )
+
+
+def test_quantized_search_finds_small_namespaces_next_to_large_ones() -> None:
+    """The index scan is not limited to the namespaces searched."""
+    vectorstore = _vectorstore(QUANTIZED_DIMENSIONS)
+    rng = np.random.default_rng(0)
+    # Chunks of the large namespace are all nearer the query than the others.
+    large = rng.normal(scale=0.01, size=(200, QUANTIZED_DIMENSIONS))
+    large[:, 0] += 1.0
+    small = rng.normal(scale=0.01, size=(3, QUANTIZED_DIMENSIONS))
+    small[:, 1] += 1.0
+    vectorstore.add_embeddings(
+        texts=[f"large {i}" for i in range(len(large))]
+        + [f"small {i}" for i in range(len(small))],
+        embeddings=[*large.tolist(), *small.tolist()],
+        metadatas=[{"namespace": "large"}] * len(large)
+        + [{"namespace": "small"}] * len(small),
+    )
+    for quantization in (Quantization.HALFVEC, Quantization.BINARY):
+        retriever = PGSearchRetriever(
+            vectorstore=vectorstore,
+            namespaces=["small"],
+            quantization=quantization,
+            k=3,
+            fetch_k=3,
+            rescore_factor=2,
+            lambda_mult=1.0,
+        )
+        assert sorted(doc.page_content for doc in retriever.invoke("q")) == [
+            "small 0",
+            "small 1",
+            "small 2",
+        ]
+        retriever.namespaces = ["large"]
+        docs = retriever.invoke("q")
+        assert len(docs) == 3
+        assert all(doc.page_content.startswith("large") for doc in docs)
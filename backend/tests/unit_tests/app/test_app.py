@@ -134,3 +134,13 @@ async def test_threads(pool: asyncpg.pool.Pool) -> None:
             headers={"Cookie": "opengpts_user_id=2"},
         )
         assert response.status_code == 422
+
+        # Deleted threads are not brought back.
+        response = await client.delete(f"/threads/{tid}", headers=headers)
+        assert response.status_code == 200, response.text
+        response = await client.put(
+            f"/threads/{tid}",
+            json={"name": "bobby again", "assistant_id": aid},
+            headers=headers,
+        )
+        assert response.status_code == 404
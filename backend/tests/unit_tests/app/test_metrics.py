@@ -0,0 +1,41 @@
+"""Test the Prometheus rendering of metrics."""
+import pytest
+
+from app.metrics import MetricsRegistry
+
+
+def test_render_counters_and_gauges() -> None:
+    registry = MetricsRegistry()
+    rows = registry.counter("deleted_rows_total", "Rows deleted.")
+    backlog = registry.gauge("backlog", "Pending work.")
+    rows.inc(3, table="checkpoints")
+    rows.inc(2, table="checkpoints")
+    backlog.set(7)
+
+    assert rows.value(table="checkpoints") == 5
+    assert registry.render() == (
+        "# HELP deleted_rows_total Rows deleted.\n"
+        "# TYPE deleted_rows_total counter\n"
+        'deleted_rows_total{table="checkpoints"} 5.0\n'
+        "# HELP backlog Pending work.\n"
+        "# TYPE backlog gauge\n"
+        "backlog 7\n"
+    )
+
+
+def test_metric_names_are_unique() -> None:
+    registry = MetricsRegistry()
+    registry.counter("requests_total", "Requests.")
+    with pytest.raises(ValueError):
+        registry.gauge("requests_total", "Requests.")
+
+
+def test_collectors_run_before_render() -> None:
+    registry = MetricsRegistry()
+    connections = registry.gauge("connections", "Open connections.")
+    open_connections = [1, 2]
+    registry.collector(lambda: connections.set(len(open_connections)))
+
+    assert "connections 2" in registry.render()
+    open_connections.append(3)
+    assert "connections 3" in registry.render()
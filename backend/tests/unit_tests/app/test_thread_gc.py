@@ -0,0 +1,67 @@
+"""Test the removal of the data of deleted threads."""
+from contextlib import asynccontextmanager
+from typing import Dict, List
+
+from app.thread_gc import collect_garbage
+
+
+class FakeConnection:
+    """Connection to a database of rows counted per table and thread."""
+
+    def __init__(self, rows: Dict[str, Dict[str, int]], deleted: List[str]) -> None:
+        self.rows = rows
+        self.deleted = deleted
+        self.batches: List[tuple] = []
+
+    async def fetch(self, query: str, limit: int) -> List[tuple]:
+        return [(thread_id,) for thread_id in self.deleted[:limit]]
+
+    async def fetchval(self, query: str) -> int:
+        return len(self.deleted)
+
+    async def execute(self, query: str, thread_id: str, *args) -> str:
+        if query.startswith("DELETE FROM thread "):
+            self.deleted.remove(thread_id)
+            return "DELETE 1"
+        table = query.split()[2]
+        (batch_size,) = args
+        count = min(self.rows[table].get(thread_id, 0), batch_size)
+        self.rows[table][thread_id] = self.rows[table].get(thread_id, 0) - count
+        self.batches.append((table, count))
+        return f"DELETE {count}"
+
+
+class FakePool:
+    def __init__(self, conn: FakeConnection) -> None:
+        self.conn = conn
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self.conn
+
+
+async def test_collect_garbage_deletes_in_batches() -> None:
+    tables = [
+        "checkpoint_writes",
+        "checkpoint_blobs",
+        "checkpoints",
+        "langchain_pg_embedding",
+        "document",
+        "namespace_embedding",
+    ]
+    rows = {table: {} for table in tables}
+    rows["checkpoints"] = {"t1": 5, "live": 3}
+    rows["langchain_pg_embedding"] = {"t1": 2}
+    conn = FakeConnection(rows, deleted=["t1", "t2"])
+
+    collected = await collect_garbage(FakePool(conn), batch_size=2, max_threads=1)
+
+    assert collected == ["t1"]
+    assert conn.deleted == ["t2"]
+    assert rows["checkpoints"] == {"t1": 0, "live": 3}
+    assert rows["langchain_pg_embedding"] == {"t1": 0}
+    assert [count for table, count in conn.batches if table == "checkpoints"] == [
+        2,
+        2,
+        1,
+    ]
@@ -0,0 +1,46 @@
+"""Test the Postgres tier of the caches."""
+import asyncio
+
+import asyncpg
+from langchain_core.messages import AIMessage
+
+from app.llm_cache import LLMCache
+from app.tool_cache import ToolResultCache
+from app.ttl_cache import run_cache_pruning
+
+
+async def test_entries_are_shared_through_postgres(pool: asyncpg.pool.Pool) -> None:
+    writer = LLMCache(ttl=60, max_entries=10, get_pool=lambda: pool)
+    reader = LLMCache(ttl=60, max_entries=10, get_pool=lambda: pool)
+    await writer.aupdate("key", AIMessage("cached answer", id="run-1"))
+
+    tier, message = await reader.get("key")
+    assert (tier, message.content, message.id) == ("postgres", "cached answer", None)
+    assert (await reader.get("key"))[0] == "memory"
+
+    tools = ToolResultCache(enabled=True, max_entries=10, get_pool=lambda: pool)
+    await tools.update("key", "search", [{"url": "https://example.com"}], 60)
+    tools.clear()
+    assert await tools.get("key") == ("postgres", [{"url": "https://example.com"}])
+
+
+async def test_expired_entries_of_every_cache_are_pruned(
+    pool: asyncpg.pool.Pool,
+) -> None:
+    llm_cache = LLMCache(ttl=0.01, max_entries=10, get_pool=lambda: pool)
+    tool_cache = ToolResultCache(enabled=True, max_entries=10, get_pool=lambda: pool)
+    await llm_cache.aupdate("expired", AIMessage("old answer"))
+    await tool_cache.update("expired", "search", "old result", 0.01)
+    await tool_cache.update("fresh", "search", "new result", 60)
+    await asyncio.sleep(0.05)
+
+    task = asyncio.create_task(
+        run_cache_pruning(pool, [llm_cache, tool_cache], interval=60)
+    )
+    await asyncio.sleep(0.2)
+    task.cancel()
+
+    async with pool.acquire() as conn:
+        assert await conn.fetchval("SELECT count(*) FROM llm_cache") == 0
+        rows = await conn.fetch("SELECT key FROM tool_cache")
+    assert [row["key"] for row in rows] == ["fresh"]
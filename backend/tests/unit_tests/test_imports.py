@@ -4,3 +4,8 @@
 def test_import_app() -> None:
     """Test import app"""
     import app  # noqa: F401
+
+
+def test_import_server() -> None:
+    """Test import the server, which builds the agents at import time"""
+    import app.server  # noqa: F401
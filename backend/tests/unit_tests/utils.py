@@ -39,7 +39,7 @@ class InMemoryVectorStore(VectorStore):
             )
 
         if not ids:
-            start_idx = max(self.store.keys(), default=0)
+            start_idx = max(map(int, self.store.keys()), default=-1) + 1
             ids = [str(x) for x in (range(start_idx, start_idx + len(documents)))]
 
         for _id, document in zip(ids, documents):
@@ -63,7 +63,7 @@ class InMemoryVectorStore(VectorStore):
             )
 
         if not ids:
-            start_idx = max(self.store.keys(), default=0)
+            start_idx = max(map(int, self.store.keys()), default=-1) + 1
             ids = [str(x) for x in (range(start_idx, start_idx + len(documents)))]
 
         for _id, document in zip(ids, documents):
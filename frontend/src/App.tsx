@@ -17,6 +17,7 @@ import { useNavigate } from "react-router-dom";
 import { useThreadAndAssistant } from "./hooks/useThreadAndAssistant.ts";
 import { Message } from "./types.ts";
 import { OrphanChat } from "./components/OrphanChat.tsx";
+import { ingestFiles } from "./api/ingest.ts";
 
 function App(props: { edit?: boolean }) {
   const navigate = useNavigate();
@@ -37,18 +38,12 @@ function App(props: { edit?: boolean }) {
     ) => {
       const files = message?.files || [];
       if (files.length > 0) {
-        const formData = files.reduce((formData, file) => {
-          formData.append("files", file);
-          return formData;
-        }, new FormData());
-        formData.append(
-          "config",
-          JSON.stringify({ configurable: { thread_id } }),
-        );
-        await fetch(`/ingest`, {
-          method: "POST",
-          body: formData,
-        });
+        try {
+          await ingestFiles(files, { thread_id });
+        } catch (error) {
+          window.alert((error as Error).message);
+          return;
+        }
       }
 
       // eslint-disable-next-line @typescript-eslint/no-explicit-any
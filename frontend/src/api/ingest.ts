@@ -0,0 +1,51 @@
+export interface IngestFileProgress {
+  name: string;
+  status: IngestJob["status"];
+  chunks: number;
+  error?: string | null;
+}
+
+export interface IngestJob {
+  job_id: string;
+  status: "queued" | "running" | "succeeded" | "failed";
+  files: IngestFileProgress[];
+}
+
+const POLL_INTERVAL_MS = 500;
+
+export async function ingestFiles(
+  files: File[],
+  configurable: Record<string, string>,
+): Promise<IngestJob> {
+  const formData = files.reduce((formData, file) => {
+    formData.append("files", file);
+    return formData;
+  }, new FormData());
+  formData.append("config", JSON.stringify({ configurable }));
+  const response = await fetch(`/ingest`, {
+    method: "POST",
+    body: formData,
+  });
+  if (!response.ok) {
+    const { detail } = await response.json().catch(() => ({}));
+    throw new Error(detail ?? "Failed to upload files.");
+  }
+
+  // Files are indexed in the background, wait until they can be retrieved.
+  let job = (await response.json()) as IngestJob;
+  while (job.status === "queued" || job.status === "running") {
+    await new Promise((resolve) => setTimeout(resolve, POLL_INTERVAL_MS));
+    const jobResponse = await fetch(`/ingest/${job.job_id}`);
+    if (!jobResponse.ok) {
+      throw new Error("Failed to get the status of the uploaded files.");
+    }
+    job = (await jobResponse.json()) as IngestJob;
+  }
+  if (job.status === "failed") {
+    const failed = job.files
+      .filter((file) => file.status === "failed")
+      .map((file) => `${file.name} (${file.error ?? "unknown error"})`);
+    throw new Error(`Failed to ingest ${failed.join(", ")}`);
+  }
+  return job;
+}
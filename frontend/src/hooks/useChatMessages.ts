@@ -2,6 +2,9 @@ import { useCallback, useEffect, useMemo, useRef, useState } from "react";
 import { Message } from "../types";
 import { StreamState, mergeMessagesById } from "./useStreamState";
 
+// Summary of the older turns of a thread, kept in its state for the model.
+const SUMMARY_MESSAGE_ID = "conversation-summary";
+
 async function getState(threadId: string) {
   const { values, next } = await fetch(`/threads/${threadId}/state`, {
     headers: {
@@ -70,7 +73,9 @@ export function useChatMessages(
   return useMemo(
     () => ({
       refreshMessages,
-      messages: mergeMessagesById(messages, stream?.messages),
+      messages: mergeMessagesById(messages, stream?.messages).filter(
+        (msg) => msg.id !== SUMMARY_MESSAGE_ID,
+      ),
       next,
     }),
     [messages, stream?.messages, next, refreshMessages],
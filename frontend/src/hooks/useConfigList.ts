@@ -1,6 +1,7 @@
 import { useCallback, useEffect, useReducer } from "react";
 import orderBy from "lodash/orderBy";
 import { getAssistants } from "../api/assistants";
+import { ingestFiles } from "../api/ingest";
 
 export interface Config {
   assistant_id: string;
@@ -83,19 +84,11 @@ export function useConfigList(): ConfigListProps {
       );
       const savedConfig = (await confResponse.json()) as Config;
       if (files.length) {
-        const assistant_id = savedConfig.assistant_id;
-        const formData = files.reduce((formData, file) => {
-          formData.append("files", file);
-          return formData;
-        }, new FormData());
-        formData.append(
-          "config",
-          JSON.stringify({ configurable: { assistant_id } }),
-        );
-        await fetch(`/ingest`, {
-          method: "POST",
-          body: formData,
-        });
+        try {
+          await ingestFiles(files, { assistant_id: savedConfig.assistant_id });
+        } catch (error) {
+          window.alert((error as Error).message);
+        }
       }
       setConfigs({ ...savedConfig, mine: true });
       return savedConfig.assistant_id;